@@ -28,21 +28,42 @@ const CostManagementHub = () => {
 
     const [usageData, setUsageData] = useState(data);
     const [agentsList, setAgentsList] = useState([]);
+    const [costs, setCosts] = useState({});
 
-    const getAgents = () => {
-        fetch(`${apiURL}/get_agents`, { method: 'GET' })
+    // /get_agents is paginated, the next page is requested until X-Next-Cursor is absent
+    const getAgents = async () => {
+        let agents = [];
+        let cursor = null;
+        do {
+            const params = new URLSearchParams({ limit: 1000 });
+            if (cursor) params.set('cursor', cursor);
+
+            const res = await fetch(`${apiURL}/get_agents?${params}`, { method: 'GET' });
+            if (res.status !== 200) break;
+            agents = agents.concat(await res.json());
+            cursor = res.headers.get('X-Next-Cursor');
+        } while (cursor);
+
+        setAgentsList(agents);
+    }
+
+    // spend for every agent in one request, served from the backend's snapshots
+    const getCosts = () => {
+        fetch(`${apiURL}/costs`, { method: 'GET' })
         .then((res)=>{
-            if (res.status !== 404) {
-                return res.json();
-            }
+            if (res.status === 200) return res.json();
         })
         .then((data)=> {
-            setAgentsList(data);
+            if (data === undefined) return;
+            let costsByAgent = {};
+            data.costs.forEach((cost)=> costsByAgent[cost.agent_id] = cost);
+            setCosts(costsByAgent);
         });
     }
 
     useEffect(()=> {
         getAgents();
+        getCosts();
     }, []);
 
     return(
@@ -83,6 +104,7 @@ const CostManagementHub = () => {
                                         <th>Description</th>
                                         <th>Owner</th>
                                         <th>Status</th>
+                                        <th>Spend (£)</th>
                                     </tr>
                                 </thead>
                                 <tbody>
@@ -93,6 +115,7 @@ const CostManagementHub = () => {
                                             <td className='max-w-[200px]'>{agent.description}</td>
                                             <td>{agent.owner}</td>
                                             <td>{agent.status}</td>
+                                            <td>{costs[agent.id]?.current_spend ? costs[agent.id].current_spend.amount : '-'}</td>
                                         </tr>
                                     ))
                                     }
@@ -0,0 +1,189 @@
+import importlib
+import os
+import threading
+import time
+
+# Credential the management clients authenticate with: "cli" uses the az login of the
+# machine, "default" the DefaultAzureCredential chain (managed identity, environment, ...)
+AZURE_CREDENTIAL = os.getenv("AZURE_CREDENTIAL", "cli")
+# Seconds before expiry a cached token is fetched again
+TOKEN_REFRESH_MARGIN = int(os.getenv("AZURE_TOKEN_REFRESH_MARGIN", "300"))
+
+# Module and class of each management client, imported when the client is first used
+MANAGEMENT_CLIENTS = {
+    'resource_client': ('azure.mgmt.resource', 'ResourceManagementClient'),
+    'consumption_client': ('azure.mgmt.consumption', 'ConsumptionManagementClient'),
+    'storage_client': ('azure.mgmt.storage', 'StorageManagementClient'),
+    'cognitive_client': ('azure.mgmt.cognitiveservices', 'CognitiveServicesManagementClient'),
+    'authorization_client': ('azure.mgmt.authorization', 'AuthorizationManagementClient')
+}
+
+def make_credential(kind=AZURE_CREDENTIAL):
+    from azure import identity
+    if kind == "cli":
+        return identity.AzureCliCredential()
+    if kind == "default":
+        return identity.DefaultAzureCredential()
+    raise ValueError(f"Unknown AZURE_CREDENTIAL '{kind}', expected 'cli' or 'default'.")
+
+class CachedCredential:
+    """
+    One credential shared by every Azure client, created on the first token request.
+    Tokens are cached per scope until shortly before they expire, so the clients do not
+    each run `az account get-access-token` (or another credential round trip) per call.
+    Each scope is fetched under its own lock, and a token that is due for refresh but
+    not yet expired is still served while one thread fetches the next.
+    :param factory: Callable creating the wrapped azure.identity credential
+    :param refresh_margin: Seconds before expiry a cached token is fetched again
+    """
+    def __init__(self, factory=make_credential, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.factory = factory
+        self.refresh_margin = refresh_margin
+        self.credential = None
+        self._tokens = {}
+        self._fetch_locks = {}
+        # guards the dictionaries and the credential, never held during a fetch
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _credential(self):
+        with self._lock:
+            if self.credential is None:
+                self.credential = self.factory()
+            return self.credential
+
+    def _fresh(self, key):
+        token = self._tokens.get(key)
+        if token is not None and token.expires_on - time.time() > self.refresh_margin:
+            return token
+        return None
+
+    def get_token(self, *scopes, claims=None, tenant_id=None, enable_cae=False, **kwargs):
+        # claims challenges always go to the credential
+        key = (scopes, tenant_id, enable_cae)
+        with self._lock:
+            token = self._fresh(key) if claims is None else None
+            if token is not None:
+                self.hits += 1
+                return token
+            stale = self._tokens.get(key) if claims is None else None
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+
+        if stale is not None and stale.expires_on > time.time():
+            # another thread is already refreshing a token that is still valid
+            if not fetch_lock.acquire(blocking=False):
+                with self._lock:
+                    self.hits += 1
+                return stale
+        else:
+            fetch_lock.acquire()
+        try:
+            # concurrent first requests wait here for the one token being fetched
+            if claims is None:
+                with self._lock:
+                    token = self._fresh(key)
+                    if token is not None:
+                        self.hits += 1
+                        return token
+            token = self._credential().get_token(*scopes, claims=claims, tenant_id=tenant_id, enable_cae=enable_cae, **kwargs)
+            with self._lock:
+                self.misses += 1
+                self._tokens[key] = token
+            return token
+        finally:
+            fetch_lock.release()
+
+    def close(self):
+        with self._lock:
+            if self.credential is not None and hasattr(self.credential, "close"):
+                self.credential.close()
+            self.credential = None
+            self._tokens.clear()
+
+class AzureClients:
+    """
+    Holds the Azure management clients shared by the endpoints and the background jobs.
+    Each client (and its SDK package) is imported and created on first use.
+    :param credentials: Azure credential used by every client
+    :param subscription_id: The Azure subscription the agents are provisioned in
+    :param client_options: Keyword arguments passed to every management and blob client, e.g. pipeline hooks
+    """
+    def __init__(self, credentials, subscription_id, client_options=None):
+        self.credentials = credentials
+        self.subscription_id = subscription_id
+        self.client_options = client_options or {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _management_client(self, name):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    module_name, class_name = MANAGEMENT_CLIENTS[name]
+                    client_class = getattr(importlib.import_module(module_name), class_name)
+                    client = self._clients[name] = client_class(self.credentials, self.subscription_id, **self.client_options)
+        return client
+
+    @property
+    def resource_client(self):
+        return self._management_client('resource_client')
+
+    @property
+    def consumption_client(self):
+        return self._management_client('consumption_client')
+
+    @property
+    def storage_client(self):
+        return self._management_client('storage_client')
+
+    @property
+    def cognitive_client(self):
+        return self._management_client('cognitive_client')
+
+    @property
+    def authorization_client(self):
+        return self._management_client('authorization_client')
+
+    def created(self):
+        # names of the management clients created so far
+        return sorted(self._clients)
+
+    def ml_client(self, resource_group_name):
+        from azure.ai.ml import MLClient
+        return MLClient(self.credentials, self.subscription_id, resource_group_name)
+
+    def blob_service_client(self, account_url, credential, **kwargs):
+        from azure.storage.blob import BlobServiceClient
+        return BlobServiceClient(account_url=account_url, credential=credential, **{**self.client_options, **kwargs})
+
+    def blob_read_url(self, account_name, account_key, container_name, blob_name, expiry):
+        from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+        # read-only SAS URL of a blob, used as the source of server-side copies
+        sas = generate_blob_sas(account_name, container_name, blob_name, account_key=account_key, permission=BlobSasPermissions(read=True), expiry=expiry)
+        return f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas}"
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+        if hasattr(self.credentials, "close"):
+            self.credentials.close()
+
+def azure_clients_from_env(subscription_id, client_options=None):
+    """
+    AzureClients with a lazily created, token-caching credential, or the in-process
+    fakes of fake_azure.py when AZURE_CLIENTS=fake (local runs without an Azure login),
+    which answer after FAKE_AZURE_LATENCY seconds (FAKE_AZURE_LRO_LATENCY for pollers).
+    """
+    if os.getenv("AZURE_CLIENTS", "azure").lower() == "fake":
+        from fake_azure import FakeAzureClients
+        return FakeAzureClients(
+            subscription_id,
+            latency=float(os.getenv("FAKE_AZURE_LATENCY", "0")),
+            lro_latency=float(os.getenv("FAKE_AZURE_LRO_LATENCY", "0"))
+        )
+    return AzureClients(CachedCredential(), subscription_id, client_options)
@@ -1,32 +1,48 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from io import BytesIO
-
-from azure.identity import AzureCliCredential
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.consumption import ConsumptionManagementClient
-from azure.mgmt.consumption.models import Budget, BudgetTimePeriod, Notification
-from azure.mgmt.storage import StorageManagementClient
-from azure.ai.ml import MLClient
-from azure.ai.ml.entities import Workspace
-from azure.mgmt.cognitiveservices import CognitiveServicesManagementClient
-from azure.mgmt.cognitiveservices.models import Account, Sku, Deployment, DeploymentModel, DeploymentProperties
-from azure.storage.blob import BlobServiceClient, BlobClient
-from azure.core.polling import LROPoller
-from azure.core.exceptions import HttpResponseError
-from openai import AzureOpenAI
+from fastapi.responses import StreamingResponse, Response, FileResponse
+from pydantic import BaseModel, Field
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 
 from azure.core.exceptions import ResourceExistsError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, nullcontext
 from datetime import datetime, timezone, timedelta
+import base64
+import hashlib
+import json
 import os
-
-from models import Agent, KnowledgeSource, AgentKnowledgeSource, Base
-from database import engine, get_db
-from sqlalchemy.orm import Session
+import time
+
+from models import Agent, KnowledgeSource, AgentKnowledgeSource, Job, CostSnapshot, AgentReconciliation, AGENT_DELETING
+from database import engine, get_db, get_async_db, SessionLocal, pool_stats, dispose_async_engine
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
 from schemas import KnowledgeSourceCreate, AgentKnowledgeSourceCreate
-from typing import Annotated
+from typing import Annotated, NamedTuple
+
+from azure_clients import azure_clients_from_env
+from jobs import JobRunner, Step, serialize_job, UNFINISHED
+from provisioning import NEW_AGENT_STEPS, DEPLOYMENT_CAPACITY, delete_resource_group
+from openai_clients import OpenAIClientRegistry, OPENAI_API_VERSION
+from response_cache import response_cache_from_env, estimate_tokens
+from sessions import SessionStore, SUMMARY_PROMPT
+from rate_limits import rate_limiter_from_env, RateLimitExceeded
+from chat_batch import BatchStats, CHAT_BATCH_CONCURRENCY, PROMPTS_FILE, RESULTS_FILE, parse_prompts, run_batch, throttled_from
+from costs import CostRefresher, serialize_snapshot
+from reconciler import Reconciler, serialize_reconciliation
+from spend_history import SpendHistoryStore, STEPS
+from blob_uploads import UPLOAD_CHUNK_SIZE
+from blob_downloads import open_blob_stream, parse_range, RangeNotSatisfiable, DOWNLOAD_CHUNK_SIZE
+from storage_resolver import StorageResolver, StorageAccountNotFound
+from bulk_ingest import archive_items, upload_file_item, BULK_UPLOAD_CONCURRENCY, BULK_MAX_FILES
+from retrieval import RetrievalIndex, OpenAIEmbedder
+from migrations import upgrade as upgrade_schema
+from metrics import MetricsMiddleware, instrument_sqlalchemy, azure_client_options, openai_event_hooks, bind_agent, registry as metrics_registry
+from knowledge_store import ingest_knowledge, release_agent_knowledge, delete_content_blob, agent_container_name, blob_path, ALREADY_LINKED, FAILED
 
 from urllib.parse import urlparse
 from dotenv import load_dotenv
@@ -34,9 +50,50 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
-Base.metadata.create_all(bind=engine)
+# Every query of the sync and async engines is timed and counted per request
+instrument_sqlalchemy()
 
-app = FastAPI()
+# Schema changes are versioned migrations, see migrations.py
+if os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true":
+    upgrade_schema(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Blocking Azure SDK calls run through asyncio.to_thread, whose default pool
+    # only has cpu_count + 4 threads and would cap bulk upload concurrency
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=int(os.getenv("BLOCKING_IO_THREADS", "64")), thread_name_prefix="blocking-io")
+    )
+
+    # chat batch jobs run their prompts on this loop, next to the interactive chats
+    app.state.loop = asyncio.get_running_loop()
+    # openai stays out of the import of this module, it is imported off the event loop
+    # while the application starts so the first chat does not import it on the loop
+    app.state.openai_preload = asyncio.create_task(asyncio.to_thread(OpenAIClientRegistry.preload))
+
+    # Resume provisioning, deletion and batch jobs whose runner stopped, now and while running
+    for runner in job_runners:
+        runner.start()
+    # Index approved knowledge sources that have no segment yet, existing segments are only mapped
+    sync_retrieval_index()
+    if cost_refresher.interval > 0:
+        cost_refresher.start()
+    if reconciler.interval > 0:
+        reconciler.start()
+    session_store.start()
+    yield
+    cost_refresher.stop()
+    reconciler.stop()
+    session_store.stop()
+    for runner in job_runners:
+        runner.shutdown()
+    azure_clients.close()
+    retrieval_index.shutdown()
+    await app.state.openai_preload
+    await openai_clients.aclose()
+    await dispose_async_engine()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -49,16 +106,113 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
+# added last, so it is the outermost middleware and times the whole request
+app.add_middleware(MetricsMiddleware)
 
-credentials = AzureCliCredential()
 subscription_id = os.environ["AZURE_SUBSCRIPTION_ID"]
 user_object_id = os.environ["AZURE_USER_OBJECT_ID"]
 
-resource_client = ResourceManagementClient(credentials, subscription_id)
-consumption_client = ConsumptionManagementClient(credentials, subscription_id)
-storage_client = StorageManagementClient(credentials, subscription_id)
-cognitive_client = CognitiveServicesManagementClient(credentials, subscription_id)
+# Azure SDK clients and the shared credential are created on first use (AZURE_CLIENTS=fake for local runs)
+azure_clients = azure_clients_from_env(subscription_id, azure_client_options())
+
+# Background runner for long-running provisioning work
+job_runner = JobRunner(SessionLocal, azure_clients, max_workers=int(os.getenv("JOB_WORKERS", "4")))
+job_runner.register('new_agent', NEW_AGENT_STEPS)
+
+# Agent deletions run on their own runner, so decommissioning many agents never queues provisioning behind it
+TEARDOWN_WORKERS = int(os.getenv("TEARDOWN_WORKERS", "16"))
+teardown_runner = JobRunner(SessionLocal, azure_clients, max_workers=TEARDOWN_WORKERS, max_step_workers=TEARDOWN_WORKERS)
+
+# Chat batches hold a worker for as long as their prompts take, so they get their own runner too
+CHAT_BATCH_WORKERS = int(os.getenv("CHAT_BATCH_WORKERS", "2"))
+batch_runner = JobRunner(SessionLocal, azure_clients, max_workers=CHAT_BATCH_WORKERS)
+
+job_runners = (job_runner, teardown_runner, batch_runner)
+
+# Per-agent AzureOpenAI clients, reused across chat turns
+openai_clients = OpenAIClientRegistry(
+    max_size=int(os.getenv("OPENAI_CLIENT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("OPENAI_CLIENT_TTL", "900")),
+    max_connections=int(os.getenv("OPENAI_CLIENT_MAX_CONNECTIONS", "100")),
+    asynchronous=True,
+    event_hooks=openai_event_hooks
+)
+
+# Opt-in per-agent cache of chat replies
+response_cache = response_cache_from_env()
+
+# Server-side chat sessions, least recently used ones are spilled to the database
+session_store = SessionStore(
+    SessionLocal,
+    max_sessions=int(os.getenv("CHAT_SESSION_CACHE_SIZE", "1000")),
+    context_budget=int(os.getenv("CHAT_CONTEXT_TOKENS", "3000")),
+    history_budget=int(os.getenv("CHAT_HISTORY_TOKENS", "2000")),
+    flush_interval=float(os.getenv("CHAT_SESSION_FLUSH_INTERVAL", "30")),
+    prompt_price=response_cache.prompt_price,
+    completion_price=response_cache.completion_price
+)
+
+# Per-agent chat rate limits matching the deployment capacity, and budget admission
+rate_limiter = rate_limiter_from_env(DEPLOYMENT_CAPACITY, response_cache.prompt_price, response_cache.completion_price)
+CHAT_DEGRADED_MAX_TOKENS = int(os.getenv("CHAT_DEGRADED_MAX_TOKENS", "200"))
+
+# Budget spend snapshots, refreshed in the background (0 disables the schedule)
+cost_refresher = CostRefresher(
+    SessionLocal,
+    azure_clients,
+    interval=float(os.getenv("COST_REFRESH_INTERVAL", "900")),
+    stale_after=float(os.getenv("COST_STALE_AFTER", "1800")),
+    max_workers=int(os.getenv("COST_REFRESH_WORKERS", "4")),
+    retry_after=float(os.getenv("COST_RETRY_AFTER", "300"))
+)
+
+# Every refresh also appends a spend sample per agent to the local history store
+spend_history = SpendHistoryStore(os.getenv("SPEND_HISTORY_DIR", "spend_history"))
+cost_refresher.listeners.append(lambda refreshed, now: spend_history.add_samples(refreshed, now.timestamp()))
+
+# Agent rows compared with their Azure resources in the background (0 disables the schedule)
+reconciler = Reconciler(
+    SessionLocal,
+    azure_clients,
+    interval=float(os.getenv("RECONCILE_INTERVAL", "600")),
+    batch_size=int(os.getenv("RECONCILE_BATCH_SIZE", "500")),
+    max_workers=int(os.getenv("RECONCILE_WORKERS", "4")),
+    deployment_check_after=float(os.getenv("RECONCILE_DEPLOYMENT_CHECK_AFTER", "3600")),
+    deployment_check_limit=int(os.getenv("RECONCILE_DEPLOYMENT_CHECK_LIMIT", "200"))
+)
+
+# Passage index over approved knowledge sources, used to ground chat replies.
+# Embeddings are only computed when an embedding deployment is configured.
+retrieval_embedder = None
+if os.getenv("RETRIEVAL_EMBEDDING_DEPLOYMENT"):
+    from openai import AzureOpenAI, DefaultHttpxClient
+    retrieval_embedder = OpenAIEmbedder(
+        AzureOpenAI(
+            azure_endpoint=os.environ["RETRIEVAL_EMBEDDING_ENDPOINT"],
+            api_key=os.environ["RETRIEVAL_EMBEDDING_API_KEY"],
+            api_version=OPENAI_API_VERSION,
+            http_client=DefaultHttpxClient(event_hooks=openai_event_hooks(None, False))
+        ),
+        os.environ["RETRIEVAL_EMBEDDING_DEPLOYMENT"]
+    )
+retrieval_index = RetrievalIndex(
+    os.getenv("RETRIEVAL_INDEX_DIR", "retrieval_index"),
+    passage_tokens=int(os.getenv("RETRIEVAL_PASSAGE_TOKENS", "200")),
+    embedder=retrieval_embedder
+)
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "1500"))
+RETRIEVAL_MAX_SOURCE_BYTES = int(os.getenv("RETRIEVAL_MAX_SOURCE_BYTES", str(50 * 1024 * 1024)))
+
+# Storage account, key and blob clients of each agent resource group, shared by uploads and downloads
+storage_resolver = StorageResolver(
+    azure_clients,
+    ttl=float(os.getenv("STORAGE_RESOLVER_TTL", "3600")),
+    max_single_get_size=DOWNLOAD_CHUNK_SIZE,
+    max_chunk_get_size=DOWNLOAD_CHUNK_SIZE
+)
 
 class ResourceGroup(BaseModel):
     name: str
@@ -73,65 +227,13 @@ class ResourceGroup(BaseModel):
     budget: float
 
 def get_openai_api_key(subscription_id, resource_group_name, resource_name):
-    # Initialize the Cognitive Services Management Client
-    cognitive_client = CognitiveServicesManagementClient(credentials, subscription_id)
-
     # Retrieve the API keys for the specified Cognitive Services resource
-    keys = cognitive_client.accounts.list_keys(resource_group_name, resource_name)
+    keys = azure_clients.cognitive_client.accounts.list_keys(resource_group_name, resource_name)
 
     # Return the primary API key
     return keys.key1
 
-def deploy_openai_model(cognitive_client, resource_group_name, openai_resource_name, deployment_name, model_name, model_version):
-    try:
-        # Define the deployment model
-        deployment_model = DeploymentModel(
-            name=model_name,
-            format='OpenAI',
-            version=model_version,
-            publisher='OpenAI'
-        )
-
-        # Define the deployment properties
-        deployment_properties = DeploymentProperties(
-            model=deployment_model
-        )
-
-        # Define the SKU for the deployment
-        deployment_sku = Sku(
-            name='Standard',
-            capacity=1
-        )
-
-        # Define the deployment
-        deployment = Deployment(
-            sku=deployment_sku,
-            properties=deployment_properties
-        )
-
-        # Begin the deployment creation or update
-        poller = cognitive_client.deployments.begin_create_or_update(
-            resource_group_name=resource_group_name,
-            account_name=openai_resource_name,
-            deployment_name=deployment_name,
-            deployment=deployment
-        )
-
-        # Wait for the deployment to complete
-        deployment_result = poller.result(timeout=3600)  # Timeout after 1 hour
-        print(f"Deployment {deployment_name} completed successfully.")
-        return deployment_result
-
-    except HttpResponseError as e:
-        print(f"Failed to deploy model: {e.message}")
-        raise HTTPException(status_code=500, detail=f"Failed to deploy model: {e.message}")
-    except Exception as e:
-        print(f"Unexpected error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
-
 import asyncio
-from azure.mgmt.authorization import AuthorizationManagementClient
-from azure.mgmt.authorization.models import RoleAssignmentCreateParameters
 from uuid import uuid4
 
 def assign_storage_role_sync(resource_group_name, storage_account_name, principal_id):
@@ -145,11 +247,11 @@ def assign_storage_role_sync(resource_group_name, storage_account_name, principa
     role_definition_id = f"/subscriptions/{subscription_id}/providers/Microsoft.Authorization/roleDefinitions/ba92f5b4-2d11-453d-a403-e96b0029c9fe"
 
     # Get the storage account resource ID
-    storage_account = storage_client.storage_accounts.get_properties(resource_group_name, storage_account_name)
+    storage_account = azure_clients.storage_client.storage_accounts.get_properties(resource_group_name, storage_account_name)
     storage_account_id = storage_account.id
 
-    # Initialize the Authorization Management Client
-    auth_client = AuthorizationManagementClient(credentials, subscription_id)
+    from azure.mgmt.authorization.models import RoleAssignmentCreateParameters
+    auth_client = azure_clients.authorization_client
 
     # Generate a unique ID for the role assignment
     role_assignment_id = str(uuid4())
@@ -172,22 +274,15 @@ async def assign_storage_role(resource_group_name, storage_account_name, princip
 def read_root():
     return {"message": "Hello World"}
 
-@app.post("/new_agent")
+@app.post("/new_agent", status_code=202)
 def new_agent(resource_group:ResourceGroup, db: Session = Depends(get_db)):
+    rg_name = f"agent-{resource_group.name}-rg"
 
     # checking if the agent already exists
-    db_item = db.query(Agent).filter(Agent.name == resource_group.name).first()
+    db_item = db.query(Agent).filter(Agent.name == rg_name).first()
     if db_item:
-        return HTTPException(404, { "message": "Error - agent already exists."})
+        raise HTTPException(status_code=409, detail="Agent already exists.")
     else:
-        rg_name = f"agent-{resource_group.name}-rg"
-        location = resource_group.location
-
-        # Provision the resource group
-        rg_result = resource_client.resource_groups.create_or_update(
-            rg_name, {"location": location, "tags": {"type": "agent"}}
-        )
-
         db_item = Agent(
             name=rg_name,
             display_name=resource_group.name,
@@ -201,375 +296,1128 @@ def new_agent(resource_group:ResourceGroup, db: Session = Depends(get_db)):
             budget=resource_group.budget
         )
         db.add(db_item)
-        db.flush()
+        try:
+            db.commit()
+        except IntegrityError:
+            # a concurrent request created the agent first, only one provisioning job is started
+            db.rollback()
+            raise HTTPException(status_code=409, detail="Agent already exists.")
         db.refresh(db_item)
 
-        budget_name = f"{rg_name}-budget"
-        scope = f"/subscriptions/{subscription_id}/resourceGroups/{rg_name}"
-        amount = resource_group.budget
-        time_grain = 'Monthly'  # Options: 'Monthly', 'Quarterly', 'Annually'
-        start_date = datetime(datetime.now(timezone.utc).year, datetime.now(timezone.utc).month, 1, tzinfo=timezone.utc)
-        end_date = datetime(start_date.year + 1, start_date.month, start_date.day)
-
-        # Define notifications (optional)
-        notifications = {
-            'Actual_GreaterThan_80_Percent': Notification(
-                enabled=True,
-                operator='GreaterThan',
-                threshold=80,
-                contact_emails=[resource_group.owner_email],
-                threshold_type='Actual'
-            )
-        }
+        # the Azure resources are provisioned in the background
+        job = job_runner.create_job(db, 'new_agent', agent_id=db_item.id, payload={"display_name": resource_group.display_name})
+        job_runner.submit(job.id)
 
-        # Create the Budget object
-        budget = Budget(
-            category='Cost',
-            amount=amount,
-            time_grain=time_grain,
-            time_period=BudgetTimePeriod(
-                start_date=start_date,
-                end_date=end_date
-            ),
-            notifications=notifications
-        )
+        return {
+            "message": f"Provisioning of resource group {rg_name} has started.",
+            "agent_id": db_item.id,
+            "job_id": job.id
+        }
 
-        # Create or update the budget
-        consumption_client.budgets.create_or_update(
-            scope=scope,
-            budget_name=budget_name,
-            parameters=budget
-        )
+@app.get('/jobs/{job_id}')
+def get_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return serialize_job(job)
+
+@app.post('/jobs/{job_id}/retry', status_code=202)
+def retry_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job.status != 'Failed':
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}, only failed jobs can be retried.")
+
+    runner = next((runner for runner in job_runners if runner.runs(job.kind)), None)
+    if runner is None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is a {job.kind} job, which this server does not run.")
+    runner.retry(db, job)
+    return {"message": f"Job {job_id} has been resubmitted.", "job_id": job_id}
 
-        # Creating the Azure AI Foundry Project
-        project_name = f"project-agent{db_item.id}"
+class ChatRequest(BaseModel):
+    agent_id: int
+    user_input: str
+    stream: bool = False
+    # continue a server-side chat session, see POST /agent/{agent_id}/chat_sessions
+    session_id: str | None = None
 
-        # Initialize the MLClient
-        ml_client = MLClient(credentials, subscription_id, rg_name)
+SYSTEM_PROMPT = "You are a helpful assistant."
 
-        # Define the workspace
-        workspace = Workspace(
-            name=project_name,
-            location=location,
-            display_name=resource_group.display_name,
-            description=resource_group.description,
-        )
+class ChatTarget(NamedTuple):
+    agent_id: int
+    openai_endpoint: str
+    openai_api_key: str
+    deployment_name: str
+    response_cache_enabled: bool
+    knowledge_ids: tuple
+    rate_limit_rpm: int | None
+    rate_limit_tpm: int | None
+    budget: float | None
+    spend: float | None
+    spend_refreshed_at: datetime | None
+
+class Admission(NamedTuple):
+    limiter: object
+    reserved_tokens: int
+    # over budget with the 'degrade' policy: ungrounded and with a capped reply length
+    degraded: bool
+
+def ensure_not_deleting(agent):
+    # an agent being deleted takes no new work, its resources are going away
+    if agent.status == AGENT_DELETING:
+        raise HTTPException(status_code=409, detail=f"Agent {agent.id} is being deleted.")
+
+def get_chat_agent(db: Session, agent_id: int):
+    # Retrieve the agent from the database
+    db_item = db.query(Agent).filter(Agent.id == agent_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Agent not found.")
+    ensure_not_deleting(db_item)
 
-        # Create the workspace
-        workspace = ml_client.workspaces.begin_create(workspace).result()
-        print(f"Provisioned Azure AI Foundry project {workspace.name} in the {workspace.location} region")
+    # Retrieve the stored OpenAI endpoint, API key, and deployment name from the database
+    openai_endpoint = db_item.openai_endpoint
+    openai_api_key = db_item.openai_api_key
+    deployment_name = f"gpt-3-deployment-agent{db_item.id}" #db_item.deployment_name  # Retrieve the deployment name
+    if not openai_endpoint or not openai_api_key or not deployment_name:
+        raise HTTPException(status_code=500, detail="OpenAI credentials or deployment not available.")
 
-        workspace_details = ml_client.workspaces.get(name=project_name)
-        workspace_endpoint = workspace_details.discovery_url
+    # approved knowledge sources the reply can be grounded in
+    knowledge_ids = tuple(
+        row.knowledge_id for row in db.query(AgentKnowledgeSource.knowledge_id)
+        .join(KnowledgeSource, KnowledgeSource.id == AgentKnowledgeSource.knowledge_id)
+        .filter(AgentKnowledgeSource.agent_id == db_item.id, KnowledgeSource.approved == True)
+    )
 
-        db_item.workspace = workspace_endpoint
+    # cached spend for budget admission, the Consumption API is never called per chat
+    snapshot = db.query(CostSnapshot.amount, CostSnapshot.refreshed_at).filter(CostSnapshot.agent_id == db_item.id).first()
 
-        openai_resource_name = f'agent{db_item.id}openai'
+    return ChatTarget(
+        db_item.id, openai_endpoint, openai_api_key, deployment_name, bool(db_item.response_cache_enabled), knowledge_ids,
+        db_item.rate_limit_rpm, db_item.rate_limit_tpm, db_item.budget,
+        snapshot.amount if snapshot else None, snapshot.refreshed_at if snapshot else None
+    )
 
-        openai_params = Account(
-            location=location,
-            kind='OpenAI',
-            sku=Sku(name='S0'),
-            properties={}
+def grounded_system_prompt(passages):
+    if not passages:
+        return SYSTEM_PROMPT
+    excerpts = "\n\n".join(f"[{number}] {passage['passage']}" for number, passage in enumerate(passages, 1))
+    return f"{SYSTEM_PROMPT}\n\nUse these excerpts from the approved knowledge sources when they are relevant to the question:\n\n{excerpts}"
+
+def passage_sources(passages):
+    return [{"knowledge_source_id": passage['knowledge_source_id'], "score": passage['score']} for passage in passages]
+
+def sse_event(data, event=None):
+    message = f"data: {json.dumps(data)}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
+def turn_lock(session):
+    # turns of one session run one at a time, stateless chats need no lock
+    return session.lock if session is not None else nullcontext()
+
+def chat_messages(system_prompt, user_input, session):
+    if session is None:
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input},
+        ]
+    # recent history and the summary of older turns, within the session token budget
+    return session.messages(system_prompt, user_input, session_store.context_budget)
+
+def completion_options(admission):
+    return {"max_tokens": CHAT_DEGRADED_MAX_TOKENS} if admission.degraded else {}
+
+async def admit_chat(target, system_prompt, user_input, session, degraded):
+    # tokens are reserved for the prompt and a typical reply, then settled with the real usage
+    reserved = estimate_tokens(system_prompt) + estimate_tokens(user_input)
+    if session is not None:
+        reserved += min(session.history_tokens() + estimate_tokens(session.summary or ''), session_store.context_budget)
+    reserved += CHAT_DEGRADED_MAX_TOKENS if degraded else rate_limiter.completion_tokens
+
+    limiter = rate_limiter.limiter(target.agent_id, target.rate_limit_rpm, target.rate_limit_tpm)
+    await limiter.acquire(reserved)
+    return Admission(limiter, reserved, degraded)
+
+def charge_tokens(target, admission, prompt_tokens, completion_tokens):
+    admission.limiter.settle(admission.reserved_tokens, prompt_tokens + completion_tokens)
+    rate_limiter.record_spend(target.agent_id, prompt_tokens, completion_tokens)
+
+async def finish_turn(target, session, admission, messages, user_input, assistant_reply, usage, complete=True):
+    # streamed replies carry no usage, so their tokens are estimated
+    prompt_tokens = usage.prompt_tokens if usage else sum(estimate_tokens(message["content"]) for message in messages)
+    completion_tokens = usage.completion_tokens if usage else estimate_tokens(assistant_reply)
+    charge_tokens(target, admission, prompt_tokens, completion_tokens)
+
+    # a reply cut short by a disconnect is kept in the session, as the user saw it, but never cached
+    if session is not None:
+        session_store.record(session, user_input, assistant_reply, prompt_tokens, completion_tokens)
+    elif target.response_cache_enabled and complete:
+        await asyncio.to_thread(
+            response_cache.store, target.agent_id, target.deployment_name, messages[0]["content"], user_input, assistant_reply,
+            prompt_tokens, completion_tokens
         )
 
-        openai_resource = cognitive_client.accounts.begin_create(
-            resource_group_name=rg_name,
-            account_name=openai_resource_name,
-            account=openai_params
-        ).result()
+async def summarize_turns(client, target, previous_summary, messages):
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if previous_summary:
+        transcript = f"Earlier summary: {previous_summary}\n\n{transcript}"
 
-        # Retrieve the endpoint from the properties of the OpenAI resource
-        openai_endpoint = openai_resource.properties.endpoint
+    response = await client.chat.completions.create(
+        model=target.deployment_name,
+        messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}]
+    )
+    usage = response.usage
+    prompt_tokens = usage.prompt_tokens if usage else estimate_tokens(transcript)
+    completion_tokens = usage.completion_tokens if usage else estimate_tokens(response.choices[0].message.content)
+
+    # summaries use the same deployment, so they count against its limits and the budget
+    rate_limiter.limiter(target.agent_id, target.rate_limit_rpm, target.rate_limit_tpm).settle(0, prompt_tokens + completion_tokens)
+    rate_limiter.record_spend(target.agent_id, prompt_tokens, completion_tokens)
+    return response.choices[0].message.content, prompt_tokens, completion_tokens
+
+async def compact_session(client, target, session):
+    # older turns are folded into the summary once the stored history outgrows its budget
+    if session_store.needs_compaction(session):
+        await session_store.compact(session, lambda summary, messages: summarize_turns(client, target, summary, messages))
+
+async def stream_chat_completion(client, target, admission, system_prompt, user_input, passages, session=None):
+    start = time.perf_counter()
+    time_to_first_token = None
+    reply = []
+
+    async with turn_lock(session):
+        messages = chat_messages(system_prompt, user_input, session)
+        failed = False
+        complete = False
+        try:
+            stream = await client.chat.completions.create(
+                model=target.deployment_name, messages=messages, stream=True, **completion_options(admission)
+            )
+            async for chunk in stream:
+                # Azure sends content filter results as chunks without choices
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if time_to_first_token is None:
+                    time_to_first_token = (time.perf_counter() - start) * 1000
+                reply.append(chunk.choices[0].delta.content)
+                yield sse_event({"delta": chunk.choices[0].delta.content})
+            complete = True
+
+        except Exception as e:
+            # the status code is already sent, so errors are reported as an event
+            print(f"Error during chat completion: {str(e)}")
+            failed = True
+            charge_tokens(target, admission, 0, 0)
+            yield sse_event({"detail": f"Failed to generate chat completion: {str(e)}"}, event="error")
+            return
+
+        finally:
+            # a client that disconnects mid-stream closes the generator at a yield,
+            # the tokens already streamed are still charged and the turn recorded
+            if not failed:
+                assistant_reply = "".join(reply)
+                await finish_turn(target, session, admission, messages, user_input, assistant_reply, None, complete)
+
+    done = {
+        "assistant_reply": assistant_reply,
+        "sources": passage_sources(passages),
+        "time_to_first_token_ms": time_to_first_token,
+        "total_ms": (time.perf_counter() - start) * 1000
+    }
+    if admission.degraded:
+        done["degraded"] = True
+    if session is not None:
+        done["session_id"] = session.id
+    yield sse_event(done, event="done")
+
+    if session is not None:
+        await compact_session(client, target, session)
+
+async def stream_cached_reply(assistant_reply):
+    yield sse_event({"delta": assistant_reply})
+    yield sse_event({"assistant_reply": assistant_reply, "cached": True}, event="done")
+
+@app.post("/chat_completion")
+async def chat_completion(request: ChatRequest, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_async_db)):
+    bind_agent(request.agent_id)
+    # the ORM lookup runs on the async driver, off the event loop
+    target = await db.run_sync(get_chat_agent, request.agent_id)
+
+    session = None
+    if request.session_id:
+        session = await asyncio.to_thread(session_store.get, request.session_id)
+        if session is None or session.agent_id != target.agent_id:
+            raise HTTPException(status_code=404, detail="Chat session not found.")
+
+    # Over its budget an agent is refused new completions, or answered ungrounded and
+    # shortened; replies from the response cache cost nothing and are still served
+    over_budget = rate_limiter.over_budget != 'allow' and await asyncio.to_thread(
+        rate_limiter.over, target.agent_id, target.budget, target.spend, target.spend_refreshed_at
+    )
 
-        # Store the OpenAI endpoint and API key in the database
-        db_item.openai_endpoint = openai_endpoint
+    # ground the reply in the best passages of the agent's approved knowledge sources
+    passages = []
+    if target.knowledge_ids and not over_budget:
+        passages = await asyncio.to_thread(retrieval_index.search, target.knowledge_ids, request.user_input, RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET)
+    system_prompt = grounded_system_prompt(passages)
+
+    # replies within a session depend on its history, so only stateless chats use the cache
+    if target.response_cache_enabled and session is None:
+        # the prompt holds the passages, so replies are cached per retrieved context
+        cached_reply = await asyncio.to_thread(response_cache.lookup, target.agent_id, target.deployment_name, system_prompt, request.user_input)
+        if cached_reply is not None:
+            if request.stream:
+                return StreamingResponse(stream_cached_reply(cached_reply), media_type="text/event-stream")
+            return {"assistant_reply": cached_reply, "cached": True}
+
+    if over_budget and rate_limiter.over_budget == 'reject':
+        raise HTTPException(status_code=402, detail="The agent has reached its budget.")
+
+    # waits in the agent's queue for its requests and tokens per minute, or 429 when it is full
+    try:
+        admission = await admit_chat(target, system_prompt, request.user_input, session, over_budget)
+    except RateLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
-        # Retrieve the API key for the OpenAI resource
-        keys = cognitive_client.accounts.list_keys(rg_name, openai_resource_name)
-        openai_api_key = keys.key1
-        db_item.openai_api_key = openai_api_key
+    # Reuse the agent's AsyncAzureOpenAI client (rebuilt if the endpoint or key changed)
+    client = openai_clients.get(target.agent_id, target.openai_endpoint, target.openai_api_key)
 
-        # Deploy the OpenAI model
-        openai_resource_name = f'agent{db_item.id}openai'
-        deployment_name = f"gpt-3-deployment-agent{db_item.id}"
-        model_name = "gpt-35-turbo"  # Replace with the correct model name
-        model_version = "0125"
+    if request.stream:
+        # Server-sent events: one 'data' event per token, then a final 'done' event
+        return StreamingResponse(
+            stream_chat_completion(client, target, admission, system_prompt, request.user_input, passages, session),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
 
+    async with turn_lock(session):
+        messages = chat_messages(system_prompt, request.user_input, session)
         try:
-            deployment_result = deploy_openai_model(
-                cognitive_client=cognitive_client,
-                resource_group_name=rg_name,
-                openai_resource_name=openai_resource_name,
-                deployment_name=deployment_name,
-                model_name=model_name,
-                model_version=model_version
+            # Create chat completion request using Azure OpenAI
+            response = await client.chat.completions.create(
+                model=target.deployment_name,  # Use the deployment name from the database
+                messages=messages,
+                **completion_options(admission)
             )
 
-            # Store the deployment details in the database
-            db_item.deployment_name = deployment_name
-            db_item.deployment_status = "Deployed"
-            db.commit()
+            # Extract and return the assistant's reply
+            assistant_reply = response.choices[0].message.content
 
-            return {
-                "message": f"Provisioned resource group {rg_result.name} and deployed OpenAI model {deployment_name}."
-            }
+        except Exception as e:
+            # Log the error for debugging
+            print(f"Error during chat completion: {str(e)}")
+            charge_tokens(target, admission, 0, 0)
+            raise HTTPException(status_code=500, detail=f"Failed to generate chat completion: {str(e)}")
+
+        await finish_turn(target, session, admission, messages, request.user_input, assistant_reply, response.usage)
+
+    result = {"assistant_reply": assistant_reply, "sources": passage_sources(passages)}
+    if admission.degraded:
+        result["degraded"] = True
+    if session is not None:
+        result["session_id"] = session.id
+        background_tasks.add_task(compact_session, client, target, session)
+    return result
+
+@app.post('/agent/{agent_id}/chat_sessions', status_code=201)
+def create_chat_session(agent_id: int, db: Session = Depends(get_db)):
+    db_item = db.query(Agent.id, Agent.status).filter(Agent.id == agent_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Agent not found.")
+    ensure_not_deleting(db_item)
+
+    session = session_store.create(agent_id)
+    return {"message": "Chat session created.", "session_id": session.id}
+
+@app.get('/chat_sessions/{session_id}')
+def get_chat_session(session_id: str):
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Chat session not found.")
+    return {"message": "Success", **session.serialize()}
+
+@app.delete('/chat_sessions/{session_id}')
+def delete_chat_session(session_id: str):
+    session_store.delete(session_id)
+    return {"message": f"Chat session {session_id} has been deleted."}
+
+@app.get('/agent/{agent_id}/chat_usage')
+def get_chat_usage(agent_id: int, db: Session = Depends(get_db)):
+    return {"message": "Success", "agent_id": agent_id, **session_store.usage(db, agent_id)}
+
+# Offline evaluation batches, prompts and results are kept on disk per job
+CHAT_BATCH_DIR = os.getenv("CHAT_BATCH_DIR", "chat_batches")
+# progress of the batches running in this process, by job id
+chat_batch_stats = {}
+
+def chat_batch_path(job_id, name):
+    return os.path.join(CHAT_BATCH_DIR, str(job_id), name)
+
+async def complete_batch_prompt(client, target, user_input):
+    passages = []
+    over_budget = rate_limiter.over_budget != 'allow' and await asyncio.to_thread(
+        rate_limiter.over, target.agent_id, target.budget, target.spend, target.spend_refreshed_at
+    )
+    if over_budget and rate_limiter.over_budget == 'reject':
+        raise ValueError("The agent has reached its budget.")
+    if target.knowledge_ids and not over_budget:
+        passages = await asyncio.to_thread(retrieval_index.search, target.knowledge_ids, user_input, RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET)
+    system_prompt = grounded_system_prompt(passages)
 
-        except HTTPException as e:
-            db_item.deployment_status = "Failed"
-            db.commit()
-            raise e
+    # batches share the agent's limits with interactive chats
+    try:
+        admission = await admit_chat(target, system_prompt, user_input, None, over_budget)
+    except RateLimitExceeded as e:
+        raise throttled_from(e)
 
-class ChatRequest(BaseModel):
-    agent_id: int
-    user_input: str
+    try:
+        response = await client.chat.completions.create(
+            model=target.deployment_name, messages=chat_messages(system_prompt, user_input, None), **completion_options(admission)
+        )
+    except Exception as e:
+        charge_tokens(target, admission, 0, 0)
+        raise throttled_from(e) or e
+
+    assistant_reply = response.choices[0].message.content
+    usage = response.usage
+    prompt_tokens = usage.prompt_tokens if usage else estimate_tokens(system_prompt) + estimate_tokens(user_input)
+    completion_tokens = usage.completion_tokens if usage else estimate_tokens(assistant_reply)
+    charge_tokens(target, admission, prompt_tokens, completion_tokens)
+    return assistant_reply, prompt_tokens, completion_tokens
+
+def run_chat_batch(ctx):
+    target = get_chat_agent(ctx.db, ctx.job.agent_id)
+    with open(chat_batch_path(ctx.job.id, PROMPTS_FILE), encoding='utf-8') as prompts_file:
+        prompts = parse_prompts(prompts_file)
+
+    # the batch does its own 429 backoff, so the client's retries are switched off
+    client = openai_clients.get(target.agent_id, target.openai_endpoint, target.openai_api_key).with_options(max_retries=0)
+    stats = chat_batch_stats[ctx.job.id] = BatchStats(len(prompts))
+    try:
+        batch = run_batch(
+            prompts,
+            lambda user_input: complete_batch_prompt(client, target, user_input),
+            chat_batch_path(ctx.job.id, RESULTS_FILE),
+            stats,
+            concurrency=ctx.payload.get('concurrency', CHAT_BATCH_CONCURRENCY)
+        )
+        # the prompts are sent from the application's event loop, this thread only waits
+        return asyncio.run_coroutine_threadsafe(batch, app.state.loop).result()
+    finally:
+        chat_batch_stats.pop(ctx.job.id, None)
+
+batch_runner.register('chat_batch', [Step('run_batch', run_chat_batch)])
+
+@app.post('/agent/{agent_id}/chat_batch', status_code=202)
+async def create_chat_batch(
+    agent_id: int,
+    file: UploadFile = File(...),
+    concurrency: int = Query(CHAT_BATCH_CONCURRENCY, ge=1, le=64),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # fails early when the agent has no deployment to chat with
+    await db.run_sync(get_chat_agent, agent_id)
 
-@app.post("/chat_completion")
-async def chat_completion(request: ChatRequest, db: Session = Depends(get_db)):
-    # Retrieve the agent from the database
-    db_item = db.query(Agent).filter(Agent.id == request.agent_id).first()
+    try:
+        prompts = parse_prompts((await file.read()).decode('utf-8').splitlines())
+    except (UnicodeDecodeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid prompts file: {e}")
+
+    job = await db.run_sync(batch_runner.create_job, 'chat_batch', agent_id=agent_id, payload={'concurrency': concurrency, 'prompts': len(prompts)})
+    job_id = job.id
+
+    def write_prompts():
+        os.makedirs(os.path.dirname(chat_batch_path(job_id, PROMPTS_FILE)), exist_ok=True)
+        with open(chat_batch_path(job_id, PROMPTS_FILE), 'w', encoding='utf-8') as prompts_file:
+            prompts_file.writelines(json.dumps(prompt) + '\n' for prompt in prompts)
+
+    await asyncio.to_thread(write_prompts)
+    batch_runner.submit(job_id)
+    return {
+        "message": f"Chat batch of {len(prompts)} prompts has started.",
+        "job_id": job_id,
+        "prompts": len(prompts),
+        "results": f"/chat_batches/{job_id}/results"
+    }
+
+@app.get('/chat_batches/{job_id}')
+def get_chat_batch(job_id: int, db: Session = Depends(get_db)):
+    job = db.get(Job, job_id)
+    if not job or job.kind != 'chat_batch':
+        raise HTTPException(status_code=404, detail="Chat batch not found.")
+
+    # live progress while the batch runs here, the stored summary once it finished
+    stats = chat_batch_stats.get(job_id)
+    if stats is not None:
+        summary = stats.summary()
+    else:
+        step = job.steps[0] if job.steps else None
+        summary = json.loads(step.result) if step is not None and step.result else None
+
+    return {
+        "message": "Success",
+        "job_id": job_id,
+        "agent_id": job.agent_id,
+        "status": job.status,
+        "error": job.error,
+        "stats": summary,
+        "results": f"/chat_batches/{job_id}/results"
+    }
+
+@app.get('/chat_batches/{job_id}/results')
+def get_chat_batch_results(job_id: int):
+    # results are appended as prompts finish, so a running batch returns what is done so far
+    path = chat_batch_path(job_id, RESULTS_FILE)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No results for this chat batch yet.")
+    return FileResponse(path, media_type='application/x-ndjson', filename=f"chat_batch_{job_id}_results.jsonl")
+
+class RateLimitSettings(BaseModel):
+    # null restores the limits of the deployment capacity
+    requests_per_minute: int | None = Field(default=None, ge=1)
+    tokens_per_minute: int | None = Field(default=None, ge=1)
+
+@app.put('/agent/{agent_id}/rate_limit')
+def set_rate_limit(agent_id: int, settings: RateLimitSettings, db: Session = Depends(get_db)):
+    db_item = db.query(Agent).filter(Agent.id == agent_id).first()
     if not db_item:
         raise HTTPException(status_code=404, detail="Agent not found.")
-    
-    # Retrieve the stored OpenAI endpoint, API key, and deployment name from the database
-    openai_endpoint = db_item.openai_endpoint
-    openai_api_key = db_item.openai_api_key
-    deployment_name = f"gpt-3-deployment-agent{db_item.id}" #db_item.deployment_name  # Retrieve the deployment name
-    if not openai_endpoint or not openai_api_key or not deployment_name:
-        raise HTTPException(status_code=500, detail="OpenAI credentials or deployment not available.")
 
-    # Set up AzureOpenAI client with the retrieved credentials
-    client = AzureOpenAI(
-        azure_endpoint=openai_endpoint,
-        api_key=openai_api_key,
-        api_version="2024-02-15-preview"  # Use the correct API version
-    )
+    db_item.rate_limit_rpm = settings.requests_per_minute
+    db_item.rate_limit_tpm = settings.tokens_per_minute
+    db.commit()
 
-    try:
-        # Create chat completion request using Azure OpenAI
-        response = client.chat.completions.create(
-            model=deployment_name,  # Use the deployment name from the database
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": request.user_input},
-            ],
-        )
+    # the limiter is rebuilt with the new limits on the agent's next chat
+    return {
+        "message": "Success",
+        'requests_per_minute': db_item.rate_limit_rpm or rate_limiter.rpm,
+        'tokens_per_minute': db_item.rate_limit_tpm or rate_limiter.tpm
+    }
 
-        # Extract and return the assistant's reply
-        assistant_reply = response.choices[0].message.content
-        return {"assistant_reply": assistant_reply}
+@app.get('/agent/{agent_id}/rate_limit')
+def get_rate_limit(agent_id: int, db: Session = Depends(get_db)):
+    db_item = db.query(Agent).filter(Agent.id == agent_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Agent not found.")
 
-    except Exception as e:
-        # Log the error for debugging
-        print(f"Error during chat completion: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to generate chat completion: {str(e)}")
+    snapshot = db.query(CostSnapshot).filter(CostSnapshot.agent_id == agent_id).first()
+    amount, refreshed_at = (snapshot.amount, snapshot.refreshed_at) if snapshot else (None, None)
+    return {
+        "message": "Success",
+        **rate_limiter.stats(agent_id),
+        'requests_per_minute': db_item.rate_limit_rpm or rate_limiter.rpm,
+        'tokens_per_minute': db_item.rate_limit_tpm or rate_limiter.tpm,
+        'budget': db_item.budget,
+        'cached_spend': round(rate_limiter.spend(agent_id, amount, refreshed_at), 6),
+        'over_budget': rate_limiter.over(agent_id, db_item.budget, amount, refreshed_at),
+        'over_budget_policy': rate_limiter.over_budget
+    }
+
+@app.get('/rate_limits')
+def get_rate_limits():
+    # limiters of the agents that chatted since the process started
+    return {"message": "Success", **rate_limiter.stats()}
+
+class ResponseCacheSettings(BaseModel):
+    enabled: bool
+
+@app.put('/agent/{agent_id}/response_cache')
+def set_response_cache(agent_id: int, settings: ResponseCacheSettings, db: Session = Depends(get_db)):
+    db_item = db.query(Agent).filter(Agent.id == agent_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Agent not found.")
 
-@app.get('/get_agents')
-def get_agents(db: Session = Depends(get_db)):
-    db_item = db.query(Agent).all()
-    if db_item is None:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return db_item
+    db_item.response_cache_enabled = settings.enabled
+    db.commit()
+
+    # replies cached before the cache was switched off must not be served later
+    if not settings.enabled:
+        response_cache.invalidate_agent(agent_id)
+
+    return {"message": "Success", "enabled": settings.enabled}
+
+@app.get('/agent/{agent_id}/response_cache')
+def get_response_cache(agent_id: int, db: Session = Depends(get_db)):
+    db_item = db.query(Agent).filter(Agent.id == agent_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Agent not found.")
+
+    return {"enabled": bool(db_item.response_cache_enabled), **response_cache.stats(agent_id)}
+
+# Columns /get_agents may return, the API key is never listed
+AGENT_LIST_FIELDS = [column.key for column in Agent.__table__.columns if column.key != 'openai_api_key']
+AGENT_SORT_KEYS = {'id': Agent.id, 'name': Agent.name}
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
 
-@app.delete('/delete_agent')
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != 2:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return values
+
+@app.get('/get_agents')
+def get_agents(
+    request: Request,
+    fields: str | None = None,
+    status: str | None = None,
+    owner: str | None = None,
+    active: bool | None = None,
+    name: str | None = None,
+    sort: str = 'id',
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db)
+):
+    # projection: only the requested columns are selected and serialised
+    selected = fields.split(',') if fields else AGENT_LIST_FIELDS
+    unknown = [field for field in selected if field not in AGENT_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}.")
+
+    descending = sort.startswith('-')
+    sort_key = sort.lstrip('-')
+    if sort_key not in AGENT_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(AGENT_SORT_KEYS)}, optionally prefixed with '-'.")
+    sort_column = AGENT_SORT_KEYS[sort_key]
+
+    columns = list(dict.fromkeys(['id', sort_key] + selected))
+    query = db.query(*[getattr(Agent, column) for column in columns])
+
+    if status is not None:
+        query = query.filter(Agent.status == status)
+    if owner is not None:
+        query = query.filter(Agent.owner == owner)
+    if active is not None:
+        query = query.filter(Agent.active == active)
+    if name:
+        # a prefix match can use the index on name, % and _ in the name are matched literally
+        query = query.filter(Agent.name.startswith(name, autoescape=True))
+
+    # keyset pagination on (sort column, id), so deep pages cost the same as the first
+    position = tuple_(sort_column, Agent.id)
+    if cursor:
+        last = tuple(decode_cursor(cursor))
+        query = query.filter(position < last if descending else position > last)
+    if descending:
+        query = query.order_by(sort_column.desc(), Agent.id.desc())
+    else:
+        query = query.order_by(sort_column, Agent.id)
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = encode_cursor([getattr(rows[limit - 1], sort_key), rows[limit - 1].id]) if len(rows) > limit else None
+    body = json.dumps([{field: getattr(row, field) for field in selected} for row in rows[:limit]], separators=(',', ':')).encode()
+
+    # pollers that already hold this page get a 304 without a body
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if next_cursor:
+        headers['X-Next-Cursor'] = next_cursor
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type='application/json', headers=headers)
+
+# Most agents a single DELETE /agents request can delete
+AGENT_BULK_DELETE_MAX = int(os.getenv("AGENT_BULK_DELETE_MAX", "100"))
+
+def release_knowledge(ctx):
+    # releasing the agent's knowledge sources before its storage account goes with the resource group
+    agent = ctx.agent
+    if agent is None:
+        return {"released_knowledge_source_ids": [], "orphaned_blobs": []}
+    released, orphaned_blobs = release_agent_knowledge(ctx.db, agent, storage_resolver)
+    return {"released_knowledge_source_ids": released, "orphaned_blobs": orphaned_blobs}
+
+def delete_orphaned_blobs(ctx):
+    # runs once the release is committed, a blob is never deleted while a row still points to it
+    orphaned_blobs = ctx.results['release_knowledge']['orphaned_blobs']
+    for blob in orphaned_blobs:
+        delete_content_blob(blob["storage_resource_group"], blob["source"], storage_resolver)
+    return {"deleted_blobs": len(orphaned_blobs)}
+
+def delete_agent_records(ctx):
+    # runs once Azure has confirmed the resource group is gone, every table is cleared with one statement
+    agent_id = ctx.job.agent_id
+    rg_name = ctx.payload["resource_group"]
+
+    ctx.db.query(CostSnapshot).filter(CostSnapshot.agent_id == agent_id).delete(synchronize_session=False)
+    ctx.db.query(AgentReconciliation).filter(AgentReconciliation.agent_id == agent_id).delete(synchronize_session=False)
+    session_store.delete_agent(ctx.db, agent_id)
+    deleted = ctx.db.query(Agent).filter(Agent.id == agent_id).delete(synchronize_session=False)
+
+    openai_clients.invalidate(agent_id)
+    response_cache.invalidate_agent(agent_id)
+    rate_limiter.forget(agent_id)
+    storage_resolver.invalidate(rg_name)
+    spend_history.delete_agent(agent_id)
+
+    for knowledge_source_id in ctx.results['release_knowledge']['released_knowledge_source_ids']:
+        retrieval_index.remove(knowledge_source_id)
+
+    return {"agent_deleted": bool(deleted)}
+
+teardown_runner.register('delete_agent', [
+    # retried when its row locks time out behind another agent's release
+    Step('release_knowledge', release_knowledge, retries=3),
+    Step('delete_orphaned_blobs', delete_orphaned_blobs, depends_on=['release_knowledge']),
+    # polls the long-running delete, retried on failure
+    Step('delete_resource_group', delete_resource_group, depends_on=['release_knowledge'], timeout=3600, retries=3, backoff=30),
+    Step('delete_records', delete_agent_records, depends_on=['release_knowledge', 'delete_resource_group'], retries=3)
+])
+
+def start_agent_deletions(db, agents):
+    """
+    Marks each agent as Deleting and starts its deletion job. An agent that is already
+    being deleted keeps its job, which is resubmitted if it failed. Agents whose
+    provisioning job has not finished are refused.
+    Returns the deletion jobs and the refusals, both by agent id.
+    """
+    agent_ids = [agent.id for agent in agents]
+    provisioning = {
+        row.agent_id for row in db.query(Job.agent_id)
+        .filter(Job.agent_id.in_(agent_ids), Job.kind == 'new_agent', Job.status.in_(UNFINISHED))
+    }
+    # the latest deletion job of each agent
+    deletions = {job.agent_id: job for job in db.query(Job).filter(Job.agent_id.in_(agent_ids), Job.kind == 'delete_agent').order_by(Job.id)}
+
+    jobs, refused = {}, {}
+    for agent in agents:
+        job = deletions.get(agent.id)
+        if agent.status == AGENT_DELETING and job is not None:
+            if job.status == 'Failed':
+                teardown_runner.retry(db, job)
+        elif agent.id in provisioning:
+            refused[agent.id] = f"Agent {agent.id} is still being provisioned."
+            continue
+        else:
+            agent.status = AGENT_DELETING
+            agent.active = False
+            # the new status is committed together with the job
+            job = teardown_runner.create_job(db, 'delete_agent', agent_id=agent.id, payload={"resource_group": agent.name})
+            teardown_runner.submit(job.id)
+        jobs[agent.id] = job
+    return jobs, refused
+
+@app.delete('/delete_agent', status_code=202)
 def delete_agent(id: int, db: Session = Depends(get_db)):
+    bind_agent(id)
     db_item = db.query(Agent).filter(Agent.id == id).first()
-    if (db_item):
-        rg_name = db_item.name
-
-        # deleting resource group
-        try:
-            # Delete resource group
-            resource_client.resource_groups.begin_delete(rg_name)
-        except Exception as e:
-            print(f"Warning: Failed to delete resource group {rg_name}. Error: {e}")
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Agent not found.")
 
-        # deleting corresponding records
-        agent_knowledge_source_item = db.query(AgentKnowledgeSource).filter(AgentKnowledgeSource.agent_id == id).all()
-        for item in agent_knowledge_source_item:
-            knowledge_source = db.query(KnowledgeSource).filter(KnowledgeSource.id == item.knowledge_id).first()
-            if (knowledge_source):
-                db.delete(knowledge_source)
+    # the resource group and the records are deleted in the background
+    jobs, refused = start_agent_deletions(db, [db_item])
+    if refused:
+        raise HTTPException(status_code=409, detail=refused[id])
 
-            db.delete(item)
+    return {
+        "message": f"Deletion of agent {id} has started.",
+        "agent_id": id,
+        "job_id": jobs[id].id
+    }
 
-        # deleting the record
-        db.delete(db_item)
-        db.commit()
+@app.delete('/agents', status_code=202)
+def delete_agents(ids: list[int] = Query(...), db: Session = Depends(get_db)):
+    """
+    Deletes many agents at once, e.g. when decommissioning a team. Every agent gets its
+    own deletion job and the jobs run concurrently (TEARDOWN_WORKERS at a time).
+    """
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > AGENT_BULK_DELETE_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {AGENT_BULK_DELETE_MAX} agents can be deleted per request.")
 
-        return { "message": f"Record with ID {id} has been deleted."}
+    agents = db.query(Agent).filter(Agent.id.in_(ids)).all()
+    jobs, refused = start_agent_deletions(db, agents)
+    found = {agent.id for agent in agents}
 
-    return { "message": "Error - item not found."}
+    return {
+        "message": f"Deletion of {len(jobs)} of {len(ids)} agents has started.",
+        "jobs": [{"agent_id": agent_id, "job_id": job.id} for agent_id, job in jobs.items()],
+        "refused": [{"agent_id": agent_id, "detail": detail} for agent_id, detail in refused.items()],
+        "not_found": [agent_id for agent_id in ids if agent_id not in found]
+    }
 
 @app.get('/get_agent/{agent_id}')
 def get_agent(agent_id: int, db: Session = Depends(get_db)):
     db_item = db.query(Agent).filter(Agent.id == agent_id).first()
     if (db_item):
-        resource_group_name = db_item.name
-        scope = f"/subscriptions/{subscription_id}/resourceGroups/{resource_group_name}"
+        # spend comes from the snapshot table, Azure is only called when it is stale
+        # and was not just tried unsuccessfully
+        snapshot = db.query(CostSnapshot).filter(CostSnapshot.agent_id == agent_id).first()
+        if cost_refresher.needs_refresh(snapshot) and db_item.status != AGENT_DELETING:
+            snapshot = cost_refresher.refresh_agent(db, db_item)
 
-        budget = consumption_client.budgets.get(scope=scope, budget_name=f"{resource_group_name}-budget")
+        current_spend = {'amount': snapshot.amount or 0, 'unit': snapshot.unit} if snapshot else {'amount': 0, 'unit': None}
 
-        # Access the current spend amount
-        current_spend = budget.current_spend
-        if current_spend:
-            amount = current_spend.amount
-            unit = current_spend.unit
-        else:
-            current_spend = {'amount': 0}
+        # tokens used by chat sessions, not yet visible in the billed spend
+        chat_usage = session_store.usage(db, agent_id)
         
-        return { 'message': 'Success', 'agent': db_item, 'budget': db_item.budget, 'current_spend': current_spend}
+        return { 'message': 'Success', 'agent': db_item, 'budget': db_item.budget, 'current_spend': current_spend, 'chat_usage': chat_usage}
     
     return HTTPException(404, { 'message': 'Error - agent was not found.' })
 
+@app.get('/metrics')
+def get_metrics():
+    # Prometheus text exposition format
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get('/db/pool')
+def get_db_pool():
+    # checkout waits of the synchronous and async connection pools
+    return {"message": "Success", **pool_stats()}
+
+@app.get('/costs')
+def get_costs(db: Session = Depends(get_db)):
+    rows = db.query(Agent.id, Agent.name, Agent.display_name, Agent.budget, CostSnapshot).outerjoin(CostSnapshot, CostSnapshot.agent_id == Agent.id).all()
+    now = datetime.now(timezone.utc)
+
+    costs = [
+        {'agent_id': agent_id, 'name': name, 'display_name': display_name, 'budget': budget, **serialize_snapshot(snapshot, cost_refresher, now)}
+        for agent_id, name, display_name, budget, snapshot in rows
+    ]
+    return {
+        'message': 'Success',
+        'last_refresh': cost_refresher.last_refresh,
+        'stale_after_seconds': cost_refresher.stale_after,
+        'costs': costs
+    }
+
+@app.post('/costs/{agent_id}/refresh')
+def refresh_cost(agent_id: int, db: Session = Depends(get_db)):
+    db_item = db.query(Agent).filter(Agent.id == agent_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="Agent not found.")
+    ensure_not_deleting(db_item)
+
+    snapshot = cost_refresher.refresh_agent(db, db_item)
+    return {'message': 'Success', 'agent_id': agent_id, 'budget': db_item.budget, **serialize_snapshot(snapshot, cost_refresher)}
+
+@app.get('/reconciliation/drift')
+def get_drift(
+    after: int | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db)
+):
+    # agents whose last reconciliation found drift, paged by agent id
+    query = db.query(Agent.id, Agent.name, Agent.display_name, Agent.status, AgentReconciliation).join(
+        AgentReconciliation, AgentReconciliation.agent_id == Agent.id
+    ).filter(AgentReconciliation.drifted == True)
+    if after is not None:
+        query = query.filter(Agent.id > after)
+    rows = query.order_by(Agent.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        'message': 'Success',
+        'last_run': reconciler.last_run,
+        'last_error': reconciler.last_error,
+        'orphaned_resource_groups': reconciler.orphaned_resource_groups,
+        'drift': [
+            {'agent_id': agent_id, 'name': name, 'display_name': display_name, 'status': status, **serialize_reconciliation(state)}
+            for agent_id, name, display_name, status, state in rows
+        ],
+        'next_after': rows[-1].id if has_more else None
+    }
+
+@app.post('/reconciliation/run', status_code=202)
+def run_reconciliation():
+    reconciler.trigger()
+    return {'message': 'Reconciliation has started.'}
+
+@app.get('/agent/{agent_id}/spend_history')
+def get_spend_history(
+    agent_id: int,
+    start: datetime | None = Query(None, alias="from"),
+    end: datetime | None = Query(None, alias="to"),
+    step: str | None = None,
+    db: Session = Depends(get_db)
+):
+    if not db.query(Agent.id).filter(Agent.id == agent_id).first():
+        raise HTTPException(status_code=404, detail="Agent not found.")
+    if step is not None and step not in STEPS:
+        raise HTTPException(status_code=422, detail=f"step must be one of {', '.join(STEPS)}.")
+
+    # the last 30 days unless a range is given, naive datetimes are taken as UTC
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=30)
+    start_ts = int((start if start.tzinfo else start.replace(tzinfo=timezone.utc)).timestamp())
+    end_ts = int((end if end.tzinfo else end.replace(tzinfo=timezone.utc)).timestamp())
+
+    step, points = spend_history.query(agent_id, start_ts, end_ts, step)
+    return {'message': 'Success', 'agent_id': agent_id, 'step': step, 'points': points}
+
+def load_knowledge_source(knowledge_source_id):
+    # content of an approved knowledge source, for the retrieval index
+    db = SessionLocal()
+    try:
+        knowledge_source = db.query(KnowledgeSource).filter(KnowledgeSource.id == knowledge_source_id).first()
+        if knowledge_source is None or not knowledge_source.approved:
+            return None
+
+        resource_group_name = knowledge_source.storage_resource_group
+        if resource_group_name is None:
+            # sources uploaded before deduplication live with their (only) agent
+            link = db.query(AgentKnowledgeSource).filter(AgentKnowledgeSource.knowledge_id == knowledge_source_id).first()
+            if link is None or link.agent is None:
+                return None
+            resource_group_name = link.agent.name
+        container_name, blob_name = blob_path(knowledge_source.source)
+        filename = knowledge_source.filename or blob_name
+    finally:
+        db.close()
+
+    def download(target):
+        blob_client, properties = open_blob(target, container_name, blob_name)
+        if properties.size > RETRIEVAL_MAX_SOURCE_BYTES:
+            raise ValueError(f"{filename} is larger than {RETRIEVAL_MAX_SOURCE_BYTES} bytes.")
+        return blob_client.download_blob().readall()
+
+    return storage_resolver.call(resource_group_name, download), filename
+
+def sync_retrieval_index():
+    db = SessionLocal()
+    try:
+        approved = {row.id for row in db.query(KnowledgeSource.id).filter(KnowledgeSource.approved == True)}
+    finally:
+        db.close()
+
+    indexed = retrieval_index.indexed_ids()
+    for knowledge_source_id in indexed - approved:
+        retrieval_index.remove(knowledge_source_id)
+    for knowledge_source_id in approved - indexed:
+        retrieval_index.schedule(knowledge_source_id, lambda knowledge_source_id=knowledge_source_id: load_knowledge_source(knowledge_source_id))
+
+def open_blob(target, container_name, blob_name):
+    blob_client = target.blob_client(container_name, blob_name)
+    return blob_client, blob_client.get_blob_properties()
+
 @app.get('/agent/{agent_id}/get_knowledge_source/{knowledge_source_id}')
-def get_knowledge_source(agent_id: int, knowledge_source_id: int, db: Session = Depends(get_db)):
+def get_knowledge_source(agent_id: int, knowledge_source_id: int, request: Request, db: Session = Depends(get_db)):
     # Retrieve the agent from the database
     current_agent = db.query(Agent).filter(Agent.id == agent_id).first()
     if not current_agent:
         raise HTTPException(status_code=404, detail="Agent not found.")
+    ensure_not_deleting(current_agent)
     
     # Retrieve the knowledge source from the database
     knowledge_source = db.query(KnowledgeSource).filter(KnowledgeSource.id == knowledge_source_id).first()
     if not knowledge_source:
         raise HTTPException(status_code=404, detail="Knowledge source not found.")
 
-    try:
-        # Get the blob URL from the knowledge source
-        blob_url = knowledge_source.source
-        
-        # Get storage account credentials
-        resource_group_name = current_agent.name
-        storage_accounts = storage_client.storage_accounts.list_by_resource_group(resource_group_name)
-        storage_account = next(storage_accounts, None)
-        
-        if not storage_account:
-            raise HTTPException(
-                status_code=404, 
-                detail=f"No storage accounts found in resource group '{resource_group_name}'."
-            )
-
-        # Get storage key
-        keys = storage_client.storage_accounts.list_keys(resource_group_name, storage_account.name)
-        storage_key = keys.keys[0].value
-
-        # Parse the blob URL to get container and blob names
-        parsed_url = urlparse(blob_url)
-        # Remove leading '/'
-        path_parts = parsed_url.path.lstrip('/').split('/')
-        container_name = path_parts[0]
-        blob_name = '/'.join(path_parts[1:])
-
-        # Create blob client directly from URL
-        blob_client = BlobClient.from_blob_url(
-            blob_url=blob_url,
-            credential=storage_key
-        )
+    # Parse the blob URL to get container and blob names
+    container_name, blob_name = blob_path(knowledge_source.source)
+    # Content-addressed blobs may be stored in another agent's resource group
+    resource_group_name = knowledge_source.storage_resource_group or current_agent.name
+    filename = knowledge_source.filename or blob_name
 
-        # Download the blob
-        download_stream = blob_client.download_blob()
-        file_content = download_stream.readall()
+    try:
+        # The storage account, key and blob client come from the per-resource-group cache
+        blob_client, properties = storage_resolver.call(resource_group_name, lambda target: open_blob(target, container_name, blob_name))
+        size = properties.size
+
+        # Serve a single byte range when asked for, unless If-Range names another version of the blob
+        byte_range = None
+        if_range = request.headers.get('if-range')
+        if if_range is None or if_range == properties.etag:
+            try:
+                byte_range = parse_range(request.headers.get('range'), size)
+            except RangeNotSatisfiable:
+                raise HTTPException(status_code=416, detail="Requested range not satisfiable.", headers={"Content-Range": f"bytes */{size}"})
 
         # Create response headers
         headers = {
-            "Content-Disposition": f"attachment; filename={blob_name}",
-            "Content-Type": "application/octet-stream"
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Accept-Ranges": "bytes",
+            "ETag": properties.etag
         }
+        if byte_range is None:
+            headers["Content-Length"] = str(size)
+        else:
+            headers["Content-Length"] = str(byte_range[1] - byte_range[0] + 1)
+            headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
 
-        # Return streaming response
+        # Return streaming response, passing chunks through as they are downloaded
         return StreamingResponse(
-            BytesIO(file_content), 
+            open_blob_stream(blob_client, properties, byte_range),
+            status_code=200 if byte_range is None else 206,
             media_type="application/octet-stream", 
             headers=headers
         )
 
+    except HTTPException:
+        raise
+    except StorageAccountNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ResourceNotFoundError:
+        raise HTTPException(status_code=404, detail="Knowledge source file not found in storage.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
 
 @app.post('/agent/{agent_id}/add_knowledge_source')
-async def add_knowledge_source(agent_id: int, knowledge_source_name: str = Form(...), file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def add_knowledge_source(agent_id: int, knowledge_source_name: str = Form(...), file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
     # Retrieve the agent from the database
-    current_agent = db.query(Agent).filter(Agent.id == agent_id).first()
+    current_agent = await db.get(Agent, agent_id)
     if not current_agent:
         raise HTTPException(status_code=404, detail="Agent not found")
+    ensure_not_deleting(current_agent)
 
-    # Define the resource group and storage account details
-    resource_group_name = current_agent.name
-    container_name = f'agent{current_agent.id}-blob'
-
-    storage_accounts = storage_client.storage_accounts.list_by_resource_group(resource_group_name)
-
-    # Get the first storage account
-    storage_account = next(storage_accounts, None)
-    if not storage_account:
-        raise HTTPException(status_code=404, detail=f"No storage accounts found in resource group '{resource_group_name}'.")
+    #await assign_storage_role(resource_group_name, container_name, user_object_id)
 
+    # Content already stored (for any agent) is only linked, new content is streamed into a blob named by its hash
     try:
-        # Attempt to retrieve the storage account properties
-        storage_account = storage_client.storage_accounts.get_properties(
-            resource_group_name, storage_account.name
-        )
-        print(f"Storage account '{storage_account.name}' exists.")
-    except:
-        print(f"Storage account '{storage_account.name}' does not exist.")
+        entry, = await ingest_knowledge(db, current_agent, [upload_file_item(file, UPLOAD_CHUNK_SIZE)], storage_resolver, 1, names=[knowledge_source_name])
+    except StorageAccountNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if entry.status == FAILED:
+        raise HTTPException(status_code=500, detail=f"Error uploading file: {entry.error}")
+    if entry.status == ALREADY_LINKED:
+        raise HTTPException(status_code=409, detail='Error uploading file - knowledge source already exists in the database.')
+
+    return {
+        "message": f"File '{file.filename}' uploaded successfully to container '{agent_container_name(agent_id)}'.",
+        **entry.result()
+    }
+
+@app.post('/agent/{agent_id}/add_knowledge_sources')
+async def add_knowledge_sources(
+    agent_id: int,
+    files: list[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    concurrency: int = Query(BULK_UPLOAD_CONCURRENCY, ge=1, le=64),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Uploads many knowledge sources at once, given as multipart files and/or one zip or
+    tar archive. Files are uploaded `concurrency` at a time and every knowledge source
+    is recorded in one transaction. Each file is named after its file name (or path in
+    the archive) and gets its own result, a failed file does not stop the others.
+    """
+    # Retrieve the agent from the database
+    current_agent = await db.get(Agent, agent_id)
+    if not current_agent:
+        raise HTTPException(status_code=404, detail="Agent not found")
+    ensure_not_deleting(current_agent)
 
-    # Initialize the BlobServiceClient
-    account_url = f'https://{storage_account.name}.blob.core.windows.net'
+    items = [upload_file_item(file, UPLOAD_CHUNK_SIZE) for file in files or []]
+    if archive is not None:
+        try:
+            items += await asyncio.to_thread(archive_items, archive.file, UPLOAD_CHUNK_SIZE)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if not items:
+        raise HTTPException(status_code=400, detail="No files were sent.")
+    if len(items) > BULK_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_FILES} files are accepted per request.")
 
-    keys = storage_client.storage_accounts.list_keys(resource_group_name, storage_account.name)
-    storage_key = keys.keys[0].value
+    try:
+        entries = await ingest_knowledge(db, current_agent, items, storage_resolver, concurrency)
+    except StorageAccountNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    stored = sum(entry.status != FAILED for entry in entries)
+    return {
+        "message": f"{stored} of {len(entries)} files uploaded successfully to container '{agent_container_name(agent_id)}'.",
+        "results": [entry.result() for entry in entries]
+    }
+
+@app.post('/agent/{agent_id}/storage/invalidate')
+def invalidate_agent_storage(agent_id: int, db: Session = Depends(get_db)):
+    # drops the cached storage account and key of the agent, e.g. after rotating its keys
+    current_agent = db.query(Agent).filter(Agent.id == agent_id).first()
+    if not current_agent:
+        raise HTTPException(status_code=404, detail="Agent not found")
 
-    blob_service_client = BlobServiceClient(account_url=account_url, credential=storage_key)
+    storage_resolver.invalidate(current_agent.name)
+    return {"message": f"Storage cache of agent {agent_id} invalidated.", "storage_cache": storage_resolver.stats()}
 
-    # Get the container client
-    container_client = blob_service_client.get_container_client(container_name)
+@app.get('/agent/{agent_id}/knowledge_sources')
+def get_knowledge_sources_agent(agent_id: int, db: Session = Depends(get_db)):
+    # returning all the knowledge sources in a single joined query
+    knowledge_sources = (
+        db.query(KnowledgeSource)
+        .join(AgentKnowledgeSource, AgentKnowledgeSource.knowledge_id == KnowledgeSource.id)
+        .filter(AgentKnowledgeSource.agent_id == agent_id)
+        .order_by(KnowledgeSource.id)
+        .all()
+    )
+    if (knowledge_sources):
+        return { "message": "Success", "knowledge_sources": knowledge_sources }
 
-    # Check if the container exists; if not, create it
-    if not container_client.exists():
-        container_client.create_container()
-        print(f"Container '{container_name}' created in storage account '{resource_group_name}'.")
+    return HTTPException(status_code=404, detail=f'Error - knowledge sources for agent {agent_id} not found.')
 
-    # Get the blob client
-    blob_client = container_client.get_blob_client(file.filename)
-    
-    file_content = await file.read()
+class KnowledgeSourceApproval(BaseModel):
+    approved: bool
 
-    #await assign_storage_role(resource_group_name, container_name, user_object_id)
+@app.put('/knowledge_source/{knowledge_source_id}/approval')
+def set_knowledge_source_approval(knowledge_source_id: int, approval: KnowledgeSourceApproval, db: Session = Depends(get_db)):
+    knowledge_source = db.query(KnowledgeSource).filter(KnowledgeSource.id == knowledge_source_id).first()
+    if not knowledge_source:
+        raise HTTPException(status_code=404, detail="Knowledge source not found.")
 
-    # Upload the file to the blob
-    try:
-        blob_client.upload_blob(file_content, overwrite=True, blob_type="BlockBlob")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
-    
-    # adding record to database for knowledge source
-    db_knowledge_source = KnowledgeSource(name=knowledge_source_name, source=blob_client.url, approved=False)
-    db.add(db_knowledge_source)
-    db.flush()
-
-    db_knowledge_check = db.query(AgentKnowledgeSource).filter(AgentKnowledgeSource.agent_id == agent_id, AgentKnowledgeSource.knowledge_id == db_knowledge_source.id).first()
-    if (db_knowledge_check is None):
-        db_agent_knowledge_link = AgentKnowledgeSource(agent_id=agent_id, knowledge_id = db_knowledge_source.id)
-        db.add(db_agent_knowledge_link)
-    else:
-        raise HTTPException(status_code=500, detail='Error uploading file - knowledge source already exists in the database.')
-    
+    knowledge_source.approved = approval.approved
     db.commit()
 
-    return {"message": f"File '{file.filename}' uploaded successfully to container '{container_name}'."}
-
-@app.get('/agent/{agent_id}/knowledge_sources')
-async def get_knowledge_sources_agent(agent_id: int, db: Session = Depends(get_db)):
-    db_item = db.query(AgentKnowledgeSource).filter(AgentKnowledgeSource.agent_id == agent_id).all()
-    if (db_item):
-        # returning all the knowledge sources
-        knowledge_sources = []
-
-        for item in db_item:
-            knowledge_source = db.query(KnowledgeSource).filter(KnowledgeSource.id == item.knowledge_id).first()
-            if (knowledge_source):
-                knowledge_sources.append(knowledge_source)
-
-        return { "message": "Success", "knowledge_sources": knowledge_sources }
+    # approved sources are indexed in the background, unapproved ones leave the index at once
+    if approval.approved:
+        retrieval_index.schedule(knowledge_source_id, lambda: load_knowledge_source(knowledge_source_id))
+    else:
+        retrieval_index.remove(knowledge_source_id)
+
+    return {"message": f"Knowledge source {knowledge_source_id} is {'approved' if approval.approved else 'no longer approved'}.", "approved": approval.approved}
+
+@app.get('/knowledge_sources')
+def list_knowledge_sources(
+    agent_id: int | None = None,
+    approved: bool | None = None,
+    name: str | None = None,
+    after: int | None = None,
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db)
+):
+    query = db.query(KnowledgeSource).options(
+        selectinload(KnowledgeSource.agent_associations)
+        .joinedload(AgentKnowledgeSource.agent)
+        .load_only(Agent.id, Agent.name, Agent.display_name)
+    )
 
-    return HTTPException(status_code=404, detail=f'Error - knowledge sources for agent {agent_id} not found.')
\ No newline at end of file
+    if agent_id is not None:
+        query = query.filter(KnowledgeSource.agent_associations.any(AgentKnowledgeSource.agent_id == agent_id))
+    if approved is not None:
+        query = query.filter(KnowledgeSource.approved == approved)
+    if name:
+        # % and _ in the name are matched literally
+        query = query.filter(KnowledgeSource.name.icontains(name, autoescape=True))
+
+    # keyset pagination: the next page starts after the last id of this one
+    if after is not None:
+        query = query.filter(KnowledgeSource.id > after)
+    knowledge_sources = query.order_by(KnowledgeSource.id).limit(limit + 1).all()
+    has_more = len(knowledge_sources) > limit
+    knowledge_sources = knowledge_sources[:limit]
+
+    return {
+        "message": "Success",
+        "knowledge_sources": [
+            {
+                "id": knowledge_source.id,
+                "name": knowledge_source.name,
+                "source": knowledge_source.source,
+                "approved": knowledge_source.approved,
+                "content_hash": knowledge_source.content_hash,
+                "size": knowledge_source.size,
+                "agents": [
+                    {"id": link.agent.id, "name": link.agent.name, "display_name": link.agent.display_name}
+                    for link in knowledge_source.agent_associations if link.agent is not None
+                ]
+            }
+            for knowledge_source in knowledge_sources
+        ],
+        "next_after": knowledge_sources[-1].id if has_more else None
+    }
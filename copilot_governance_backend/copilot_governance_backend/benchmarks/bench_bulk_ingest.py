@@ -0,0 +1,78 @@
+"""
+Bulk knowledge-source ingestion through POST /agent/{id}/add_knowledge_sources
+against fake Azure storage with per-call latency, reporting files per second
+at each concurrency setting.
+
+Run from the backend directory:
+    python -m benchmarks.bench_bulk_ingest --files 200 --latency 0.05
+"""
+import argparse
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+def build_archive(files, size):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for index in range(files):
+            archive.writestr(f"docs/document{index}.txt", os.urandom(size))
+    return buffer.getvalue()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Bytes per file")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every storage call takes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    # the backend reads its settings at import time
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["SPEND_HISTORY_DIR"] = os.path.join(workdir, "spend_history")
+    os.environ["COST_REFRESH_INTERVAL"] = "0"
+    os.environ["RECONCILE_INTERVAL"] = "0"
+    os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    os.environ.setdefault("AZURE_USER_OBJECT_ID", "00000000-0000-0000-0000-000000000000")
+
+    from fastapi.testclient import TestClient
+
+    import backend
+    from fake_azure import FakeAzureClients
+    from models import Agent
+
+    fake = FakeAzureClients(latency=args.latency)
+    fake.storage_accounts["agent-bench-rg"] = {"benchstore": "benchstore-key1"}
+    backend.storage_resolver.clients = fake
+
+    db = backend.SessionLocal()
+    agent = Agent(name="agent-bench-rg", display_name="bench", status="Active", active=True, budget=100)
+    db.add(agent)
+    db.commit()
+    agent_id = agent.id
+    db.close()
+
+    reports = []
+    with TestClient(backend.app) as client:
+        for concurrency in args.concurrency:
+            # fresh content every run, content already stored is only linked and never uploaded again
+            archive = build_archive(args.files, args.size)
+            start = time.perf_counter()
+            response = client.post(
+                f"/agent/{agent_id}/add_knowledge_sources?concurrency={concurrency}",
+                files=[("archive", ("documents.zip", archive))]
+            )
+            elapsed = time.perf_counter() - start
+            response.raise_for_status()
+            uploaded = sum(result['status'] == 'uploaded' for result in response.json()['results'])
+            reports.append({
+                'concurrency': concurrency,
+                'files': uploaded,
+                'wall_s': round(elapsed, 3),
+                'files_per_s': round(uploaded / elapsed, 1)
+            })
+
+    print(json.dumps(reports, indent=2))
@@ -0,0 +1,66 @@
+"""
+Chat batches through POST /agent/{id}/chat_batch against the local OpenAI stub,
+with model latency and injected 429s, reporting the batch stats at each concurrency.
+
+Run from the backend directory:
+    python -m benchmarks.bench_chat_batch --prompts 500 --latency 0.05 --throttle-every 20
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--prompts", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every completion takes")
+    parser.add_argument("--throttle-every", type=int, default=20, help="Answer every n-th request with 429")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    args = parser.parse_args()
+
+    # the backend reads its settings at import time
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["SPEND_HISTORY_DIR"] = os.path.join(workdir, "spend_history")
+    os.environ["RETRIEVAL_INDEX_DIR"] = os.path.join(workdir, "retrieval_index")
+    os.environ["CHAT_BATCH_DIR"] = os.path.join(workdir, "chat_batches")
+    os.environ["COST_REFRESH_INTERVAL"] = "0"
+    os.environ["RECONCILE_INTERVAL"] = "0"
+    os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    os.environ.setdefault("AZURE_USER_OBJECT_ID", "00000000-0000-0000-0000-000000000000")
+
+    from fastapi.testclient import TestClient
+
+    import backend
+    from benchmarks.stub_openai import StubOpenAIServer
+    from models import Agent
+
+    prompts = "\n".join(json.dumps({"id": index, "user_input": f"Evaluation prompt number {index}"}) for index in range(args.prompts))
+
+    reports = []
+    with StubOpenAIServer(latency=args.latency, throttle_every=args.throttle_every) as stub, TestClient(backend.app) as client:
+        db = backend.SessionLocal()
+        # limits well above the stub's, so the batch concurrency is what is measured
+        agent = Agent(
+            name="agent-bench-rg", display_name="bench", status="Waiting for approval", active=False, budget=100,
+            openai_endpoint=stub.endpoint, openai_api_key="bench", rate_limit_rpm=1_000_000, rate_limit_tpm=100_000_000
+        )
+        db.add(agent)
+        db.commit()
+        agent_id = agent.id
+        db.close()
+
+        for concurrency in args.concurrency:
+            response = client.post(f"/agent/{agent_id}/chat_batch?concurrency={concurrency}", files={"file": ("prompts.jsonl", prompts)})
+            response.raise_for_status()
+            job_id = response.json()["job_id"]
+
+            while True:
+                batch = client.get(f"/chat_batches/{job_id}").json()
+                if batch["status"] in ("Succeeded", "Failed"):
+                    break
+                time.sleep(0.1)
+            reports.append({'concurrency': concurrency, 'status': batch["status"], **batch["stats"]})
+
+    print(json.dumps(reports, indent=2))
@@ -0,0 +1,93 @@
+"""
+Concurrent /chat_completion requests against one uvicorn worker, backed by a
+local stub OpenAI server, reporting throughput and time-to-first-token.
+
+Run from the backend directory:
+    python -m benchmarks.bench_chat_concurrency --concurrency 200 --latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+import httpx
+
+from benchmarks.stats import summarise
+from benchmarks.stub_openai import StubOpenAIServer
+
+def start_app(database_url, port):
+    # the backend reads its settings at import time
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    os.environ.setdefault("AZURE_USER_OBJECT_ID", "00000000-0000-0000-0000-000000000000")
+
+    import uvicorn
+    import backend
+
+    server = uvicorn.Server(uvicorn.Config(backend.app, host="127.0.0.1", port=port, workers=1, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return backend, server
+
+def add_agent(backend, endpoint):
+    from models import Agent
+
+    db = backend.SessionLocal()
+    agent = Agent(name="agent-bench-rg", display_name="bench", status="Waiting for approval", active=False,
+                  budget=100, openai_endpoint=endpoint, openai_api_key="stub-key")
+    db.add(agent)
+    db.commit()
+    agent_id = agent.id
+    db.close()
+    return agent_id
+
+async def one_chat(client, agent_id, stream):
+    start = time.perf_counter()
+    first_token = None
+    async with client.stream("POST", "/chat_completion", json={"agent_id": agent_id, "user_input": "What is the capital of France?", "stream": stream}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if first_token is None and line.startswith("data:"):
+                first_token = time.perf_counter() - start
+    return time.perf_counter() - start, first_token
+
+async def run(base_url, agent_id, concurrency, stream):
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        await one_chat(client, agent_id, stream)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[one_chat(client, agent_id, stream) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    report = {
+        'concurrency': concurrency,
+        'stream': stream,
+        'wall_s': round(elapsed, 3),
+        'throughput_rps': round(concurrency / elapsed, 1),
+        'latency': summarise([total for total, _ in results])
+    }
+    if stream:
+        report['time_to_first_token'] = summarise([first for _, first in results if first is not None])
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated model latency in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory, StubOpenAIServer(latency=args.latency, token_latency=args.token_latency) as stub:
+        backend, server = start_app(f"sqlite:///{directory}/bench.db", args.port)
+        agent_id = add_agent(backend, stub.endpoint)
+
+        base_url = f"http://127.0.0.1:{args.port}"
+        reports = [asyncio.run(run(base_url, agent_id, args.concurrency, stream)) for stream in (False, True)]
+        print(json.dumps(reports, indent=2))
+        server.should_exit = True
@@ -0,0 +1,70 @@
+"""
+Connection pool checkout waits of the synchronous and async engines on SQLite
+(aiosqlite), with more concurrent sessions than pooled connections.
+
+Run from the backend directory:
+    python -m benchmarks.bench_db_pool --sessions 64 --pool-size 4 --max-overflow 0
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=64, help="Sessions open at the same time")
+    parser.add_argument("--queries", type=int, default=20, help="Queries per session")
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--max-overflow", type=int, default=0)
+    args = parser.parse_args()
+
+    # the pool settings are read at import time
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["DB_POOL_SIZE"] = str(args.pool_size)
+    os.environ["DB_MAX_OVERFLOW"] = str(args.max_overflow)
+
+    from sqlalchemy import text
+
+    import database
+    from migrations import upgrade
+
+    upgrade(database.engine)
+
+    def sync_session():
+        db = database.SessionLocal()
+        try:
+            for _ in range(args.queries):
+                db.execute(text("SELECT count(*) FROM agents")).scalar()
+                # the connection goes back to the pool between requests
+                db.commit()
+        finally:
+            db.close()
+
+    async def async_session():
+        async with database.get_async_sessionmaker()() as db:
+            for _ in range(args.queries):
+                await db.execute(text("SELECT count(*) FROM agents"))
+                await db.commit()
+
+    async def run_async():
+        await asyncio.gather(*[async_session() for _ in range(args.sessions)])
+        stats = database.pool_stats()
+        await database.dispose_async_engine()
+        return stats
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        list(executor.map(lambda _: sync_session(), range(args.sessions)))
+    sync_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = asyncio.run(run_async())
+    async_elapsed = time.perf_counter() - start
+
+    stats['sync']['wall_s'] = round(sync_elapsed, 3)
+    stats['async']['wall_s'] = round(async_elapsed, 3)
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,105 @@
+"""
+Import time of the backend module (python -X importtime), for the working tree and a
+baseline git revision, with the slowest top-level packages and the first-use cost of
+the lazily created Azure clients.
+
+Run from the backend directory:
+    python -m benchmarks.bench_import_time --baseline HEAD~1 --repeat 5
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+FIRST_USE = """
+import time, backend
+for name in ('resource_client', 'consumption_client', 'storage_client', 'cognitive_client'):
+    start = time.perf_counter()
+    getattr(backend.azure_clients, name)
+    print(name, time.perf_counter() - start)
+"""
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package", nesting shown by indentation
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((name.rstrip(), int(cumulative)))
+    return modules
+
+def import_backend(directory, env):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import backend"], cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing backend from {directory} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+def measure(directory, env, repeat):
+    runs = [import_backend(directory, env) for _ in range(repeat)]
+    totals = [next(cumulative for name, cumulative in modules if name.strip() == "backend") for modules in runs]
+
+    # modules imported directly by backend.py in the last run; children are listed before
+    # their parent, one level (two spaces) deeper
+    modules = runs[-1]
+    end = next(index for index, (name, _) in enumerate(modules) if name.strip() == "backend")
+    packages = {}
+    for name, cumulative in reversed(modules[:end]):
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            break
+        if depth == 1:
+            top = name.strip().split(".")[0]
+            packages[top] = packages.get(top, 0) + cumulative
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:8]
+    return {
+        'backend_import_ms': round(statistics.median(totals) / 1000, 1),
+        'runs_ms': [round(total / 1000, 1) for total in totals],
+        'slowest_packages_ms': {name: round(cumulative / 1000, 1) for name, cumulative in slowest}
+    }
+
+def checkout(revision, workdir):
+    # the backend directory as of the revision, without touching the working tree
+    top, prefix = subprocess.run(["git", "rev-parse", "--show-toplevel", "--show-prefix"], capture_output=True, text=True, check=True).stdout.split()
+    archive = subprocess.run(["git", "archive", "--format=tar", f"{revision}:{prefix}"], cwd=top, capture_output=True, check=True).stdout
+    target = os.path.join(workdir, "baseline")
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target)
+    return target
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--baseline", default=None, help="Git revision to compare with, e.g. HEAD~1")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # settings the backend reads at import time; migrations are left out of the measurement
+    workdir = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        SPEND_HISTORY_DIR=os.path.join(workdir, "spend_history"),
+        RETRIEVAL_INDEX_DIR=os.path.join(workdir, "retrieval_index"),
+        COST_REFRESH_INTERVAL="0",
+        RECONCILE_INTERVAL="0",
+        DB_MIGRATE_ON_STARTUP="false"
+    )
+    env.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    env.setdefault("AZURE_USER_OBJECT_ID", "00000000-0000-0000-0000-000000000000")
+
+    report = {'current': measure(os.getcwd(), env, args.repeat)}
+
+    # constructing a client imports its SDK package, no token is requested yet
+    first_use = subprocess.run([sys.executable, "-c", FIRST_USE], env=env, capture_output=True, text=True, check=True).stdout
+    report['current']['first_use_ms'] = {name: round(float(seconds) * 1000, 1) for name, seconds in (line.split() for line in first_use.splitlines())}
+
+    if args.baseline:
+        report['baseline'] = {'revision': args.baseline, **measure(checkout(args.baseline, workdir), env, args.repeat)}
+        report['speedup'] = round(report['baseline']['backend_import_ms'] / report['current']['backend_import_ms'], 1)
+
+    print(json.dumps(report, indent=2))
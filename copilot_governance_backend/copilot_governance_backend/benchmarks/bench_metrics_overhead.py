@@ -0,0 +1,79 @@
+"""
+Per-request cost of the metrics middleware and query listeners: the same requests,
+in-process over ASGI, with METRICS_ENABLED switched on and off in alternating rounds.
+
+Run from the backend directory:
+    python -m benchmarks.bench_metrics_overhead --requests 2000 --rounds 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.stats import summarise
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per endpoint and round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--agents", type=int, default=200)
+    args = parser.parse_args()
+
+    # the backend reads its settings at import time
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["SPEND_HISTORY_DIR"] = os.path.join(workdir, "spend_history")
+    os.environ["RETRIEVAL_INDEX_DIR"] = os.path.join(workdir, "retrieval_index")
+    os.environ["COST_REFRESH_INTERVAL"] = "0"
+    os.environ["RECONCILE_INTERVAL"] = "0"
+    os.environ["AZURE_CLIENTS"] = "fake"
+    os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    os.environ.setdefault("AZURE_USER_OBJECT_ID", "00000000-0000-0000-0000-000000000000")
+
+    import httpx
+
+    import backend
+    import metrics
+    from models import Agent
+
+    db = backend.SessionLocal()
+    db.add_all([Agent(name=f"agent-{index}-rg", display_name=f"agent {index}", status="Active", active=True, budget=100) for index in range(args.agents)])
+    db.commit()
+    db.close()
+
+    endpoints = [
+        ("GET /rate_limits (no queries)", "/rate_limits"),
+        ("GET /get_agents (one page)", "/get_agents?limit=50"),
+    ]
+
+    async def run(path):
+        samples = []
+        transport = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                response = await client.get(path)
+                samples.append(time.perf_counter() - start)
+                response.raise_for_status()
+        return samples
+
+    results = {name: {'on': [], 'off': []} for name, _ in endpoints}
+    for _ in range(args.rounds):
+        for enabled in (True, False):
+            metrics.METRICS_ENABLED = enabled
+            for name, path in endpoints:
+                results[name]['on' if enabled else 'off'] += asyncio.run(run(path))
+
+    metrics.METRICS_ENABLED = True
+    start = time.perf_counter()
+    exposition = metrics.registry.render()
+    render_ms = (time.perf_counter() - start) * 1000
+
+    report = {}
+    for name, samples in results.items():
+        on, off = summarise(samples['on']), summarise(samples['off'])
+        report[name] = {'metrics_on': on, 'metrics_off': off, 'overhead_us': round((on['mean_ms'] - off['mean_ms']) * 1000, 1)}
+    report['GET /metrics render'] = {'series_lines': exposition.count("\n"), 'render_ms': round(render_ms, 3)}
+    print(json.dumps(report, indent=2))
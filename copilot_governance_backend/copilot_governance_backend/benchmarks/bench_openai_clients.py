@@ -0,0 +1,50 @@
+"""
+Chat latency with a new AzureOpenAI client per request against the pooled
+OpenAIClientRegistry, measured against a local stub server.
+
+Run from the backend directory:
+    python -m benchmarks.bench_openai_clients --requests 500 --latency 0.005
+"""
+import argparse
+import json
+import time
+
+from openai import AzureOpenAI
+
+from benchmarks.stats import summarise
+from benchmarks.stub_openai import StubOpenAIServer
+from openai_clients import OpenAIClientRegistry, OPENAI_API_VERSION
+
+def chat(client):
+    return client.chat.completions.create(
+        model="gpt-3-deployment-agent1",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "What is the capital of France?"},
+        ],
+    )
+
+def run(requests, endpoint):
+    before, after = [], []
+    registry = OpenAIClientRegistry()
+
+    for _ in range(requests):
+        # previous behaviour: a new client (and connection pool) per request
+        start = time.perf_counter()
+        chat(AzureOpenAI(azure_endpoint=endpoint, api_key="stub-key", api_version=OPENAI_API_VERSION))
+        before.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        chat(registry.get(1, endpoint, "stub-key"))
+        after.append(time.perf_counter() - start)
+
+    return {'new_client_per_request': summarise(before), 'pooled_registry': summarise(after)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated model latency in seconds")
+    args = parser.parse_args()
+
+    with StubOpenAIServer(latency=args.latency) as server:
+        print(json.dumps(run(args.requests, server.endpoint), indent=2))
@@ -0,0 +1,107 @@
+"""
+Reconciliation runs against the fake Azure clients as the number of agents grows:
+duration, SQL statements per batch and Azure calls per run, with a share of the
+agents drifted (resource group deleted, deployment failed, workspace missing).
+
+Run from the backend directory:
+    python -m benchmarks.bench_reconcile --agents 100 1000 5000 --latency 0.02
+"""
+import argparse
+import json
+import math
+import os
+import tempfile
+import time
+from collections import Counter
+
+from sqlalchemy import event
+
+def seed(session_factory, fake, agents, drift_every):
+    from models import Agent
+
+    db = session_factory()
+    db.add_all([Agent(name=f"agent-{index}-rg", display_name=f"agent {index}", status="Active", active=True, budget=100) for index in range(agents)])
+    db.commit()
+    ids = [agent_id for agent_id, in db.query(Agent.id).order_by(Agent.id)]
+    db.close()
+
+    # every agent is provisioned in the fake, then every drift_every-th one drifts in turn
+    for position, agent_id in enumerate(ids):
+        resource_group_name = f"agent-{position}-rg"
+        fake.resource_client.resource_groups.create_or_update(resource_group_name, {"location": "uksouth", "tags": {"type": "agent"}})
+        fake.accounts[(resource_group_name, f"agent{agent_id}openai")] = f"https://agent{agent_id}openai.openai.azure.com/"
+        fake.deployments[(resource_group_name, f"agent{agent_id}openai", f"gpt-3-deployment-agent{agent_id}")] = None
+        fake.workspaces[(resource_group_name, f"project-agent{agent_id}")] = None
+
+        if position % drift_every == 0:
+            kind = position // drift_every % 3
+            if kind == 0:
+                fake.resource_groups.pop(resource_group_name)
+            elif kind == 1:
+                fake.deployment_states[(resource_group_name, f"agent{agent_id}openai", f"gpt-3-deployment-agent{agent_id}")] = 'Failed'
+            else:
+                fake.workspaces.pop((resource_group_name, f"project-agent{agent_id}"))
+    fake.calls.clear()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--agents", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds every fake Azure call takes")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--deployment-check-limit", type=int, default=200)
+    parser.add_argument("--drift-every", type=int, default=20, help="Every n-th agent drifts")
+    args = parser.parse_args()
+
+    # the database module reads its settings at import time
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    from database import engine, SessionLocal
+    from fake_azure import FakeAzureClients
+    from migrations import upgrade
+    from models import Agent, AgentReconciliation
+    from reconciler import Reconciler
+
+    upgrade(engine)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    report = {}
+    for agents in args.agents:
+        db = SessionLocal()
+        db.query(AgentReconciliation).delete()
+        db.query(Agent).delete()
+        db.commit()
+        db.close()
+
+        fake = FakeAzureClients(latency=args.latency)
+        seed(SessionLocal, fake, agents, args.drift_every)
+        reconciler = Reconciler(
+            SessionLocal,
+            fake,
+            batch_size=args.batch_size,
+            max_workers=args.workers,
+            deployment_check_limit=args.deployment_check_limit
+        )
+
+        runs = []
+        # the first run checks deployments up to the limit, the second one continues where it stopped
+        for _ in range(2):
+            statements.clear()
+            fake.calls.clear()
+            start = time.perf_counter()
+            stats = reconciler.run()
+            batches = math.ceil(agents / args.batch_size)
+            runs.append({
+                'seconds': round(time.perf_counter() - start, 3),
+                'drifted': stats['drifted'],
+                'status_updates': stats['status_updates'],
+                'deployment_checks': stats['deployment_checks'],
+                'sql_statements': len(statements),
+                'sql_statements_per_batch': round(len(statements) / batches, 1),
+                'azure_calls': dict(Counter(fake.calls))
+            })
+        report[agents] = runs
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,146 @@
+"""
+Hot query paths on a seeded SQLite database (100k agents, 1M knowledge sources and
+links) before and after the index migration, reporting p50/p95 latency per endpoint.
+
+Run from the backend directory:
+    python -m benchmarks.bench_schema_indexes --agents 100000 --sources 1000000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.stats import percentile
+
+# the index migration measured, the schema is migrated up to the version before it
+INDEX_MIGRATION = 5
+STATUSES = ["Active"] * 90 + ["Waiting for approval"] * 2 + ["Rejected"] * 8
+
+def seed(connection, agents, sources, approved_share, batch=50_000):
+    cursor = connection.cursor()
+    rows = ((index, f"agent-{index}-rg", f"agent {index}", f"owner{index % 500}@example.com", random.choice(STATUSES), 100.0)
+            for index in range(1, agents + 1))
+    while chunk := [row for _, row in zip(range(batch), rows)]:
+        cursor.executemany("INSERT INTO agents (id, name, display_name, owner_email, status, budget) VALUES (?, ?, ?, ?, ?, ?)", chunk)
+
+    rows = ((index, f"source-{index}.pdf", f"https://store.blob.core.windows.net/c/{index}", random.random() < approved_share)
+            for index in range(1, sources + 1))
+    while chunk := [row for _, row in zip(range(batch), rows)]:
+        cursor.executemany("INSERT INTO knowledge_sources (id, name, source, approved) VALUES (?, ?, ?, ?)", chunk)
+
+    # every source is linked to one agent, agents get sources / agents links each
+    rows = (((index % agents) + 1, index) for index in range(1, sources + 1))
+    while chunk := [row for _, row in zip(range(batch), rows)]:
+        cursor.executemany("INSERT INTO agent_knowledge_sources (agent_id, knowledge_id) VALUES (?, ?)", chunk)
+    connection.commit()
+    cursor.execute("ANALYZE")
+    connection.commit()
+
+def measure(name, call, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return name, {'p50_ms': round(percentile(samples, 0.50) * 1000, 3), 'p95_ms': round(percentile(samples, 0.95) * 1000, 3)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--agents", type=int, default=100_000)
+    parser.add_argument("--sources", type=int, default=1_000_000)
+    parser.add_argument("--approved-share", type=float, default=0.02, help="Share of approved knowledge sources")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    # the backend reads its settings at import time, the schema is migrated here
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["SPEND_HISTORY_DIR"] = os.path.join(workdir, "spend_history")
+    os.environ["RETRIEVAL_INDEX_DIR"] = os.path.join(workdir, "retrieval_index")
+    os.environ["COST_REFRESH_INTERVAL"] = "0"
+    os.environ["RECONCILE_INTERVAL"] = "0"
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "false"
+    os.environ.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    os.environ.setdefault("AZURE_USER_OBJECT_ID", "00000000-0000-0000-0000-000000000000")
+
+    from fastapi.testclient import TestClient
+    from sqlalchemy import text
+
+    import backend
+    import migrations
+    from database import engine
+    from models import Agent, AgentKnowledgeSource, KnowledgeSource
+
+    # the schema as it was before the index migration
+    migrations.upgrade(engine, target=INDEX_MIGRATION - 1)
+
+    start = time.perf_counter()
+    raw = engine.raw_connection()
+    seed(raw.driver_connection, args.agents, args.sources, args.approved_share)
+    raw.close()
+    seed_seconds = time.perf_counter() - start
+
+    # no lifespan: the endpoints measured need no background services
+    client = TestClient(backend.app)
+    agent_ids = [random.randint(1, args.agents) for _ in range(args.repeat)]
+    picks = iter(agent_ids * 100)
+
+    def duplicate_check():
+        # the lookup new_agent makes before creating an agent
+        db = backend.SessionLocal()
+        try:
+            db.query(Agent).filter(Agent.name == f"agent-{next(picks)}-rg").first()
+        finally:
+            db.close()
+
+    def link_check():
+        # the lookup record_knowledge makes before linking a source to an agent
+        db = backend.SessionLocal()
+        try:
+            agent_id = next(picks)
+            db.query(AgentKnowledgeSource.knowledge_id).filter(
+                AgentKnowledgeSource.agent_id == agent_id, AgentKnowledgeSource.knowledge_id.in_([agent_id, agent_id + args.agents])
+            ).all()
+        finally:
+            db.close()
+
+    def grounding_ids():
+        # the approved sources get_chat_agent grounds a chat in
+        db = backend.SessionLocal()
+        try:
+            db.query(AgentKnowledgeSource.knowledge_id).join(KnowledgeSource, KnowledgeSource.id == AgentKnowledgeSource.knowledge_id).filter(
+                AgentKnowledgeSource.agent_id == next(picks), KnowledgeSource.approved == True
+            ).all()
+        finally:
+            db.close()
+
+    cases = [
+        ("new_agent duplicate name check", duplicate_check),
+        ("add_knowledge_source link check", link_check),
+        ("chat_completion grounding sources", grounding_ids),
+        ("GET /agent/{id}/knowledge_sources", lambda: client.get(f"/agent/{next(picks)}/knowledge_sources")),
+        ("GET /knowledge_sources?approved=true", lambda: client.get("/knowledge_sources?approved=true&limit=50")),
+        ("GET /knowledge_sources?approved=true&after=", lambda: client.get(f"/knowledge_sources?approved=true&limit=50&after={args.sources // 2}")),
+        ("GET /get_agents?status=Waiting for approval", lambda: client.get("/get_agents?status=Waiting%20for%20approval&limit=50")),
+    ]
+
+    before = dict(measure(name, call, args.repeat) for name, call in cases)
+    start = time.perf_counter()
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+    migrate_seconds = time.perf_counter() - start
+    after = dict(measure(name, call, args.repeat) for name, call in cases)
+
+    print(json.dumps({
+        'agents': args.agents,
+        'sources': args.sources,
+        'seed_s': round(seed_seconds, 1),
+        'migration_s': round(migrate_seconds, 1),
+        'endpoints': {
+            name: {'before': before[name], 'after': after[name], 'p50_speedup': round(before[name]['p50_ms'] / max(after[name]['p50_ms'], 0.001), 1)}
+            for name, _ in cases
+        }
+    }, indent=2))
@@ -0,0 +1,56 @@
+"""
+Spend history range queries over years of hourly samples for many agents.
+
+Run from the backend directory:
+    python -m benchmarks.bench_spend_history --agents 200 --years 3 --queries 2000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.stats import summarise
+from spend_history import SpendHistoryStore
+
+def run(directory, agents, years, queries):
+    store = SpendHistoryStore(directory, raw_retention=years * 366 * 86400, hour_retention=years * 366 * 86400)
+    end = int(time.time()) // 3600 * 3600
+    timestamps = list(range(end - years * 365 * 86400, end, 3600))
+
+    start = time.perf_counter()
+    for agent_id in range(1, agents + 1):
+        # spend grows through each month and resets at its start
+        values = [(ts % (30 * 86400)) / 86400 * agent_id for ts in timestamps]
+        store.bulk_load(agent_id, timestamps, values)
+    load_seconds = time.perf_counter() - start
+
+    samples = {step: [] for step in (None, 'hour', 'day', 'month')}
+    for _ in range(queries):
+        agent_id = random.randint(1, agents)
+        span = random.choice([7, 30, 365, years * 365]) * 86400
+        range_start = random.randint(timestamps[0], end - span)
+        for step in samples:
+            begin = time.perf_counter()
+            store.query(agent_id, range_start, range_start + span, step)
+            samples[step].append(time.perf_counter() - begin)
+
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+    return {
+        'agents': agents,
+        'samples_per_agent': len(timestamps),
+        'bulk_load_s': round(load_seconds, 2),
+        'bytes_on_disk': size,
+        'query_latency': {step or 'auto': summarise(values) for step, values in samples.items()}
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--agents", type=int, default=200)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(json.dumps(run(directory, args.agents, args.years, args.queries), indent=2))
@@ -0,0 +1,352 @@
+"""
+Load test of the API served by uvicorn, with the Azure clients replaced by the in-process
+fakes (AZURE_CLIENTS=fake) and chat answered by the local OpenAI stub, both with injected
+latency. Every scenario (each endpoint on its own, then a weighted mix) runs at each
+concurrency; throughput, p50/p95/p99 latency per endpoint and the server's peak RSS are
+saved as JSON, and compared with an earlier report to catch regressions.
+
+Run from the backend directory:
+    python -m benchmarks.load_test --concurrency 1 8 32 --requests 500 --output load_test.json
+    python -m benchmarks.load_test --compare load_test.json --output load_test_new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmarks.stats import summarise
+from benchmarks.stub_openai import StubOpenAIServer
+
+DEFAULT_MIX = "get_agents=30,get_agent=30,chat=25,download=10,upload=5"
+SCENARIOS = ["get_agents", "get_agent", "chat", "download", "upload", "mix"]
+
+class LoadState:
+    """
+    Ids the requests pick from: every seeded agent, the provisioned agents (with storage
+    and a chat deployment pointing at the stub) and the knowledge sources uploaded so far.
+    """
+    def __init__(self, agent_ids, provisioned_ids, upload_bytes):
+        self.agent_ids = agent_ids
+        self.provisioned_ids = provisioned_ids
+        self.upload_bytes = upload_bytes
+        self.sources = []
+        self.uploads = 0
+
+def get_agents(state, rng):
+    return "GET", "/get_agents?limit=50", {}
+
+def get_agent(state, rng):
+    return "GET", f"/get_agent/{rng.choice(state.agent_ids)}", {}
+
+def chat(state, rng):
+    body = {"agent_id": rng.choice(state.provisioned_ids), "user_input": f"What does the travel policy say about case {rng.randrange(10_000)}?"}
+    return "POST", "/chat_completion", {'json': body}
+
+def upload(state, rng):
+    # new content every time, identical content would only be linked. The levels reuse
+    # the seed, so the random bytes repeat across them and a uuid4 prefix keeps them unique
+    state.uploads += 1
+    content = uuid.uuid4().bytes + rng.randbytes(max(state.upload_bytes - 16, 0))
+    files = {"file": (f"load-{state.uploads}.bin", content)}
+    return "POST", f"/agent/{rng.choice(state.provisioned_ids)}/add_knowledge_source", {'data': {"knowledge_source_name": f"load {state.uploads}"}, 'files': files}
+
+def download(state, rng):
+    agent_id, knowledge_source_id = rng.choice(state.sources)
+    return "GET", f"/agent/{agent_id}/get_knowledge_source/{knowledge_source_id}", {}
+
+ENDPOINTS = {
+    'get_agents': get_agents,
+    'get_agent': get_agent,
+    'chat': chat,
+    'upload': upload,
+    'download': download
+}
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}' in the mix, expected one of {', '.join(ENDPOINTS)}.")
+        weights[name] = float(weight)
+    return weights
+
+class ServerProcess:
+    """
+    The backend served by uvicorn in a subprocess, so the load generator does not share
+    its interpreter (and GIL), and its memory can be read from /proc.
+    """
+    def __init__(self, env, workdir):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.log_path = os.path.join(workdir, "server.log")
+        self._log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "backend:app", "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning", "--no-access-log"],
+            env=env, stdout=self._log, stderr=subprocess.STDOUT
+        )
+
+    def wait_ready(self, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The server exited with {self.process.returncode}, see {self.log_path}")
+            try:
+                if httpx.get(f"{self.base_url}/", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"The server did not start within {timeout}s, see {self.log_path}")
+
+    def reset_peak_rss(self):
+        # Linux resets the VmHWM high-water mark when 5 is written to clear_refs
+        try:
+            with open(f"/proc/{self.process.pid}/clear_refs", "w") as clear_refs:
+                clear_refs.write("5")
+        except OSError:
+            pass
+
+    def peak_rss_mb(self):
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._log.close()
+
+def provision_agents(client, count):
+    # through the API, so the fakes in the server process create the storage accounts
+    jobs = []
+    for index in range(count):
+        body = dict(
+            name=f"load{index}", display_name=f"load {index}", description="load test", owner="load", owner_email="load@example.com",
+            model_base="gpt-35-turbo", location="uksouth", active=False, status="Waiting for approval", budget=1_000_000
+        )
+        response = client.post("/new_agent", json=body)
+        response.raise_for_status()
+        jobs.append((response.json()["agent_id"], response.json()["job_id"]))
+
+    for agent_id, job_id in jobs:
+        while (status := client.get(f"/jobs/{job_id}").json()["status"]) not in ("Succeeded", "Failed"):
+            time.sleep(0.1)
+        if status == "Failed":
+            raise RuntimeError(f"Provisioning agent {agent_id} failed: {client.get(f'/jobs/{job_id}').json()['error']}")
+    return [agent_id for agent_id, _ in jobs]
+
+def seed_agents(count):
+    # listing load: plain rows, inserted directly in batches
+    from database import SessionLocal
+    from models import Agent
+
+    db = SessionLocal()
+    try:
+        rows = [
+            {'name': f"agent-bulk{index}-rg", 'display_name': f"bulk {index}", 'owner_email': f"owner{index % 50}@example.com",
+             'status': "Active", 'active': True, 'budget': 100.0}
+            for index in range(count)
+        ]
+        for start in range(0, len(rows), 5000):
+            db.execute(Agent.__table__.insert(), rows[start:start + 5000])
+        db.commit()
+        return [agent_id for agent_id, in db.query(Agent.id)]
+    finally:
+        db.close()
+
+def point_chat_at_stub(agent_ids, endpoint):
+    from database import SessionLocal
+    from models import Agent
+
+    db = SessionLocal()
+    try:
+        db.query(Agent).filter(Agent.id.in_(agent_ids)).update(
+            {Agent.openai_endpoint: endpoint, Agent.openai_api_key: "load-test"}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+async def run_level(base_url, weights, concurrency, requests, state, seed):
+    rng = random.Random(seed)
+    names, values = list(weights), list(weights.values())
+    samples = {name: [] for name in names}
+    errors = {name: Counter() for name in names}
+    remaining = requests
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                name = rng.choices(names, values)[0]
+                method, url, kwargs = ENDPOINTS[name](state, rng)
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, url, **kwargs)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    response, status = None, type(e).__name__
+                samples[name].append(time.perf_counter() - start)
+                if response is None or status >= 400:
+                    errors[name][str(status)] += 1
+                elif name == "upload":
+                    state.sources.append((int(url.split("/")[2]), response.json()["knowledge_source_id"]))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        wall = time.perf_counter() - start
+
+    endpoints = {
+        name: {**summarise(values), 'errors': dict(errors[name]), 'throughput_rps': round(len(values) / wall, 1)}
+        for name, values in samples.items() if values
+    }
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(requests / wall, 1),
+        'errors': sum(sum(counts.values()) for counts in errors.values()),
+        'endpoints': endpoints
+    }
+
+def compare(previous, current, tolerance):
+    """
+    Regressions of current against previous: lower throughput, a higher p95 of any
+    endpoint or a higher peak RSS than the tolerance allows, at the same concurrency.
+    """
+    regressions = []
+    for scenario, levels in current['scenarios'].items():
+        for concurrency, result in levels.items():
+            before = previous.get('scenarios', {}).get(scenario, {}).get(concurrency)
+            if before is None:
+                continue
+            where = f"{scenario} at concurrency {concurrency}"
+            if result['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+                regressions.append(f"{where}: throughput {before['throughput_rps']} -> {result['throughput_rps']} req/s")
+            for endpoint, stats in result['endpoints'].items():
+                old = before['endpoints'].get(endpoint)
+                if old and stats['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+                    regressions.append(f"{where}: {endpoint} p95 {old['p95_ms']} -> {stats['p95_ms']} ms")
+            if result.get('peak_rss_mb') and before.get('peak_rss_mb') and result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+                regressions.append(f"{where}: peak RSS {before['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+    return regressions
+
+def git_revision():
+    result = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario and concurrency")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weights of the endpoints in the mix scenario")
+    parser.add_argument("--agents", type=int, default=1000, help="Agents seeded for the listing and lookup endpoints")
+    parser.add_argument("--provisioned-agents", type=int, default=4, help="Agents provisioned on the fakes, used by chat, uploads and downloads")
+    parser.add_argument("--seed-files", type=int, default=20, help="Knowledge sources uploaded before the downloads")
+    parser.add_argument("--upload-bytes", type=int, default=256 * 1024)
+    parser.add_argument("--azure-latency", type=float, default=0.02, help="Seconds every fake Azure call takes")
+    parser.add_argument("--lro-latency", type=float, default=0.1, help="Seconds every fake long-running operation takes")
+    parser.add_argument("--openai-latency", type=float, default=0.05, help="Seconds every stub completion takes")
+    parser.add_argument("--database-url", default=None, help="Database the server uses, a new SQLite file by default")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="load_test.json")
+    parser.add_argument("--compare", default=None, help="Earlier report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative change before a regression is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    # the harness seeds the same database the server uses
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "false"
+    env = dict(
+        os.environ,
+        DB_MIGRATE_ON_STARTUP="true",
+        SPEND_HISTORY_DIR=os.path.join(workdir, "spend_history"),
+        RETRIEVAL_INDEX_DIR=os.path.join(workdir, "retrieval_index"),
+        CHAT_BATCH_DIR=os.path.join(workdir, "chat_batches"),
+        COST_REFRESH_INTERVAL="0",
+        RECONCILE_INTERVAL="0",
+        AZURE_CLIENTS="fake",
+        FAKE_AZURE_LATENCY=str(args.azure_latency),
+        FAKE_AZURE_LRO_LATENCY=str(args.lro_latency),
+        # the per-agent limits would otherwise be what is measured
+        CHAT_RATE_LIMIT_RPM="100000000",
+        CHAT_RATE_LIMIT_TPM="100000000000"
+    )
+    env.setdefault("AZURE_SUBSCRIPTION_ID", "00000000-0000-0000-0000-000000000000")
+    env.setdefault("AZURE_USER_OBJECT_ID", "00000000-0000-0000-0000-000000000000")
+
+    weights = parse_mix(args.mix)
+    report = {
+        'revision': git_revision(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        'scenarios': {}
+    }
+
+    with StubOpenAIServer(latency=args.openai_latency) as stub:
+        server = ServerProcess(env, workdir)
+        try:
+            server.wait_ready()
+            with httpx.Client(base_url=server.base_url, timeout=300) as client:
+                provisioned_ids = provision_agents(client, args.provisioned_agents)
+                agent_ids = seed_agents(args.agents)
+                point_chat_at_stub(provisioned_ids, stub.endpoint)
+                state = LoadState(agent_ids, provisioned_ids, args.upload_bytes)
+
+                # the downloads need sources, and the first requests warm the server up
+                asyncio.run(run_level(server.base_url, {'upload': 1}, 1, args.seed_files, state, args.seed))
+                asyncio.run(run_level(server.base_url, weights, 1, 50, state, args.seed))
+
+            for scenario in args.scenarios:
+                scenario_weights = weights if scenario == "mix" else {scenario: 1}
+                levels = report['scenarios'][scenario] = {}
+                for concurrency in args.concurrency:
+                    server.reset_peak_rss()
+                    result = asyncio.run(run_level(server.base_url, scenario_weights, concurrency, args.requests, state, args.seed + concurrency))
+                    result['peak_rss_mb'] = server.peak_rss_mb()
+                    levels[str(concurrency)] = result
+                    print(f"{scenario} at concurrency {concurrency}: {result['throughput_rps']} req/s, "
+                          f"p95 {max(stats['p95_ms'] for stats in result['endpoints'].values())} ms, "
+                          f"{result['errors']} errors, peak RSS {result['peak_rss_mb']} MB")
+        finally:
+            server.stop()
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare(json.load(previous), report, args.tolerance)
+        report['compared_with'] = {'path': args.compare, 'tolerance': args.tolerance, 'regressions': regressions}
+
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"Report saved to {args.output}")
+
+    if regressions:
+        print("Regressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
@@ -0,0 +1,14 @@
+import statistics
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+def summarise(samples):
+    return {
+        'requests': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.mean(samples) * 1000, 3)
+    }
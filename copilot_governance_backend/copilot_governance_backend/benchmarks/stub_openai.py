@@ -0,0 +1,120 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        user_input = request.get("messages", [{}])[-1].get("content", "")
+        reply = f"Echo: {user_input}"
+
+        if self.server.throttled():
+            body = json.dumps({"error": {"code": "429", "message": "Rate limit is exceeded."}}).encode()
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("retry-after-ms", str(int(self.server.retry_after * 1000)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if request.get("stream"):
+            self._stream(request, reply)
+            return
+
+        time.sleep(self.server.latency)
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": reply}
+            }],
+            "usage": {"prompt_tokens": len(user_input.split()), "completion_tokens": len(reply.split()), "total_tokens": len(user_input.split()) + len(reply.split())}
+        }).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, request, reply):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        # the first token arrives after the model latency, the rest after token_latency each
+        time.sleep(self.server.latency)
+        for index, token in enumerate(reply.split(" ")):
+            if index:
+                time.sleep(self.server.token_latency)
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": token if not index else f" {token}"}}]
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+class _Server(ThreadingHTTPServer):
+    # a deep listen backlog so bursts of new connections are not dropped
+    request_queue_size = 1024
+    daemon_threads = True
+    throttle_every = 0
+    requests = 0
+
+    def throttled(self):
+        # every throttle_every-th request is refused like an exhausted Azure deployment
+        with self.lock:
+            self.requests += 1
+            return bool(self.throttle_every) and self.requests % self.throttle_every == 0
+
+class StubOpenAIServer:
+    """
+    Minimal OpenAI-compatible chat completions server for benchmarks.
+    :param latency: Seconds every completion takes, standing in for the model round trip
+    :param token_latency: Seconds between streamed tokens
+    :param throttle_every: Answer every n-th request with 429 (0 never does)
+    :param retry_after: Seconds advertised in the retry-after-ms header of a 429
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, token_latency=0.0, throttle_every=0, retry_after=0.05):
+        self._server = _Server((host, port), _Handler)
+        self._server.latency = latency
+        self._server.token_latency = token_latency
+        self._server.throttle_every = throttle_every
+        self._server.retry_after = retry_after
+        self._server.lock = threading.Lock()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,62 @@
+import os
+import re
+
+from azure.core import MatchConditions
+
+# Bytes fetched from storage and held in memory per download at any time
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) byte positions (inclusive) asked for by a Range header,
+    or None when the whole blob should be sent.
+    Only single ranges are served, multi-range requests get the whole blob.
+    :raises RangeNotSatisfiable: The range lies outside of the blob
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+
+    first, last = match.groups()
+    if first == '':
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    # a last position before the first makes the header invalid, which RFC 9110 ignores
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+def open_blob_stream(blob_client, properties, byte_range=None):
+    """
+    Starts downloading the blob (or the inclusive byte_range of it) and returns an
+    iterator over its chunks as they arrive from storage, to hand to StreamingResponse.
+    The first request is made here so storage errors surface before any header is sent.
+    The download is pinned to the ETag read with the properties, so a blob replaced
+    mid-download fails instead of sending a mix of both versions.
+    """
+    offset, length = None, None
+    if byte_range is not None:
+        offset, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+
+    downloader = blob_client.download_blob(
+        offset=offset,
+        length=length,
+        etag=properties.etag,
+        match_condition=MatchConditions.IfNotModified
+    )
+    return downloader.chunks()
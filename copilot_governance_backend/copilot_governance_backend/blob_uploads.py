@@ -0,0 +1,95 @@
+import asyncio
+import base64
+import hashlib
+import os
+
+from azure.core.exceptions import ResourceNotFoundError
+
+# Bytes read from the upload and staged per block, and blocks staged at the same
+# time. Peak memory per upload is about chunk_size * (concurrency + 1).
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+
+class UploadResult:
+    def __init__(self, url, size, sha256, blocks, reused_blocks):
+        self.url = url
+        self.size = size
+        self.sha256 = sha256
+        self.blocks = blocks
+        self.reused_blocks = reused_blocks
+
+def block_id(index, chunk):
+    # The id depends on the block's position and content, so when an interrupted
+    # upload is sent again the blocks Azure already holds can be skipped.
+    # Azure requires every block id of a blob to have the same length.
+    return base64.b64encode(f"{index:06d}-{hashlib.sha256(chunk).hexdigest()[:32]}".encode()).decode()
+
+def staged_block_ids(blob_client):
+    try:
+        _, uncommitted = blob_client.get_block_list('uncommitted')
+    except ResourceNotFoundError:
+        return set()
+    return {block.id for block in uncommitted}
+
+async def read_chunks(upload_file, chunk_size):
+    while True:
+        chunk = await upload_file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+async def upload_stream(chunks, blob_client, concurrency=UPLOAD_CONCURRENCY, content_type=None):
+    """
+    Streams chunks into a block blob: each chunk is staged as a block (up to
+    `concurrency` at a time), the content is hashed on the fly and the block
+    list is committed at the end.
+    :param chunks: Async iterator of bytes, e.g. read_chunks(file, UPLOAD_CHUNK_SIZE)
+    :param blob_client: azure.storage.blob.BlobClient of the target blob
+    """
+    from azure.storage.blob import BlobBlock, ContentSettings
+    already_staged = await asyncio.to_thread(staged_block_ids, blob_client)
+    hasher = hashlib.sha256()
+    slots = asyncio.Semaphore(concurrency)
+    block_ids, tasks = [], []
+    size = reused = 0
+
+    async def stage(block, chunk):
+        try:
+            await asyncio.to_thread(blob_client.stage_block, block, chunk)
+        finally:
+            slots.release()
+
+    try:
+        async for chunk in chunks:
+            hasher.update(chunk)
+            size += len(chunk)
+
+            block = block_id(len(block_ids), chunk)
+            block_ids.append(block)
+            if block in already_staged:
+                reused += 1
+                continue
+
+            # waiting for a free slot bounds the number of chunks held in memory
+            await slots.acquire()
+            tasks.append(asyncio.create_task(stage(block, chunk)))
+
+            # surfacing staging errors early instead of reading the rest of the file
+            for task in tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    sha256 = hasher.hexdigest()
+    await asyncio.to_thread(
+        blob_client.commit_block_list,
+        [BlobBlock(block_id=block) for block in block_ids],
+        content_settings=ContentSettings(content_type=content_type) if content_type else None,
+        metadata={'sha256': sha256}
+    )
+    return UploadResult(blob_client.url, size, sha256, len(block_ids), reused)
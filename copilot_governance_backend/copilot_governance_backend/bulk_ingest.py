@@ -0,0 +1,111 @@
+import asyncio
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+
+# Files uploaded at the same time by one bulk request, and the most files it may hold
+BULK_UPLOAD_CONCURRENCY = int(os.getenv("BULK_UPLOAD_CONCURRENCY", "8"))
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "1000"))
+
+class IngestItem:
+    """
+    One file of a bulk request.
+    :param name: Blob name the file is stored under
+    :param open_chunks: Callable returning a new async iterator over the file's bytes, called again on retries
+    :param content_type: MIME type stored on the blob, when known
+    """
+    def __init__(self, name, open_chunks, content_type=None):
+        self.name = name
+        self.open_chunks = open_chunks
+        self.content_type = content_type
+
+def safe_blob_name(name):
+    # archive paths are kept as virtual folders, but never absolute or climbing out with '..'
+    parts = [part for part in posixpath.normpath(name.replace('\\', '/')).split('/') if part not in ('', '.', '..')]
+    return '/'.join(parts)
+
+def upload_file_item(upload_file, chunk_size):
+    async def open_chunks():
+        await upload_file.seek(0)
+        while True:
+            chunk = await upload_file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    return IngestItem(safe_blob_name(upload_file.filename or ''), open_chunks, upload_file.content_type)
+
+def _member_item(name, open_member, lock, chunk_size):
+    # Members of one archive share the spooled upload file, so each read takes the
+    # archive lock; zipfile and tarfile seek to the member's position on every read.
+    def read(member_file):
+        with lock:
+            return member_file.read(chunk_size)
+
+    def locked_open():
+        with lock:
+            return open_member()
+
+    async def open_chunks():
+        member_file = await asyncio.to_thread(locked_open)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(read, member_file)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            member_file.close()
+    return IngestItem(safe_blob_name(name), open_chunks)
+
+def archive_items(fileobj, chunk_size, max_files=BULK_MAX_FILES):
+    """
+    Lists the regular files of a zip or tar (optionally compressed) archive.
+    Member contents are only read while they are uploaded.
+    :param fileobj: Seekable file object of the archive, e.g. UploadFile.file
+    :raises ValueError: The file is not a supported archive or holds more than max_files files
+    """
+    lock = threading.Lock()
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        try:
+            archive = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile as e:
+            raise ValueError(f"The zip archive could not be read: {e}")
+        members = [info for info in archive.infolist() if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+        opener = lambda info: (lambda: archive.open(info))
+        names = [info.filename for info in members]
+    else:
+        fileobj.seek(0)
+        try:
+            archive = tarfile.open(fileobj=fileobj, mode='r:*')
+        except tarfile.TarError:
+            raise ValueError("The archive must be a zip or tar file.")
+        members = [info for info in archive.getmembers() if info.isfile()]
+        opener = lambda info: (lambda: archive.extractfile(info))
+        names = [info.name for info in members]
+
+    if len(members) > max_files:
+        raise ValueError(f"The archive holds {len(members)} files, at most {max_files} are accepted.")
+    return [_member_item(name, opener(info), lock, chunk_size) for name, info in zip(names, members)]
+
+async def ingest(items, upload_item, concurrency=BULK_UPLOAD_CONCURRENCY):
+    """
+    Runs upload_item(item) for every item, `concurrency` at a time, and returns
+    (item, result, error) tuples in the order of the items. A failed file does
+    not stop the others.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        if not item.name:
+            return item, None, "The file has no name."
+        async with slots:
+            try:
+                return item, await upload_item(item), None
+            except Exception as e:
+                print(f"Warning: Failed to upload {item.name}. Error: {e}")
+                return item, None, str(e)
+
+    return await asyncio.gather(*[run(item) for item in items])
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+from rate_limits import RateLimitExceeded
+
+# Prompts of one batch sent at the same time, on top of the agent's rate limits
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+CHAT_BATCH_MAX_PROMPTS = int(os.getenv("CHAT_BATCH_MAX_PROMPTS", "100000"))
+# Attempts per prompt after 429s, and the first backoff when no Retry-After is given
+CHAT_BATCH_MAX_ATTEMPTS = int(os.getenv("CHAT_BATCH_MAX_ATTEMPTS", "6"))
+CHAT_BATCH_BACKOFF = float(os.getenv("CHAT_BATCH_BACKOFF", "1"))
+
+PROMPTS_FILE = 'prompts.jsonl'
+RESULTS_FILE = 'results.jsonl'
+
+class Throttled(Exception):
+    """
+    Raised by a completion function when the request was refused for its rate,
+    either by the agent's limiter (local) or by Azure OpenAI with a 429.
+    """
+    def __init__(self, message, retry_after=None, local=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.local = local
+
+def parse_prompts(lines, max_prompts=CHAT_BATCH_MAX_PROMPTS):
+    """
+    Reads the prompts of a batch, one JSON object per line with a 'user_input' (or
+    'prompt') and an optional 'id'. Lines without an id are numbered from 1.
+    :raises ValueError: A line is not valid JSON, has no prompt, or repeats an id
+    """
+    prompts, ids = [], set()
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {number} is not valid JSON: {e}")
+        if not isinstance(record, dict):
+            raise ValueError(f"Line {number} must be a JSON object.")
+
+        user_input = record.get('user_input', record.get('prompt'))
+        if not isinstance(user_input, str) or not user_input:
+            raise ValueError(f"Line {number} has no 'user_input'.")
+        prompt_id = str(record.get('id', number))
+        if prompt_id in ids:
+            raise ValueError(f"Line {number} repeats the id '{prompt_id}'.")
+        ids.add(prompt_id)
+
+        prompts.append({'id': prompt_id, 'user_input': user_input})
+        if len(prompts) > max_prompts:
+            raise ValueError(f"A batch holds at most {max_prompts} prompts.")
+    if not prompts:
+        raise ValueError("The batch holds no prompts.")
+    return prompts
+
+def finished_ids(results_path):
+    # prompts answered before a restart are not sent again
+    if not os.path.exists(results_path):
+        return set()
+    ids = set()
+    with open(results_path, 'rb') as results:
+        for line in results:
+            try:
+                ids.add(json.loads(line)['id'])
+            except (ValueError, KeyError):
+                # the last line may have been cut short by the restart
+                continue
+    return ids
+
+def ends_with_newline(path):
+    with open(path, 'rb') as file:
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b'\n'
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+class BatchStats:
+    def __init__(self, total, skipped=0):
+        self.total = total
+        self.skipped = skipped
+        self.succeeded = 0
+        self.failed = 0
+        self.throttled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = []
+        self.started = time.monotonic()
+        self.finished = None
+
+    def summary(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        done = self.succeeded + self.failed
+        summary = {
+            'total': self.total,
+            'skipped': self.skipped,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'remaining': self.total - self.skipped - done,
+            'throttled_retries': self.throttled,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'elapsed_seconds': round(elapsed, 3),
+            'prompts_per_second': round(done / elapsed, 3) if elapsed > 0 else 0.0
+        }
+        if self.latencies:
+            summary.update({
+                'p50_ms': round(percentile(self.latencies, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(self.latencies, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(self.latencies, 0.99) * 1000, 3),
+                'max_ms': round(max(self.latencies) * 1000, 3)
+            })
+        return summary
+
+def backoff_delay(attempt, retry_after, base):
+    # the server's Retry-After wins, otherwise exponential backoff with full jitter
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, base * 2 ** attempt)
+
+async def run_batch(prompts, complete, results_path, stats, concurrency=CHAT_BATCH_CONCURRENCY,
+                    max_attempts=CHAT_BATCH_MAX_ATTEMPTS, backoff=CHAT_BATCH_BACKOFF):
+    """
+    Sends every prompt not yet in results_path through complete(user_input), `concurrency`
+    at a time, and appends one JSON line per prompt to results_path as soon as it is answered.
+    Throttled prompts are retried with backoff, other errors are recorded and the batch goes on.
+    Waiting for the agent's own limiter never uses up the attempts of a prompt, only 429s from
+    the deployment do.
+    :param complete: Coroutine function returning (assistant_reply, prompt_tokens, completion_tokens),
+                     raising Throttled when it should be retried later
+    :param stats: BatchStats updated as prompts finish, readable while the batch runs
+    """
+    done = finished_ids(results_path)
+    pending = [prompt for prompt in prompts if prompt['id'] not in done]
+    stats.skipped = len(prompts) - len(pending)
+
+    queue = asyncio.Queue()
+    for prompt in pending:
+        queue.put_nowait(prompt)
+
+    with open(results_path, 'a', encoding='utf-8') as results:
+        # a line cut short by a restart is ended, so the first new record gets a line of its own
+        if results.tell() > 0 and not ends_with_newline(results_path):
+            results.write('\n')
+
+        def write(record):
+            # one line per prompt, flushed so the file can be downloaded while the batch runs
+            results.write(json.dumps(record) + '\n')
+            results.flush()
+
+        async def answer(prompt):
+            start = time.monotonic()
+            attempts = 0
+            while True:
+                try:
+                    reply, prompt_tokens, completion_tokens = await complete(prompt['user_input'])
+                except Throttled as e:
+                    if e.local:
+                        await asyncio.sleep(e.retry_after)
+                        start = time.monotonic()
+                        continue
+                    stats.throttled += 1
+                    attempts += 1
+                    if attempts == max_attempts:
+                        return {'status': 'failed', 'error': f"Throttled: {e}", 'attempts': attempts}, start
+                    await asyncio.sleep(backoff_delay(attempts - 1, e.retry_after, backoff))
+                    # the latency of a prompt starts at its last attempt, backoff is reported separately
+                    start = time.monotonic()
+                    continue
+                except Exception as e:
+                    return {'status': 'failed', 'error': str(e), 'attempts': attempts + 1}, start
+                return {
+                    'status': 'succeeded',
+                    'assistant_reply': reply,
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'attempts': attempts + 1
+                }, start
+
+        async def worker():
+            while not queue.empty():
+                prompt = queue.get_nowait()
+                outcome, start = await answer(prompt)
+                latency = time.monotonic() - start
+
+                if outcome['status'] == 'succeeded':
+                    stats.succeeded += 1
+                    stats.prompt_tokens += outcome['prompt_tokens']
+                    stats.completion_tokens += outcome['completion_tokens']
+                    stats.latencies.append(latency)
+                else:
+                    stats.failed += 1
+                write({'id': prompt['id'], 'user_input': prompt['user_input'], **outcome, 'latency_ms': round(latency * 1000, 3)})
+
+        await asyncio.gather(*[worker() for _ in range(max(1, min(concurrency, len(pending))))])
+
+    stats.finished = time.monotonic()
+    return stats.summary()
+
+def throttled_from(error):
+    """
+    Converts the agent limiter's RateLimitExceeded, or an Azure OpenAI 429, into Throttled.
+    Returns None for any other error.
+    """
+    if isinstance(error, RateLimitExceeded):
+        return Throttled(str(error), error.retry_after, local=True)
+
+    response = getattr(error, 'response', None)
+    if getattr(error, 'status_code', None) != 429 or response is None:
+        return None
+    retry_after = None
+    try:
+        if response.headers.get('retry-after-ms'):
+            retry_after = float(response.headers['retry-after-ms']) / 1000
+        elif response.headers.get('retry-after'):
+            retry_after = float(response.headers['retry-after'])
+    except ValueError:
+        pass
+    return Throttled(str(error), retry_after)
@@ -0,0 +1,168 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+
+from models import AGENT_DELETING, Agent, CostSnapshot
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+def as_utc(value):
+    # SQLite hands DateTime columns back without a timezone
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+class CostRefresher:
+    """
+    Pulls the budget current_spend of every agent resource group on a schedule and
+    stores it in the cost_snapshots table, so page views never call the Consumption API.
+    :param session_factory: Callable returning a new SQLAlchemy session
+    :param clients: Azure clients (real or fake) providing consumption_client
+    :param interval: Seconds between two full refreshes
+    :param stale_after: Age in seconds after which a snapshot is reported as stale
+    :param max_workers: Consumption API calls made at the same time, kept low to avoid throttling
+    :param retry_after: Seconds a page view waits after a failed refresh of a stale snapshot before trying again
+    """
+    def __init__(self, session_factory, clients, interval=900, stale_after=1800, max_workers=4, retries=3, retry_after=300):
+        self.session_factory = session_factory
+        self.clients = clients
+        self.interval = interval
+        self.stale_after = stale_after
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_after = retry_after
+        self.last_refresh = None
+        # callables receiving [(agent_id, amount)] and the refresh time after every refresh
+        self.listeners = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def fetch_spend(self, resource_group_name):
+        scope = f"/subscriptions/{self.clients.subscription_id}/resourceGroups/{resource_group_name}"
+
+        for attempt in range(self.retries + 1):
+            try:
+                budget = self.clients.consumption_client.budgets.get(scope=scope, budget_name=f"{resource_group_name}-budget")
+                break
+            except ResourceNotFoundError:
+                return 0.0, None
+            except HttpResponseError as e:
+                # throttled calls are retried with exponential backoff
+                if e.status_code != 429 or attempt == self.retries:
+                    raise
+                time.sleep(2 ** attempt)
+
+        # Access the current spend amount
+        current_spend = budget.current_spend
+        if current_spend:
+            return current_spend.amount, current_spend.unit
+        return 0.0, None
+
+    def _fetch(self, agent):
+        agent_id, resource_group_name = agent
+        try:
+            amount, unit = self.fetch_spend(resource_group_name)
+            return agent_id, amount, unit, None
+        except Exception as e:
+            print(f"Warning: Failed to refresh spend for {resource_group_name}. Error: {e}")
+            return agent_id, None, None, str(e)
+
+    def _store(self, db, fetched):
+        now = utcnow()
+        snapshots = {
+            snapshot.agent_id: snapshot
+            for snapshot in db.query(CostSnapshot).filter(CostSnapshot.agent_id.in_([item[0] for item in fetched]))
+        }
+
+        for agent_id, amount, unit, error in fetched:
+            snapshot = snapshots.get(agent_id)
+            if snapshot is None:
+                snapshot = CostSnapshot(agent_id=agent_id)
+                db.add(snapshot)
+
+            # a failed refresh keeps the last known spend and records the error
+            snapshot.attempted_at = now
+            snapshot.error = error
+            if error is None:
+                snapshot.amount = amount
+                snapshot.unit = unit
+                snapshot.refreshed_at = now
+
+        db.commit()
+
+        refreshed = [(agent_id, amount) for agent_id, amount, _, error in fetched if error is None]
+        for listener in self.listeners:
+            try:
+                listener(refreshed, now)
+            except Exception as e:
+                print(f"Warning: Cost refresh listener failed. Error: {e}")
+
+    def refresh_all(self):
+        db = self.session_factory()
+        try:
+            # agents being deleted are left out, their resource group is going away
+            agents = db.query(Agent.id, Agent.name).filter(Agent.status != AGENT_DELETING).all()
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cost-refresh") as executor:
+                fetched = list(executor.map(self._fetch, agents))
+
+            # every snapshot is written in one transaction
+            self._store(db, fetched)
+            self.last_refresh = utcnow()
+            return len(fetched)
+        finally:
+            db.close()
+
+    def refresh_agent(self, db, agent):
+        fetched = self._fetch((agent.id, agent.name))
+        self._store(db, [fetched])
+        return db.query(CostSnapshot).filter(CostSnapshot.agent_id == agent.id).first()
+
+    def is_stale(self, snapshot, now=None):
+        if snapshot is None or snapshot.refreshed_at is None:
+            return True
+        now = now or utcnow()
+        return (now - as_utc(snapshot.refreshed_at)).total_seconds() > self.stale_after
+
+    def needs_refresh(self, snapshot, now=None):
+        """
+        Whether a page view should refresh the snapshot itself: it is stale and no refresh
+        failed within retry_after, otherwise the Consumption API (and its throttling backoff)
+        would be called on every view while it fails.
+        """
+        now = now or utcnow()
+        if not self.is_stale(snapshot, now):
+            return False
+        if snapshot is None or snapshot.error is None or snapshot.attempted_at is None:
+            return True
+        return (now - as_utc(snapshot.attempted_at)).total_seconds() > self.retry_after
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="cost-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_all()
+            except Exception as e:
+                print(f"Warning: Cost refresh failed. Error: {e}")
+            self._stop.wait(self.interval)
+
+def serialize_snapshot(snapshot, refresher, now=None):
+    if snapshot is None:
+        return {'current_spend': None, 'refreshed_at': None, 'stale': True, 'error': None}
+
+    return {
+        'current_spend': {'amount': snapshot.amount, 'unit': snapshot.unit} if snapshot.refreshed_at else None,
+        'refreshed_at': snapshot.refreshed_at,
+        'stale': refresher.is_stale(snapshot, now),
+        'error': snapshot.error
+    }
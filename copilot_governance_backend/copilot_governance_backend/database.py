@@ -1,20 +1,158 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from dotenv import load_dotenv
 import os
+import threading
+import time
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Driver used by AsyncSession, derived from DATABASE_URL when not set
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+# Connection pool of each engine. The Azure MySQL flexible server drops connections idle
+# for longer than its wait_timeout, so they are recycled before and checked on checkout.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# Async drivers of the synchronous ones this backend is deployed with
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg'
+}
+
+class PoolMetrics:
+    """
+    How long requests waited for a pooled connection. A growing wait means the pool
+    is too small for the traffic (or connections are held too long).
+    """
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def stats(self, pool):
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'average_wait_ms': round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                'max_wait_ms': round(self.wait_max * 1000, 3)
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': pool.overflow(), 'idle': pool.checkedin()})
+        return stats
+
+def timed_pool(pool_class, metrics):
+    # _do_get is where a checkout waits for a free connection (or opens a new one)
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except PoolTimeoutError:
+                metrics.record(time.perf_counter() - start, timed_out=True)
+                raise
+            metrics.record(time.perf_counter() - start)
+            return connection
+    return TimedPool
+
+def engine_options(url, pool_class, metrics, **overrides):
+    """
+    Keyword arguments for create_engine / create_async_engine. SQLite in-memory
+    databases keep SQLAlchemy's own single-connection pool.
+    """
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return overrides
+
+    options = {
+        'poolclass': timed_pool(pool_class, metrics),
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+    options.update(overrides)
+    return options
+
+def make_engine(url=DATABASE_URL, metrics=None, **overrides):
+    """
+    Creates the synchronous engine with the configured pool.
+    :param overrides: create_engine arguments that win over the DB_POOL_* settings
+    """
+    return create_engine(url, **engine_options(url, QueuePool, metrics or PoolMetrics(), **overrides))
+
+def async_url(url):
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f"No async driver is known for '{url.get_backend_name()}', set ASYNC_DATABASE_URL.")
+    return url.set(drivername=driver)
+
+def make_async_engine(url=None, metrics=None, **overrides):
+    # imported here, so the synchronous code paths never need the async drivers
+    from sqlalchemy.ext.asyncio import create_async_engine
+    url = url or ASYNC_DATABASE_URL or async_url(DATABASE_URL)
+    return create_async_engine(url, **engine_options(url, AsyncAdaptedQueuePool, metrics or PoolMetrics(), **overrides))
+
+pool_metrics = PoolMetrics()
+engine = make_engine(DATABASE_URL, pool_metrics)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# The async engine is created on first use
+async_pool_metrics = PoolMetrics()
+async_engine = None
+AsyncSessionLocal = None
+_async_lock = threading.Lock()
+
+def get_async_sessionmaker():
+    global async_engine, AsyncSessionLocal
+    with _async_lock:
+        if AsyncSessionLocal is None:
+            from sqlalchemy.ext.asyncio import async_sessionmaker
+            async_engine = make_async_engine(metrics=async_pool_metrics)
+            # objects stay readable after commit, an async session cannot lazy-load expired attributes
+            AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+        return AsyncSessionLocal
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+def pool_stats():
+    stats = {'sync': pool_metrics.stats(engine.pool)}
+    if async_engine is not None:
+        stats['async'] = async_pool_metrics.stats(async_engine.pool)
+    return stats
+
+async def dispose_async_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
@@ -0,0 +1,359 @@
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from azure.core.exceptions import ClientAuthenticationError, HttpResponseError, ResourceExistsError, ResourceNotFoundError
+
+class FakePoller:
+    """
+    Stands in for azure.core.polling.LROPoller; the operation completes after the injected latency.
+    """
+    def __init__(self, result, latency=0.0):
+        self._result = result
+        self._ready_at = time.monotonic() + latency
+
+    def result(self, timeout=None):
+        remaining = self._ready_at - time.monotonic()
+        if timeout is not None and timeout < remaining:
+            # like LROPoller, an expired timeout returns without the resource
+            time.sleep(timeout)
+            return None
+        time.sleep(max(remaining, 0))
+        return self._result
+
+    def wait(self, timeout=None):
+        self.result(timeout)
+
+    def done(self):
+        return time.monotonic() >= self._ready_at
+
+    def status(self):
+        return 'Succeeded' if self.done() else 'InProgress'
+
+class _FakeOperations:
+    def __init__(self, azure):
+        self.azure = azure
+
+    def _call(self, operation, result):
+        self.azure.record(operation)
+        time.sleep(self.azure.latency)
+        return result
+
+    def _poller(self, operation, result):
+        self.azure.record(operation)
+        return FakePoller(result, self.azure.lro_latency)
+
+class FakeResourceGroups(_FakeOperations):
+    def create_or_update(self, resource_group_name, parameters):
+        group = SimpleNamespace(
+            name=resource_group_name,
+            location=parameters.get("location"),
+            tags=parameters.get("tags", {}),
+            properties=SimpleNamespace(provisioning_state='Succeeded')
+        )
+        self.azure.resource_groups[resource_group_name] = group
+        return self._call('resource_groups.create_or_update', group)
+
+    def get(self, resource_group_name):
+        return self._call('resource_groups.get', self.azure.resource_groups[resource_group_name])
+
+    def list(self, filter=None):
+        # supports the "tagName eq '...' and tagValue eq '...'" filter
+        groups = list(self.azure.resource_groups.values())
+        match = re.fullmatch(r"tagName eq '(.*)' and tagValue eq '(.*)'", filter or "")
+        if match:
+            groups = [group for group in groups if group.tags.get(match.group(1)) == match.group(2)]
+        return iter(self._call('resource_groups.list', groups))
+
+    def begin_delete(self, resource_group_name):
+        self.azure.resource_groups.pop(resource_group_name, None)
+        return self._poller('resource_groups.begin_delete', None)
+
+class FakeResources(_FakeOperations):
+    def list(self, filter=None):
+        # supports the "resourceType eq '...'" filter, resources go with their resource group
+        resources = [
+            ('Microsoft.CognitiveServices/accounts', resource_group_name, name) for resource_group_name, name in self.azure.accounts
+        ] + [
+            ('Microsoft.MachineLearningServices/workspaces', resource_group_name, name) for resource_group_name, name in self.azure.workspaces
+        ]
+        match = re.fullmatch(r"resourceType eq '(.*)'", filter or "")
+        return iter(self._call('resources.list', [
+            SimpleNamespace(
+                name=name,
+                type=resource_type,
+                id=f"/subscriptions/{self.azure.subscription_id}/resourceGroups/{resource_group_name}/providers/{resource_type}/{name}"
+            )
+            for resource_type, resource_group_name, name in resources
+            if resource_group_name in self.azure.resource_groups and (not match or match.group(1) == resource_type)
+        ]))
+
+class FakeBudgets(_FakeOperations):
+    def create_or_update(self, scope, budget_name, parameters):
+        self.azure.budgets[(scope, budget_name)] = parameters
+        return self._call('budgets.create_or_update', parameters)
+
+    def get(self, scope, budget_name):
+        spend = self.azure.spend.get(scope.rsplit('/', 1)[-1], 0.0)
+        budget = SimpleNamespace(name=budget_name, current_spend=SimpleNamespace(amount=spend, unit='GBP'))
+        return self._call('budgets.get', budget)
+
+class FakeAccounts(_FakeOperations):
+    def begin_create(self, resource_group_name, account_name, account):
+        endpoint = f"https://{account_name}.openai.azure.com/"
+        self.azure.accounts[(resource_group_name, account_name)] = endpoint
+        resource = SimpleNamespace(name=account_name, properties=SimpleNamespace(endpoint=endpoint))
+        return self._poller('accounts.begin_create', resource)
+
+    def list_keys(self, resource_group_name, account_name):
+        return self._call('accounts.list_keys', SimpleNamespace(key1=f"{account_name}-key1", key2=f"{account_name}-key2"))
+
+class FakeDeployments(_FakeOperations):
+    def begin_create_or_update(self, resource_group_name, account_name, deployment_name, deployment):
+        self.azure.deployments[(resource_group_name, account_name, deployment_name)] = deployment
+        return self._poller('deployments.begin_create_or_update', SimpleNamespace(name=deployment_name))
+
+    def get(self, resource_group_name, account_name, deployment_name):
+        key = (resource_group_name, account_name, deployment_name)
+        if key not in self.azure.deployments or resource_group_name not in self.azure.resource_groups:
+            self.azure.record('deployments.get')
+            raise ResourceNotFoundError(message=f"Deployment {deployment_name} not found")
+        # deployment_states overrides the state, e.g. 'Failed'
+        state = self.azure.deployment_states.get(key, 'Succeeded')
+        return self._call('deployments.get', SimpleNamespace(name=deployment_name, properties=SimpleNamespace(provisioning_state=state)))
+
+class FakeWorkspaces(_FakeOperations):
+    def __init__(self, azure, resource_group_name):
+        super().__init__(azure)
+        self.resource_group_name = resource_group_name
+
+    def begin_create(self, workspace):
+        result = SimpleNamespace(
+            name=workspace.name,
+            location=workspace.location,
+            discovery_url=f"https://{workspace.location}.api.azureml.ms/discovery"
+        )
+        self.azure.workspaces[(self.resource_group_name, workspace.name)] = result
+        # like Azure, the workspace comes with a storage account in its resource group
+        account_name = f"{self.resource_group_name.replace('-', '')[:19]}store"
+        self.azure.storage_accounts.setdefault(self.resource_group_name, {account_name: f"{account_name}-key1"})
+        return self._poller('workspaces.begin_create', result)
+
+    def get(self, name):
+        return self._call('workspaces.get', self.azure.workspaces[(self.resource_group_name, name)])
+
+class FakeStorageAccounts(_FakeOperations):
+    def list_by_resource_group(self, resource_group_name):
+        accounts = self.azure.storage_accounts.get(resource_group_name, {})
+        return iter(self._call('storage_accounts.list_by_resource_group', [
+            SimpleNamespace(name=name, id=f"/subscriptions/{self.azure.subscription_id}/resourceGroups/{resource_group_name}/providers/Microsoft.Storage/storageAccounts/{name}")
+            for name in accounts
+        ]))
+
+    def list_keys(self, resource_group_name, account_name):
+        key = self.azure.storage_accounts[resource_group_name][account_name]
+        return self._call('storage_accounts.list_keys', SimpleNamespace(keys=[SimpleNamespace(value=key)]))
+
+    def regenerate_key(self, resource_group_name, account_name, regenerate_key=None):
+        # rotates the key, clients still holding the old one are refused with 403
+        accounts = self.azure.storage_accounts[resource_group_name]
+        accounts[account_name] = f"{account_name}-key{int(accounts[account_name].rsplit('-key', 1)[1]) + 1}"
+        return self._call('storage_accounts.regenerate_key', None)
+
+class FakeBlobDownloader:
+    def __init__(self, data, properties, chunk_size):
+        self._data = data
+        self.properties = properties
+        self.size = len(data)
+        self._chunk_size = chunk_size
+
+    def chunks(self):
+        for start in range(0, len(self._data), self._chunk_size):
+            yield self._data[start:start + self._chunk_size]
+
+    def readall(self):
+        return self._data
+
+class _FakeDataOperations(_FakeOperations):
+    # data-plane calls check the key of the client they were made through
+    def __init__(self, azure, service):
+        super().__init__(azure)
+        self.service = service
+
+    def _call(self, operation, result):
+        if self.service is not None:
+            self.service.authorize(operation)
+        return super()._call(operation, result)
+
+class FakeBlobClient(_FakeDataOperations):
+    """
+    In-memory block blob supporting the subset of azure.storage.blob.BlobClient the backend uses.
+    """
+    def __init__(self, azure, container_name, blob_name, service=None):
+        super().__init__(azure, service)
+        self.container_name = container_name
+        self.blob_name = blob_name
+        account_url = service.account_url if service is not None and service.account_url else "https://fakestorage.blob.core.windows.net"
+        self.url = f"{account_url}/{container_name}/{blob_name}"
+
+    @property
+    def _key(self):
+        return (self.container_name, self.blob_name)
+
+    def stage_block(self, block_id, data, **kwargs):
+        self._call('blob.stage_block', None)
+        with self.azure._lock:
+            self.azure.staged_blocks.setdefault(self._key, {})[block_id] = bytes(data)
+
+    def get_block_list(self, block_list_type='committed', **kwargs):
+        self._call('blob.get_block_list', None)
+        staged = self.azure.staged_blocks.get(self._key, {})
+        return [], [SimpleNamespace(id=block_id, size=len(data)) for block_id, data in staged.items()]
+
+    def commit_block_list(self, block_list, content_settings=None, metadata=None, **kwargs):
+        self._call('blob.commit_block_list', None)
+        with self.azure._lock:
+            staged = self.azure.staged_blocks.pop(self._key, {})
+            data = b"".join(staged[block.id] for block in block_list)
+            self._store(data, metadata)
+
+    def upload_blob(self, data, overwrite=False, metadata=None, **kwargs):
+        self._call('blob.upload_blob', None)
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.read()
+        with self.azure._lock:
+            self._store(bytes(data), metadata)
+
+    def _store(self, data, metadata):
+        etag = f'"0x{abs(hash((self._key, data))):016X}"'
+        self.azure.blobs[self._key] = (data, SimpleNamespace(size=len(data), etag=etag, metadata=metadata or {}, content_settings=None))
+
+    def upload_blob_from_url(self, source_url, overwrite=False, **kwargs):
+        # server-side copy, the source is found by container and blob name
+        self._call('blob.upload_blob_from_url', None)
+        path = source_url.split('?', 1)[0].split('.blob.core.windows.net/', 1)[1]
+        container_name, blob_name = path.split('/', 1)
+        with self.azure._lock:
+            data, properties = self.azure.blobs[(container_name, blob_name)]
+            self._store(data, properties.metadata)
+
+    def get_blob_properties(self, **kwargs):
+        self._call('blob.get_blob_properties', None)
+        if self._key not in self.azure.blobs:
+            raise ResourceNotFoundError(message=f"Blob {self.blob_name} not found")
+        return self.azure.blobs[self._key][1]
+
+    def exists(self, **kwargs):
+        return self._call('blob.exists', self._key in self.azure.blobs)
+
+    def download_blob(self, offset=None, length=None, **kwargs):
+        self._call('blob.download_blob', None)
+        if self._key not in self.azure.blobs:
+            raise ResourceNotFoundError(message=f"Blob {self.blob_name} not found")
+        data, properties = self.azure.blobs[self._key]
+        start = offset or 0
+        end = len(data) if length is None else start + length
+        return FakeBlobDownloader(data[start:end], properties, self.azure.download_chunk_size)
+
+    def delete_blob(self, **kwargs):
+        self._call('blob.delete_blob', None)
+        self.azure.blobs.pop(self._key, None)
+
+class FakeContainerClient(_FakeDataOperations):
+    def __init__(self, azure, container_name, service=None):
+        super().__init__(azure, service)
+        self.container_name = container_name
+
+    def exists(self, **kwargs):
+        return self._call('container.exists', self.container_name in self.azure.containers)
+
+    def create_container(self, **kwargs):
+        self._call('container.create_container', None)
+        with self.azure._lock:
+            if self.container_name in self.azure.containers:
+                raise ResourceExistsError(message="The specified container already exists.")
+            self.azure.containers.add(self.container_name)
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self.azure, self.container_name, blob, self.service)
+
+class FakeBlobServiceClient:
+    def __init__(self, azure, account_url=None, credential=None):
+        self.azure = azure
+        self.account_url = account_url
+        self.credential = credential
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self.azure, container, self)
+
+    def authorize(self, operation):
+        # a client built with a key that has since been rotated is refused with 403
+        if self.credential is None:
+            return
+        for accounts in self.azure.storage_accounts.values():
+            for name, key in accounts.items():
+                if self.account_url == f"https://{name}.blob.core.windows.net" and key != self.credential:
+                    self.azure.record(operation)
+                    error = ClientAuthenticationError(message="Server failed to authenticate the request.")
+                    error.status_code = 403
+                    raise error
+
+class FakeAzureClients:
+    """
+    In-process replacement for AzureClients, for tests and local runs without Azure.
+    :param subscription_id: Subscription id used to build scopes
+    :param latency: Seconds every plain call sleeps for
+    :param lro_latency: Seconds every poller's result() sleeps for
+    """
+    def __init__(self, subscription_id="00000000-0000-0000-0000-000000000000", latency=0.0, lro_latency=0.0):
+        self.credentials = None
+        self.subscription_id = subscription_id
+        self.latency = latency
+        self.lro_latency = lro_latency
+
+        # recorded calls, injected failures and in-memory Azure state
+        self.calls = []
+        self.failures = {}
+        self._lock = threading.Lock()
+        self.resource_groups = {}
+        self.budgets = {}
+        self.spend = {}
+        self.accounts = {}
+        self.deployments = {}
+        self.deployment_states = {}
+        self.workspaces = {}
+        self.storage_accounts = {}
+        self.containers = set()
+        self.blobs = {}
+        self.staged_blocks = {}
+        self.download_chunk_size = 4 * 1024 * 1024
+
+        self.resource_client = SimpleNamespace(resource_groups=FakeResourceGroups(self), resources=FakeResources(self))
+        self.consumption_client = SimpleNamespace(budgets=FakeBudgets(self))
+        self.cognitive_client = SimpleNamespace(accounts=FakeAccounts(self), deployments=FakeDeployments(self))
+        self.storage_client = SimpleNamespace(storage_accounts=FakeStorageAccounts(self))
+
+    def ml_client(self, resource_group_name):
+        return SimpleNamespace(workspaces=FakeWorkspaces(self, resource_group_name))
+
+    def blob_service_client(self, account_url=None, credential=None, **kwargs):
+        return FakeBlobServiceClient(self, account_url, credential)
+
+    def blob_read_url(self, account_name, account_key, container_name, blob_name, expiry):
+        return f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?sig=fake"
+
+    def close(self):
+        pass
+
+    def fail_next(self, operation, times=1):
+        # the next `times` calls of the operation raise HttpResponseError
+        with self._lock:
+            self.failures[operation] = self.failures.get(operation, 0) + times
+
+    def record(self, operation):
+        with self._lock:
+            self.calls.append(operation)
+            if self.failures.get(operation):
+                self.failures[operation] -= 1
+                raise HttpResponseError(message=f"Injected failure in {operation}")
@@ -0,0 +1,471 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import or_, update
+
+from metrics import agent_label
+from models import Agent, Job, JobStep
+
+# Job and step states
+PENDING = 'Pending'
+RUNNING = 'Running'
+SUCCEEDED = 'Succeeded'
+FAILED = 'Failed'
+
+UNFINISHED = (PENDING, RUNNING)
+
+# Seconds a runner holds a job without renewing its lease. Unfinished jobs whose lease
+# has expired belong to a runner that is gone and are resumed by another one.
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+class LeaseLost(Exception):
+    pass
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+class Step:
+    """
+    A single named unit of work inside a job.
+    :param name: Name the step is persisted under
+    :param func: Callable taking a StepContext and returning a JSON-serialisable dict
+    :param depends_on: Names of the steps that must succeed before this one starts
+    :param timeout: Seconds the step may run for, including retries (None for no limit)
+    :param retries: Number of extra attempts made after a failure
+    :param backoff: Seconds to wait before the first retry, doubled on each further retry
+    """
+    def __init__(self, name, func, depends_on=(), timeout=None, retries=0, backoff=1.0):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+class StepContext:
+    """
+    Everything a step needs: the job, a database session, the Azure clients and
+    the results of the steps it depends on.
+    """
+    def __init__(self, job, db, clients, results, deadline=None):
+        self.job = job
+        self.db = db
+        self.clients = clients
+        self.results = results
+        self.deadline = deadline
+        self.payload = json.loads(job.payload) if job.payload else {}
+
+    @property
+    def agent(self):
+        return self.db.get(Agent, self.job.agent_id)
+
+    def remaining(self):
+        # seconds left before the step times out, for passing on to LRO pollers
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+class _RunningStep:
+    def __init__(self, step):
+        self.step = step
+        self.started = None
+        self.cancelled = threading.Event()
+
+    @property
+    def deadline(self):
+        if self.started is None or self.step.timeout is None:
+            return None
+        return self.started + self.step.timeout
+
+def _check_graph(kind, steps):
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Job '{kind}' has duplicate step names.")
+
+    # depth-first search for unknown dependencies and cycles
+    by_name = {step.name: step for step in steps}
+    visited, visiting = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Job '{kind}' has a dependency cycle through step '{name}'.")
+        visiting.add(name)
+        for dependency in by_name[name].depends_on:
+            if dependency not in by_name:
+                raise ValueError(f"Step '{name}' of job '{kind}' depends on unknown step '{dependency}'.")
+            visit(dependency)
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in names:
+        visit(name)
+
+class JobRunner:
+    """
+    Runs jobs in the background and persists the state of every step, so a
+    request only has to create the job and return its id. The steps of a job
+    form a dependency graph and every step whose dependencies have succeeded
+    is started straight away, so a job takes as long as its critical path.
+    Each job is held by one runner through a lease the runner keeps renewing,
+    and a step's changes are only committed while the lease is still held.
+    :param session_factory: Callable returning a new SQLAlchemy session
+    :param clients: Azure clients handed to each step (real or fake)
+    :param max_workers: Number of jobs that can run at the same time
+    :param max_step_workers: Number of steps that can run at the same time, across all jobs
+    :param lease_seconds: Seconds the lease of a job lasts without being renewed
+    """
+    def __init__(self, session_factory, clients, max_workers=4, max_step_workers=8, lease_seconds=JOB_LEASE_SECONDS):
+        self.session_factory = session_factory
+        self.clients = clients
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="jobs")
+        self._step_executor = ThreadPoolExecutor(max_workers=max_step_workers, thread_name_prefix="job-steps")
+        self._steps = {}
+        self._active = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def runs(self, kind):
+        return kind in self._steps
+
+    def register(self, kind, steps):
+        steps = list(steps)
+        _check_graph(kind, steps)
+        self._steps[kind] = steps
+
+    def lease_expiry(self):
+        return utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def create_job(self, db, kind, agent_id=None, payload=None):
+        now = utcnow()
+        # the job is leased to this runner from the start, it is submitted here
+        job = Job(
+            kind=kind,
+            agent_id=agent_id,
+            status=PENDING,
+            payload=json.dumps(payload or {}),
+            created_at=now,
+            updated_at=now,
+            owner=self.owner,
+            lease_expires_at=self.lease_expiry()
+        )
+        db.add(job)
+        db.flush()
+
+        for position, step in enumerate(self._steps[kind]):
+            db.add(JobStep(job_id=job.id, name=step.name, position=position, status=PENDING, attempts=0))
+
+        db.commit()
+        db.refresh(job)
+        return job
+
+    def submit(self, job_id):
+        # making sure the same job never runs twice in this process
+        with self._lock:
+            if job_id in self._active:
+                return None
+            self._active.add(job_id)
+        return self._executor.submit(self._run, job_id)
+
+    def retry(self, db, job):
+        # failed steps (and the ones they held back) run again, succeeded steps are kept
+        db.query(JobStep).filter(JobStep.job_id == job.id, JobStep.status == FAILED).update({JobStep.status: PENDING})
+        job.status = PENDING
+        job.error = None
+        job.updated_at = utcnow()
+        job.owner = self.owner
+        job.lease_expires_at = self.lease_expiry()
+        db.commit()
+        return self.submit(job.id)
+
+    def resume_unfinished(self):
+        """
+        Resubmits every job of a registered kind left Pending or Running whose lease has
+        expired, i.e. whose runner stopped renewing it. Each job is claimed with a
+        conditional update on the lease, so only one runner picks it up.
+        """
+        resumed = []
+        db = self.session_factory()
+        try:
+            now = utcnow()
+            expired = or_(Job.lease_expires_at.is_(None), Job.lease_expires_at < now)
+            job_ids = [
+                job_id for job_id, in db.query(Job.id).filter(Job.status.in_(UNFINISHED), Job.kind.in_(list(self._steps)), expired)
+            ]
+            for job_id in job_ids:
+                claimed = db.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.status.in_(UNFINISHED), expired)
+                    .values(status=PENDING, owner=self.owner, lease_expires_at=self.lease_expiry(), updated_at=now)
+                ).rowcount
+                if not claimed:
+                    db.rollback()
+                    continue
+
+                # steps interrupted mid-flight are started again
+                db.query(JobStep).filter(JobStep.job_id == job_id, JobStep.status == RUNNING).update({JobStep.status: PENDING})
+                db.commit()
+                resumed.append(job_id)
+        finally:
+            db.close()
+
+        for job_id in resumed:
+            self.submit(job_id)
+        return resumed
+
+    def renew_leases(self):
+        # jobs queued or running here keep their lease, whatever their steps are doing
+        with self._lock:
+            job_ids = list(self._active)
+        if not job_ids:
+            return 0
+        db = self.session_factory()
+        try:
+            renewed = db.execute(
+                update(Job)
+                .where(Job.id.in_(job_ids), Job.owner == self.owner)
+                .values(lease_expires_at=self.lease_expiry())
+            ).rowcount
+            db.commit()
+            return renewed
+        finally:
+            db.close()
+
+    def start(self):
+        """Resumes the jobs left behind by stopped runners and starts renewing the leases of this one."""
+        self.resume_unfinished()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._keep_leases, name="job-leases", daemon=True)
+            self._thread.start()
+
+    def _keep_leases(self):
+        # renewed well before expiry, jobs of runners that stopped renewing are taken over
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self.renew_leases()
+                self.resume_unfinished()
+            except Exception as e:
+                print(f"Warning: Renewing job leases failed. Error: {e}")
+
+    def shutdown(self, wait=False):
+        # leases of jobs still running are left to expire, another runner resumes them
+        self._stop.set()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        self._step_executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _held(self, db, job_id):
+        # the job row is locked until the caller commits, so the lease cannot change hands meanwhile
+        owner = db.query(Job.owner).filter(Job.id == job_id).with_for_update().scalar()
+        return owner == self.owner
+
+    def _run(self, job_id):
+        db = self.session_factory()
+        try:
+            now = utcnow()
+            claimed = db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status.in_(UNFINISHED), or_(Job.owner == self.owner, Job.owner.is_(None)))
+                .values(status=RUNNING, owner=self.owner, lease_expires_at=self.lease_expiry(), updated_at=now)
+            ).rowcount
+            db.commit()
+            if not claimed:
+                return
+            job = db.get(Job, job_id)
+
+            crashed = False
+            try:
+                error = self._run_graph(db, job)
+            except LeaseLost:
+                # the runner that took the job over finishes it
+                return
+            except Exception as e:
+                db.rollback()
+                crashed = True
+                error = f"Job runner failed: {e}"
+                print(f"Job {job_id} failed: {error}")
+
+            db.expire_all()
+            # a runner that lost the lease leaves the job to the one that took it over
+            if not self._held(db, job_id):
+                db.rollback()
+                return
+            if crashed:
+                # the job is failed rather than left Running, the steps it did not finish can be retried
+                db.query(JobStep).filter(JobStep.job_id == job_id, JobStep.status.in_(UNFINISHED)).update(
+                    {JobStep.status: FAILED, JobStep.error: error}
+                )
+
+            job = db.get(Job, job_id)
+            job.owner = None
+            job.lease_expires_at = None
+            job.updated_at = utcnow()
+            if error:
+                job.status = FAILED
+                job.error = error
+            elif all(job_step.status == SUCCEEDED for job_step in job.steps):
+                job.status = SUCCEEDED
+            db.commit()
+        finally:
+            db.close()
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _run_graph(self, db, job):
+        states = {job_step.name: job_step.status for job_step in job.steps}
+        results = {
+            job_step.name: json.loads(job_step.result) if job_step.result else {}
+            for job_step in job.steps if job_step.status == SUCCEEDED
+        }
+        running = {}
+        error = None
+
+        while True:
+            # once a step has failed nothing new is started, the running steps are left to finish
+            if error is None:
+                for step in self._steps[job.kind]:
+                    ready = all(states[dependency] == SUCCEEDED for dependency in step.depends_on)
+                    if states[step.name] == PENDING and ready:
+                        states[step.name] = RUNNING
+                        running_step = _RunningStep(step)
+                        dependency_results = {dependency: results[dependency] for dependency in step.depends_on}
+                        future = self._step_executor.submit(self._run_step, job.id, running_step, dependency_results)
+                        running[future] = running_step
+
+            if not running:
+                return error
+
+            deadlines = [running_step.deadline for running_step in running.values() if running_step.deadline is not None]
+            waiting_to_start = any(running_step.started is None for running_step in running.values())
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            if waiting_to_start:
+                timeout = min(timeout, 1.0) if timeout is not None else 1.0
+
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                running_step = running.pop(future)
+                succeeded, outcome = future.result()
+                if succeeded:
+                    states[running_step.step.name] = SUCCEEDED
+                    results[running_step.step.name] = outcome
+                else:
+                    states[running_step.step.name] = FAILED
+                    error = error or f"Step '{running_step.step.name}' failed: {outcome}"
+
+            # steps past their deadline are abandoned, their late results are discarded
+            now = time.monotonic()
+            for future, running_step in list(running.items()):
+                if running_step.deadline is not None and now >= running_step.deadline:
+                    running_step.cancelled.set()
+                    running.pop(future)
+                    message = f"Timed out after {running_step.step.timeout}s"
+                    self._finish_step(db, job.id, running_step, FAILED, error=message)
+                    states[running_step.step.name] = FAILED
+                    error = error or f"Step '{running_step.step.name}' failed: {message}"
+
+    def _run_step(self, job_id, running_step, results):
+        step = running_step.step
+        db = self.session_factory()
+        try:
+            job = db.get(Job, job_id)
+            job_step = db.query(JobStep).filter(JobStep.job_id == job_id, JobStep.name == step.name).one()
+
+            running_step.started = time.monotonic()
+            job_step.status = RUNNING
+            job_step.started_at = utcnow()
+            job_step.finished_at = None
+            job_step.duration_ms = None
+            job_step.error = None
+            db.commit()
+
+            error = None
+            for attempt in range(step.retries + 1):
+                job_step.attempts = (job_step.attempts or 0) + 1
+                db.commit()
+
+                try:
+                    ctx = StepContext(job, db, self.clients, results, deadline=running_step.deadline)
+                    # Azure calls made by the step are labelled with the job's agent
+                    with agent_label(job.agent_id):
+                        result = step.func(ctx) or {}
+                except Exception as e:
+                    db.rollback()
+                    error = str(e)
+                    print(f"Job {job_id} step '{step.name}' attempt {attempt + 1} failed: {error}")
+
+                    # waiting before the next attempt, unless the step timed out meanwhile
+                    if attempt < step.retries and not running_step.cancelled.wait(step.backoff * 2 ** attempt):
+                        continue
+                    break
+
+                if running_step.cancelled.is_set():
+                    db.rollback()
+                    return False, "Timed out"
+
+                # changes made by the step are committed together with its state
+                try:
+                    self._finish_step(db, job_id, running_step, SUCCEEDED, result=result)
+                except LeaseLost as e:
+                    return False, str(e)
+                return True, result
+
+            if running_step.cancelled.is_set():
+                db.rollback()
+                return False, error
+
+            try:
+                self._finish_step(db, job_id, running_step, FAILED, error=error)
+            except LeaseLost as e:
+                return False, str(e)
+            return False, error
+        finally:
+            db.close()
+
+    def _finish_step(self, db, job_id, running_step, status, result=None, error=None):
+        # a runner whose lease was taken over must not commit, the other runner redoes the step
+        if not self._held(db, job_id):
+            db.rollback()
+            raise LeaseLost(f"Job {job_id} is now held by another runner")
+        job_step = db.query(JobStep).filter(JobStep.job_id == job_id, JobStep.name == running_step.step.name).one()
+        job_step.status = status
+        job_step.result = json.dumps(result) if result is not None else None
+        job_step.error = error
+        job_step.finished_at = utcnow()
+        if running_step.started is not None:
+            job_step.duration_ms = (time.monotonic() - running_step.started) * 1000
+        db.commit()
+
+def serialize_job(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'agent_id': job.agent_id,
+        'status': job.status,
+        'error': job.error,
+        'created_at': job.created_at,
+        'updated_at': job.updated_at,
+        'owner': job.owner,
+        'lease_expires_at': job.lease_expires_at,
+        'steps': [
+            {
+                'name': step.name,
+                'status': step.status,
+                'attempts': step.attempts,
+                'result': json.loads(step.result) if step.result else None,
+                'error': step.error,
+                'started_at': step.started_at,
+                'finished_at': step.finished_at,
+                'duration_ms': step.duration_ms
+            }
+            for step in job.steps
+        ]
+    }
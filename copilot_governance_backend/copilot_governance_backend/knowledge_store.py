@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+from sqlalchemy.exc import IntegrityError
+
+from blob_uploads import UPLOAD_CONCURRENCY, upload_stream
+from bulk_ingest import ingest
+from models import Agent, AgentKnowledgeSource, KnowledgeSource, AGENT_DELETING
+
+# Outcome of each file of an ingestion
+UPLOADED = 'uploaded'              # new content, stored once
+DEDUPLICATED = 'deduplicated'      # content already stored for another agent, only linked
+ALREADY_LINKED = 'already_linked'  # the agent already has this content
+FAILED = 'failed'
+
+def content_blob_name(sha256):
+    # blobs are named by their content, so identical files share one name and never overwrite others
+    return f"sha256/{sha256}"
+
+def agent_container_name(agent_id):
+    return f'agent{agent_id}-blob'
+
+async def hash_chunks(chunks):
+    hasher = hashlib.sha256()
+    size = 0
+    async for chunk in chunks:
+        hasher.update(chunk)
+        size += len(chunk)
+    return hasher.hexdigest(), size
+
+class IngestEntry:
+    def __init__(self, item, name):
+        self.item = item
+        self.name = name
+        self.sha256 = None
+        self.size = None
+        self.knowledge_source = None
+        self.status = None
+        self.error = None
+
+    def result(self):
+        if self.status == FAILED:
+            return {'file': self.item.name, 'status': FAILED, 'error': self.error}
+        return {
+            'file': self.item.name,
+            'status': self.status,
+            'knowledge_source_id': self.knowledge_source.id,
+            'size': self.size,
+            'sha256': self.sha256
+        }
+
+async def ingest_knowledge(db, agent, items, storage_resolver, concurrency, names=None):
+    """
+    Stores files as content-addressed knowledge sources of an agent.
+    Every file is hashed first (it is already spooled locally), content that is
+    stored already is only linked to the agent, and the remaining unique contents
+    are uploaded `concurrency` at a time into the agent's storage account.
+    All rows are written in one transaction.
+    :param db: AsyncSession, the ORM work runs through run_sync so the event loop never blocks on it
+    :param items: IngestItem list
+    :param names: Knowledge source name of each item, the file names when omitted
+    :returns: IngestEntry list in the order of the items
+    """
+    entries = [IngestEntry(item, name) for item, name in zip(items, names or [item.name for item in items])]
+    container_name = agent_container_name(agent.id)
+
+    async def hash_item(item):
+        return await hash_chunks(item.open_chunks())
+
+    for entry, (_, hashed, error) in zip(entries, await ingest(items, hash_item, concurrency)):
+        if error is not None:
+            entry.status, entry.error = FAILED, error
+        else:
+            entry.sha256, entry.size = hashed
+
+    hashed_entries = [entry for entry in entries if entry.status is None]
+    known = await db.run_sync(known_sources, {entry.sha256 for entry in hashed_entries})
+
+    # each unknown content is uploaded once, even when the request holds it several times
+    to_upload = {}
+    for entry in hashed_entries:
+        if entry.sha256 not in known:
+            to_upload.setdefault(entry.sha256, entry)
+
+    uploading = {id(entry.item): entry for entry in to_upload.values()}
+    if uploading:
+        # raises StorageAccountNotFound up front instead of failing every file
+        await asyncio.to_thread(storage_resolver.get, agent.name)
+
+    async def upload_item(item):
+        entry = uploading[id(item)]
+
+        async def upload(target):
+            container_client = await asyncio.to_thread(target.container_client, container_name, True)
+            blob_client = container_client.get_blob_client(content_blob_name(entry.sha256))
+            return await upload_stream(item.open_chunks(), blob_client, UPLOAD_CONCURRENCY, content_type=item.content_type)
+
+        result = await storage_resolver.acall(agent.name, upload)
+        if result.sha256 != entry.sha256:
+            raise ValueError("The file changed while it was being uploaded.")
+        return result
+
+    uploads = {}
+    for item, result, error in await ingest([entry.item for entry in to_upload.values()], upload_item, concurrency):
+        uploads[uploading[id(item)].sha256] = (result, error)
+
+    for entry in hashed_entries:
+        if entry.sha256 in uploads and uploads[entry.sha256][1] is not None:
+            entry.status, entry.error = FAILED, uploads[entry.sha256][1]
+
+    await db.run_sync(record_knowledge, agent, [entry for entry in hashed_entries if entry.status is None], uploads, known)
+    return entries
+
+def known_sources(db, hashes):
+    if not hashes:
+        return {}
+    return {source.content_hash: source for source in db.query(KnowledgeSource).filter(KnowledgeSource.content_hash.in_(hashes))}
+
+def record_knowledge(db, agent, entries, uploads, known):
+    # Two requests may store the same new content at the same time: the unique
+    # content_hash makes the second insert fail, and it then links to the first one.
+    for attempt in range(2):
+        try:
+            created = {}
+            for entry in entries:
+                source = known.get(entry.sha256) or created.get(entry.sha256)
+                if source is None:
+                    result, _ = uploads[entry.sha256]
+                    source = created[entry.sha256] = KnowledgeSource(
+                        name=entry.name,
+                        source=result.url,
+                        approved=False,
+                        content_hash=entry.sha256,
+                        size=entry.size,
+                        filename=entry.item.name,
+                        storage_resource_group=agent.name
+                    )
+                entry.knowledge_source = source
+            db.add_all(created.values())
+            db.flush()
+
+            linked = {
+                row.knowledge_id
+                for row in db.query(AgentKnowledgeSource.knowledge_id).filter(
+                    AgentKnowledgeSource.agent_id == agent.id,
+                    AgentKnowledgeSource.knowledge_id.in_({entry.knowledge_source.id for entry in entries})
+                )
+            } if entries else set()
+
+            for entry in entries:
+                source = entry.knowledge_source
+                if source.id in linked:
+                    entry.status = ALREADY_LINKED
+                    continue
+                entry.status = UPLOADED if source.content_hash in created else DEDUPLICATED
+                db.add(AgentKnowledgeSource(agent_id=agent.id, knowledge_id=source.id))
+                linked.add(source.id)
+
+            db.commit()
+            return
+        except IntegrityError:
+            db.rollback()
+            if attempt == 1:
+                raise
+            known = known_sources(db, {entry.sha256 for entry in entries})
+
+def release_agent_knowledge(db, agent, storage_resolver):
+    """
+    Drops the knowledge links of an agent that is being deleted, with reference counting:
+    knowledge sources no other live agent uses are deleted, and shared blobs stored in the
+    agent's resource group are copied to another live agent's storage first, since the
+    resource group and its storage account are about to be deleted. Agents that are being
+    deleted themselves never count as users of a source.
+    Releases of agents sharing a source are serialized on its row, so the second one sees
+    the links the first one dropped.
+    Must run before the resource group is deleted. Changes are left for the caller to commit,
+    the blobs of deleted sources stored elsewhere are only returned, to be deleted once the
+    commit has succeeded (see delete_content_blob).
+    Returns the ids of the deleted knowledge sources and those blobs.
+    """
+    knowledge_ids = sorted(row.knowledge_id for row in db.query(AgentKnowledgeSource.knowledge_id).filter(AgentKnowledgeSource.agent_id == agent.id))
+    if not knowledge_ids:
+        return [], []
+
+    # locked in id order, so releases sharing several sources never deadlock
+    sources = db.query(KnowledgeSource).filter(KnowledgeSource.id.in_(knowledge_ids)).order_by(KnowledgeSource.id).with_for_update().all()
+    db.query(AgentKnowledgeSource).filter(AgentKnowledgeSource.agent_id == agent.id).delete(synchronize_session=False)
+
+    # a locking read sees the links other releases have committed meanwhile
+    survivors = {}
+    for knowledge_id, agent_id, status in (
+        db.query(AgentKnowledgeSource.knowledge_id, AgentKnowledgeSource.agent_id, Agent.status)
+        .join(Agent, Agent.id == AgentKnowledgeSource.agent_id)
+        .filter(AgentKnowledgeSource.knowledge_id.in_(knowledge_ids))
+        .order_by(AgentKnowledgeSource.agent_id)
+        .with_for_update(of=AgentKnowledgeSource)
+    ):
+        if status != AGENT_DELETING:
+            survivors.setdefault(knowledge_id, agent_id)
+
+    orphaned, orphaned_blobs = [], []
+    for source in sources:
+        hosted_here = source.storage_resource_group in (None, agent.name)
+        if source.id not in survivors:
+            orphaned.append(source.id)
+            if not hosted_here:
+                orphaned_blobs.append({"storage_resource_group": source.storage_resource_group, "source": source.source})
+        elif hosted_here:
+            rehome_content_blob(db, source, survivors[source.id], storage_resolver)
+
+    if orphaned:
+        # links of other agents being deleted go with the source
+        db.query(AgentKnowledgeSource).filter(AgentKnowledgeSource.knowledge_id.in_(orphaned)).delete(synchronize_session=False)
+        db.query(KnowledgeSource).filter(KnowledgeSource.id.in_(orphaned)).delete(synchronize_session=False)
+    return orphaned, orphaned_blobs
+
+def delete_content_blob(storage_resource_group, source, storage_resolver):
+    try:
+        storage_resolver.call(
+            storage_resource_group,
+            lambda target: target.blob_client(*blob_path(source)).delete_blob()
+        )
+    except Exception as e:
+        print(f"Warning: Failed to delete blob {source}. Error: {e}")
+
+def rehome_content_blob(db, source, agent_id, storage_resolver):
+    new_host = db.query(Agent.id, Agent.name).filter(Agent.id == agent_id).first()
+    container_name, blob_name = blob_path(source.source)
+    source_target = storage_resolver.get(source.storage_resource_group)
+
+    # a short-lived read-only SAS lets storage copy the blob server side
+    source_url = storage_resolver.clients.blob_read_url(
+        source_target.account_name,
+        source_target.key,
+        container_name,
+        blob_name,
+        datetime.now(timezone.utc) + timedelta(hours=1)
+    )
+
+    def copy(target):
+        container_client = target.container_client(agent_container_name(new_host.id), create=True)
+        blob_client = container_client.get_blob_client(blob_name)
+        blob_client.upload_blob_from_url(source_url, overwrite=True)
+        return blob_client.url
+
+    source.source = storage_resolver.call(new_host.name, copy)
+    source.storage_resource_group = new_host.name
+    print(f"Knowledge source {source.id} moved to the storage of agent {new_host.id}.")
+
+def blob_path(url):
+    # Remove leading '/'
+    path_parts = urlparse(url).path.lstrip('/').split('/')
+    return path_parts[0], '/'.join(path_parts[1:])
@@ -0,0 +1,336 @@
+"""
+Prometheus metrics of the API: the duration of every route, of every outbound Azure
+call (ARM, Consumption, Blob and OpenAI) and of every database query, with the
+number of queries each request made. Rendered in the text exposition format by
+GET /metrics; with TRACING_ENABLED=true the same timings are also recorded as
+OpenTelemetry spans, exported by whatever tracer provider the deployment configures.
+"""
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# SQL statements are labelled by their first keyword, anything else is OTHER
+STATEMENTS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'COMMIT', 'ROLLBACK', 'CREATE', 'ALTER', 'DROP', 'PRAGMA'}
+
+tracer = None
+if TRACING_ENABLED:
+    try:
+        from opentelemetry import trace
+        tracer = trace.get_tracer("copilot_governance_backend")
+    except ImportError:
+        print("TRACING_ENABLED is set but opentelemetry-api is not installed, no spans are recorded.")
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _number(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+class Histogram:
+    """
+    Prometheus histogram with a fixed set of labels.
+    :param name: Metric name, including its unit
+    :param documentation: HELP text of the metric
+    :param labelnames: Names of the labels, their values are passed to observe() in this order
+    :param buckets: Upper bounds of the buckets, +Inf is added
+    """
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # bucket counts (the last one is +Inf), then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(snapshot.items()):
+            pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{{{','.join(pairs + [le])}}} {cumulative}")
+            selector = f"{{{','.join(pairs)}}}" if pairs else ""
+            lines.append(f"{self.name}_sum{selector} {series[-1]}")
+            lines.append(f"{self.name}_count{selector} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        histogram = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+registry = MetricsRegistry()
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time to the last byte of the response, per route.", ("method", "route", "status")
+)
+http_request_db_queries = registry.histogram(
+    "http_request_db_queries", "Database queries made by one request, per route.", ("route",), COUNT_BUCKETS
+)
+http_request_db_duration = registry.histogram(
+    "http_request_db_duration_seconds", "Time one request spent in database queries, per route.", ("route",)
+)
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "Duration of every database query, by statement.", ("statement",), QUERY_BUCKETS
+)
+azure_request_duration = registry.histogram(
+    "azure_request_duration_seconds",
+    "Duration of every outbound Azure HTTP request (each retry and LRO poll counts), by service, operation and agent.",
+    ("service", "operation", "agent", "status")
+)
+
+class RequestStats:
+    """
+    What the request being served has done so far, shared with the threads it runs work in.
+    """
+    __slots__ = ('scope', 'queries', 'db_seconds')
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.queries = 0
+        self.db_seconds = 0.0
+
+_request = contextvars.ContextVar("metrics_request", default=None)
+_agent = contextvars.ContextVar("metrics_agent", default=None)
+
+def bind_agent(agent_id):
+    """
+    Labels the Azure calls made from here on (in this request or task) with the agent.
+    Routes with an {agent_id} path parameter are labelled without it.
+    """
+    _agent.set(agent_id)
+
+@contextmanager
+def agent_label(agent_id):
+    # for worker threads, which are reused by the next task
+    token = _agent.set(agent_id)
+    try:
+        yield
+    finally:
+        _agent.reset(token)
+
+def current_agent():
+    agent = _agent.get()
+    if agent is None:
+        stats = _request.get()
+        if stats is not None:
+            agent = stats.scope.get("path_params", {}).get("agent_id")
+    return "" if agent is None else str(agent)
+
+def route_label(scope):
+    # the route template keeps ids out of the labels, unknown paths share one label
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+def record_span(name, start_ns, end_ns, attributes):
+    span = tracer.start_span(name, start_time=start_ns, attributes=attributes)
+    span.end(end_time=end_ns)
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request to its last response byte, so streamed
+    replies are measured in full. Background tasks that run after the response are not.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _request.set(stats)
+        start = time.perf_counter()
+        status = 500
+        finished = None
+
+        async def timed_send(message):
+            nonlocal status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = time.perf_counter()
+            await send(message)
+
+        span = tracer.start_span(f"{scope['method']} {scope['path']}") if tracer is not None else None
+        span_token = None
+        if span is not None:
+            from opentelemetry import context, trace
+            span_token = context.attach(trace.set_span_in_context(span))
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            elapsed = (finished or time.perf_counter()) - start
+            route = route_label(scope)
+            http_request_duration.observe(elapsed, scope["method"], route, str(status))
+            http_request_db_queries.observe(stats.queries, route)
+            http_request_db_duration.observe(stats.db_seconds, route)
+            _request.reset(token)
+            if span is not None:
+                context.detach(span_token)
+                span.update_name(f"{scope['method']} {route}")
+                span.set_attributes({'http.route': route, 'http.status_code': status, 'db.queries': stats.queries})
+                span.end()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("metrics_query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if not METRICS_ENABLED:
+        return
+
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    keyword = keyword if keyword in STATEMENTS else "OTHER"
+    db_query_duration.observe(elapsed, keyword)
+    stats = _request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+    if tracer is not None:
+        end_ns = time.time_ns()
+        record_span(f"db {keyword}", end_ns - int(elapsed * 1e9), end_ns, {'db.statement': statement[:200]})
+
+def _handle_error(exception_context):
+    # a failed query never reaches after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("metrics_query_start"):
+        connection.info["metrics_query_start"].pop()
+
+def instrument_sqlalchemy():
+    """
+    Times the queries of every engine, including the one behind the AsyncSession.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+def arm_operation(path):
+    """
+    Service and operation of an Azure Resource Manager request path, e.g.
+    /subscriptions/s/resourceGroups/rg/providers/Microsoft.CognitiveServices/accounts/a/listKeys
+    is ('cognitiveservices', 'accounts/listKeys'). Resource names are left out.
+    """
+    segments = [segment for segment in path.split("/") if segment]
+    lowered = [segment.lower() for segment in segments]
+    if "providers" in lowered and lowered.index("providers") + 1 < len(segments):
+        # the last provider wins: role assignments are scoped under the resource they apply to
+        index = len(lowered) - 1 - lowered[::-1].index("providers")
+        namespace, rest = lowered[index + 1], segments[index + 2:]
+    else:
+        namespace, rest = "microsoft.resources", segments[2:]
+
+    service = {'microsoft.resources': 'arm'}.get(namespace, namespace.removeprefix("microsoft."))
+    # resource types and names alternate, a trailing action takes the place of a type
+    return service, "/".join(rest[0::2]) or "subscription"
+
+def azure_operation(method, url):
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    if host == "management.azure.com" or host.startswith("management."):
+        service, operation = arm_operation(parts.path)
+    elif ".blob." in host:
+        query = parse_qs(parts.query)
+        service = "blob"
+        operation = query.get("comp", [None])[0] or ("container" if query.get("restype") == ["container"] else "blob")
+    else:
+        service, operation = host, "request"
+    return service, f"{method} {operation}"
+
+def record_outbound(service, operation, status, elapsed):
+    agent = current_agent()
+    azure_request_duration.observe(elapsed, service, operation, agent, str(status))
+    if tracer is not None:
+        end_ns = time.time_ns()
+        record_span(f"{service} {operation}", end_ns - int(elapsed * 1e9), end_ns, {'azure.agent': agent, 'http.status_code': status})
+
+def _azure_request_hook(request):
+    request.context["metrics_start"] = time.perf_counter()
+
+def _azure_response_hook(response):
+    start = response.context.get("metrics_start")
+    if start is None or not METRICS_ENABLED:
+        return
+    http_request = response.http_request
+    service, operation = azure_operation(http_request.method, http_request.url)
+    record_outbound(service, operation, response.http_response.status_code, time.perf_counter() - start)
+
+def azure_client_options():
+    """
+    Keyword arguments for the azure-core based clients (management and blob), whose
+    custom hook policy runs once per HTTP attempt, after the retry policy.
+    """
+    return {'raw_request_hook': _azure_request_hook, 'raw_response_hook': _azure_response_hook}
+
+def openai_operation(path):
+    # /openai/deployments/{deployment}/chat/completions is chat/completions
+    segments = [segment for segment in path.split("/") if segment]
+    if "deployments" in segments and segments.index("deployments") + 2 < len(segments):
+        segments = segments[segments.index("deployments") + 2:]
+    return "/".join(segments[-2:])
+
+def openai_event_hooks(agent_id, asynchronous):
+    """
+    httpx event hooks timing the requests of an OpenAI client to its response headers:
+    a streamed completion is measured to its first chunk.
+    """
+    def on_request(request):
+        request.extensions["metrics_start"] = time.perf_counter()
+
+    def on_response(response):
+        start = response.request.extensions.get("metrics_start")
+        if start is None or not METRICS_ENABLED:
+            return
+        elapsed = time.perf_counter() - start
+        with agent_label(agent_id if agent_id is not None else _agent.get()):
+            record_outbound("openai", f"{response.request.method} {openai_operation(response.request.url.path)}", response.status_code, elapsed)
+
+    if not asynchronous:
+        return {'request': [on_request], 'response': [on_response]}
+
+    async def on_request_async(request):
+        on_request(request)
+
+    async def on_response_async(response):
+        on_response(response)
+
+    return {'request': [on_request_async], 'response': [on_response_async]}
@@ -0,0 +1,271 @@
+"""
+Versioned schema migrations.
+
+Every migration runs once, in version order, and is recorded in the schema_migrations
+table. Databases created by the old Base.metadata.create_all are upgraded in place:
+each migration checks what already exists before changing it. Migrations spell out
+the tables they create instead of using the models, so what they create never
+changes when the models do.
+
+Usage, from the backend directory:
+    python migrations.py status
+    python migrations.py upgrade [--target VERSION]
+"""
+import argparse
+from datetime import datetime, timezone
+
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, String, Table, Text, inspect, select, text
+from sqlalchemy.schema import CreateColumn
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(255)),
+    Column("applied_at", DateTime)
+)
+
+class Migration:
+    """
+    :param version: Position of the migration, applied in increasing order
+    :param name: Short description stored with the version
+    :param upgrade: Callable taking the Connection the migration runs in
+    """
+    def __init__(self, version, name, upgrade):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+
+def has_table(conn, table_name):
+    return inspect(conn).has_table(table_name)
+
+def create_tables(conn, metadata, *table_names):
+    # Tables that already exist are left alone, so later migrations adding a
+    # column to one of them always check that it is still missing.
+    metadata.create_all(conn, tables=[metadata.tables[table_name] for table_name in table_names], checkfirst=True)
+
+def referenced_tables(conn, *table_names):
+    # metadata holding the existing tables the new ones have foreign keys to
+    metadata = MetaData()
+    for table_name in table_names:
+        Table(table_name, metadata, autoload_with=conn)
+    return metadata
+
+def add_column(conn, table_name, column):
+    if column.name in {existing['name'] for existing in inspect(conn).get_columns(table_name)}:
+        return
+    # the column is bound to a throwaway table, only to compile its DDL
+    Table(table_name, MetaData(), column)
+    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}"))
+
+def create_index(conn, table_name, index_name, column_names, unique=False):
+    if index_name in {index['name'] for index in inspect(conn).get_indexes(table_name)}:
+        return
+    table = Table(table_name, MetaData(), autoload_with=conn)
+    Index(index_name, *[table.c[column_name] for column_name in column_names], unique=unique).create(conn)
+
+def drop_index(conn, table_name, index_name):
+    if index_name not in {index['name'] for index in inspect(conn).get_indexes(table_name)}:
+        return
+    table = Table(table_name, MetaData(), autoload_with=conn)
+    next(index for index in table.indexes if index.name == index_name).drop(conn)
+
+def baseline(conn):
+    # the tables as the models defined them before the first migration
+    metadata = MetaData()
+    Table(
+        "agents", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("name", String, index=True),
+        Column("display_name", String),
+        Column("description", String),
+        Column("owner", String),
+        Column("owner_email", String),
+        Column("model_base", String),
+        Column("location", String),
+        Column("active", Boolean),
+        Column("status", String),
+        Column("budget", Float),
+        Column("workspace", String),
+        Column("openai_endpoint", String, nullable=True),
+        Column("openai_api_key", String, nullable=True)
+    )
+    Table(
+        "knowledge_sources", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("name", String, index=True),
+        Column("source", String),
+        Column("approved", Boolean)
+    )
+    Table(
+        "agent_knowledge_sources", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("agent_id", Integer, ForeignKey("agents.id"), index=True),
+        Column("knowledge_id", Integer, ForeignKey("knowledge_sources.id"), index=True)
+    )
+    create_tables(conn, metadata, "agents", "knowledge_sources", "agent_knowledge_sources")
+
+def agent_settings(conn):
+    add_column(conn, "agents", Column("response_cache_enabled", Boolean, default=False))
+    add_column(conn, "agents", Column("rate_limit_rpm", Integer, nullable=True))
+    add_column(conn, "agents", Column("rate_limit_tpm", Integer, nullable=True))
+
+def content_addressed_knowledge(conn):
+    add_column(conn, "knowledge_sources", Column("content_hash", String(64), nullable=True))
+    add_column(conn, "knowledge_sources", Column("size", Integer, nullable=True))
+    add_column(conn, "knowledge_sources", Column("filename", String, nullable=True))
+    add_column(conn, "knowledge_sources", Column("storage_resource_group", String, nullable=True))
+    create_index(conn, "knowledge_sources", "ix_knowledge_sources_content_hash", ["content_hash"], unique=True)
+
+def background_tables(conn):
+    metadata = referenced_tables(conn, "agents")
+    Table(
+        "jobs", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("kind", String, index=True),
+        Column("agent_id", Integer, ForeignKey("agents.id", ondelete="SET NULL"), index=True, nullable=True),
+        Column("status", String, index=True),
+        Column("payload", Text, nullable=True),
+        Column("error", Text, nullable=True),
+        Column("created_at", DateTime),
+        Column("updated_at", DateTime)
+    )
+    Table(
+        "job_steps", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("job_id", Integer, ForeignKey("jobs.id"), index=True),
+        Column("name", String),
+        Column("position", Integer),
+        Column("status", String),
+        Column("attempts", Integer, default=0),
+        Column("result", Text, nullable=True),
+        Column("error", Text, nullable=True),
+        Column("started_at", DateTime, nullable=True),
+        Column("finished_at", DateTime, nullable=True),
+        Column("duration_ms", Float, nullable=True)
+    )
+    Table(
+        "cost_snapshots", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("agent_id", Integer, ForeignKey("agents.id"), unique=True, index=True),
+        Column("amount", Float, nullable=True),
+        Column("unit", String, nullable=True),
+        Column("refreshed_at", DateTime, nullable=True),
+        Column("error", Text, nullable=True)
+    )
+    Table(
+        "chat_sessions", metadata,
+        Column("id", String(32), primary_key=True),
+        Column("agent_id", Integer, ForeignKey("agents.id", ondelete="CASCADE"), index=True),
+        Column("summary", Text, nullable=True),
+        Column("turns", Text),
+        Column("prompt_tokens", Integer, default=0),
+        Column("completion_tokens", Integer, default=0),
+        Column("estimated_spend", Float, default=0.0),
+        Column("created_at", DateTime),
+        Column("updated_at", DateTime)
+    )
+    create_tables(conn, metadata, "jobs", "job_steps", "cost_snapshots", "chat_sessions")
+
+def hot_path_indexes(conn):
+    # links duplicated before the unique index existed are dropped, the oldest one is kept
+    conn.execute(text(
+        "DELETE FROM agent_knowledge_sources WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MIN(id) AS id FROM agent_knowledge_sources GROUP BY agent_id, knowledge_id) AS keep)"
+    ))
+    create_index(conn, "agent_knowledge_sources", "ux_agent_knowledge_sources_agent_knowledge", ["agent_id", "knowledge_id"], unique=True)
+    # agent_id leads the unique index, so its own index is redundant
+    drop_index(conn, "agent_knowledge_sources", "ix_agent_knowledge_sources_agent_id")
+    create_index(conn, "knowledge_sources", "ix_knowledge_sources_approved_id", ["approved", "id"])
+    create_index(conn, "agents", "ix_agents_status_id", ["status", "id"])
+
+def reconciliation_table(conn):
+    metadata = referenced_tables(conn, "agents")
+    Table(
+        "agent_reconciliations", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("agent_id", Integer, ForeignKey("agents.id", ondelete="CASCADE"), unique=True, index=True),
+        Column("drift", Text),
+        Column("drifted", Boolean, default=False, index=True),
+        Column("previous_status", String, nullable=True),
+        Column("checked_at", DateTime, nullable=True),
+        Column("deployment_state", String, nullable=True),
+        Column("deployment_checked_at", DateTime, nullable=True)
+    )
+    create_tables(conn, metadata, "agent_reconciliations")
+
+def job_leases(conn):
+    add_column(conn, "jobs", Column("owner", String(255), nullable=True))
+    add_column(conn, "jobs", Column("lease_expires_at", DateTime, nullable=True))
+
+def cost_refresh_attempts(conn):
+    add_column(conn, "cost_snapshots", Column("attempted_at", DateTime, nullable=True))
+
+def unique_agent_names(conn):
+    # the name is the agent's resource group, two rows with one name share its Azure resources
+    duplicates = conn.execute(text("SELECT name FROM agents GROUP BY name HAVING COUNT(*) > 1")).scalars().all()
+    if duplicates:
+        raise RuntimeError(f"Agents {', '.join(duplicates)} have more than one row, delete the extra rows before upgrading.")
+    drop_index(conn, "agents", "ix_agents_name")
+    create_index(conn, "agents", "ix_agents_name", ["name"], unique=True)
+
+MIGRATIONS = [
+    Migration(1, "baseline tables", baseline),
+    Migration(2, "agent response cache and rate limit settings", agent_settings),
+    Migration(3, "content-addressed knowledge sources", content_addressed_knowledge),
+    Migration(4, "jobs, cost snapshots and chat sessions", background_tables),
+    Migration(5, "indexes for hot query paths", hot_path_indexes),
+    Migration(6, "agent reconciliation state", reconciliation_table),
+    Migration(7, "job owner and lease", job_leases),
+    Migration(8, "cost refresh attempts", cost_refresh_attempts),
+    Migration(9, "unique agent names", unique_agent_names),
+]
+
+def applied_versions(conn):
+    if not has_table(conn, "schema_migrations"):
+        return set()
+    return {row.version for row in conn.execute(select(schema_migrations.c.version))}
+
+def upgrade(engine, target=None):
+    """
+    Applies the pending migrations up to target (the latest when None), each in its own
+    transaction together with its version row. Returns the versions applied.
+    Run it once before starting several worker processes (DB_MIGRATE_ON_STARTUP=false).
+    """
+    with engine.begin() as conn:
+        schema_migrations.create(conn, checkfirst=True)
+        done = applied_versions(conn)
+
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version in done or (target is not None and migration.version > target):
+            continue
+        with engine.begin() as conn:
+            migration.upgrade(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=migration.version, name=migration.name, applied_at=datetime.now(timezone.utc)
+            ))
+        print(f"Applied migration {migration.version}: {migration.name}")
+        applied.append(migration.version)
+    return applied
+
+def status(engine):
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+    return [{'version': migration.version, 'name': migration.name, 'applied': migration.version in done} for migration in MIGRATIONS]
+
+if __name__ == "__main__":
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Versioned schema migrations.")
+    parser.add_argument("command", choices=["status", "upgrade"])
+    parser.add_argument("--target", type=int, default=None, help="Last version to apply")
+    args = parser.parse_args()
+
+    if args.command == "upgrade":
+        applied = upgrade(engine, args.target)
+        print(f"{len(applied)} migrations applied.")
+    else:
+        for row in status(engine):
+            print(f"{row['version']:>4}  {'applied' if row['applied'] else 'pending':<8} {row['name']}")
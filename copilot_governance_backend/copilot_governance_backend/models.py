@@ -1,12 +1,20 @@
-from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, DateTime, Text, Index
 from sqlalchemy.orm import relationship
 from database import Base
 
+# Status of an agent whose deletion job is running, it takes no new work
+AGENT_DELETING = 'Deleting'
+# Statuses set by the reconciler when Azure no longer matches the agent: its resource group
+# is gone (or being deleted), or its workspace, OpenAI account or deployment is missing or failed
+AGENT_MISSING = 'Missing in Azure'
+AGENT_DEGRADED = 'Degraded'
+
 class Agent(Base):
     __tablename__ = "agents"
 
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, index=True)
+    # the agent's resource group, so no two agents share one
+    name = Column(String, index=True, unique=True)
     display_name = Column(String)
     description = Column(String)
     owner = Column(String)
@@ -19,10 +27,19 @@ class Agent(Base):
     workspace = Column(String)
     openai_endpoint = Column(String, nullable=True)
     openai_api_key = Column(String, nullable=True)
+    response_cache_enabled = Column(Boolean, default=False)
+    # Chat rate limits, the deployment capacity defaults when null
+    rate_limit_rpm = Column(Integer, nullable=True)
+    rate_limit_tpm = Column(Integer, nullable=True)
 
     # Establish relationship to AgentKnowledgeSource
     knowledge_sources = relationship("AgentKnowledgeSource", back_populates="agent")
 
+    __table_args__ = (
+        # /get_agents filtered by status, paged by id
+        Index('ix_agents_status_id', 'status', 'id'),
+    )
+
 class KnowledgeSource(Base):
     __tablename__ = "knowledge_sources"
 
@@ -30,17 +47,111 @@ class KnowledgeSource(Base):
     name = Column(String, index=True)
     source = Column(String)
     approved = Column(Boolean)
+    # Content-addressed blob: one row (and one blob) per unique content, shared by every agent linked to it
+    content_hash = Column(String(64), unique=True, index=True, nullable=True)
+    size = Column(Integer, nullable=True)
+    filename = Column(String, nullable=True)
+    # Resource group whose storage account holds the blob
+    storage_resource_group = Column(String, nullable=True)
 
     # Establish relationship to AgentKnowledgeSource
     agent_associations = relationship("AgentKnowledgeSource", back_populates="knowledge_source")
 
+    __table_args__ = (
+        # approved sources for chat grounding and the approval queue, paged by id
+        Index('ix_knowledge_sources_approved_id', 'approved', 'id'),
+    )
+
 class AgentKnowledgeSource(Base):
     __tablename__ = "agent_knowledge_sources"
 
     id = Column(Integer, primary_key=True, index=True)
-    agent_id = Column(Integer, ForeignKey("agents.id"), index=True)
+    # indexed by the unique (agent_id, knowledge_id) index below
+    agent_id = Column(Integer, ForeignKey("agents.id"))
     knowledge_id = Column(Integer, ForeignKey("knowledge_sources.id"), index=True)
 
     # Define relationships to Agent and KnowledgeSource
     agent = relationship("Agent", back_populates="knowledge_sources")
-    knowledge_source = relationship("KnowledgeSource", back_populates="agent_associations")
\ No newline at end of file
+    knowledge_source = relationship("KnowledgeSource", back_populates="agent_associations")
+
+    __table_args__ = (
+        # an agent is linked to a knowledge source at most once
+        Index('ux_agent_knowledge_sources_agent_knowledge', 'agent_id', 'knowledge_id', unique=True),
+    )
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, index=True)
+    agent_id = Column(Integer, ForeignKey("agents.id", ondelete="SET NULL"), index=True, nullable=True)
+    status = Column(String, index=True)
+    payload = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    # Runner process that holds the job, it renews the lease while the job is queued or running
+    owner = Column(String(255), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+
+    # Establish relationship to JobStep
+    steps = relationship("JobStep", back_populates="job", order_by="JobStep.position")
+
+class JobStep(Base):
+    __tablename__ = "job_steps"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, ForeignKey("jobs.id"), index=True)
+    name = Column(String)
+    position = Column(Integer)
+    status = Column(String)
+    attempts = Column(Integer, default=0)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    duration_ms = Column(Float, nullable=True)
+
+    # Define relationship to Job
+    job = relationship("Job", back_populates="steps")
+
+class CostSnapshot(Base):
+    __tablename__ = "cost_snapshots"
+
+    id = Column(Integer, primary_key=True, index=True)
+    agent_id = Column(Integer, ForeignKey("agents.id"), unique=True, index=True)
+    amount = Column(Float, nullable=True)
+    unit = Column(String, nullable=True)
+    refreshed_at = Column(DateTime, nullable=True)
+    # Last refresh, successful or not, so a failing one is not retried on every page view
+    attempted_at = Column(DateTime, nullable=True)
+    error = Column(Text, nullable=True)
+
+class AgentReconciliation(Base):
+    __tablename__ = "agent_reconciliations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    agent_id = Column(Integer, ForeignKey("agents.id", ondelete="CASCADE"), unique=True, index=True)
+    # Drift kinds found by the last check as a JSON list, empty when Azure matches the agent
+    drift = Column(Text)
+    drifted = Column(Boolean, default=False, index=True)
+    # Status the agent had before the reconciler changed it, restored once the drift is gone
+    previous_status = Column(String, nullable=True)
+    checked_at = Column(DateTime, nullable=True)
+    # The deployment takes one Azure call per agent, so it is only checked every so often
+    deployment_state = Column(String, nullable=True)
+    deployment_checked_at = Column(DateTime, nullable=True)
+
+class ChatSession(Base):
+    __tablename__ = "chat_sessions"
+
+    id = Column(String(32), primary_key=True)
+    agent_id = Column(Integer, ForeignKey("agents.id", ondelete="CASCADE"), index=True)
+    # Summary of the turns that left the window, and the recent turns as compact JSON
+    summary = Column(Text, nullable=True)
+    turns = Column(Text)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    estimated_spend = Column(Float, default=0.0)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
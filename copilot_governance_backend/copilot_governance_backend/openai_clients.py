@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+OPENAI_API_VERSION = "2024-02-15-preview"
+
+def _fingerprint(endpoint, api_key):
+    # the key itself is never kept as a dictionary key
+    return endpoint, hashlib.sha256(api_key.encode()).hexdigest()
+
+class _Entry:
+    def __init__(self, fingerprint, client):
+        self.fingerprint = fingerprint
+        self.client = client
+        self.created = time.monotonic()
+
+class OpenAIClientRegistry:
+    """
+    Keeps one AzureOpenAI (or AsyncAzureOpenAI) client per agent so chat turns reuse its keep-alive
+    connection pool instead of opening a new connection (and TLS session) each time.
+    Entries are evicted least-recently-used beyond max_size and after ttl seconds,
+    and are rebuilt when the agent's endpoint or API key changes.
+    :param max_size: Maximum number of agents with a cached client
+    :param ttl: Seconds a client is reused for before it is rebuilt
+    :param max_connections: Connection pool size of each client
+    :param keepalive_expiry: Seconds an idle pooled connection is kept open
+    :param asynchronous: Build AsyncAzureOpenAI clients for use on the event loop
+    :param event_hooks: Callable taking the agent id and asynchronous, returning the httpx event hooks of its client
+    """
+    def __init__(self, max_size=256, ttl=900, max_connections=20, keepalive_expiry=60, api_version=OPENAI_API_VERSION, asynchronous=False, event_hooks=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.api_version = api_version
+        self.asynchronous = asynchronous
+        self.event_hooks = event_hooks
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def preload():
+        """
+        Imports the openai package, which _build otherwise imports with the first client.
+        It is slow to import, so the application calls this from a worker thread at startup.
+        """
+        import openai
+
+    def _build(self, agent_id, endpoint, api_key):
+        # the openai package is imported with the first client, it is slow to import
+        import httpx
+        from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+        event_hooks = self.event_hooks(agent_id, self.asynchronous) if self.event_hooks else None
+        if self.asynchronous:
+            return AsyncAzureOpenAI(
+                azure_endpoint=endpoint,
+                api_key=api_key,
+                api_version=self.api_version,
+                http_client=DefaultAsyncHttpxClient(limits=limits, event_hooks=event_hooks)
+            )
+        return AzureOpenAI(
+            azure_endpoint=endpoint,
+            api_key=api_key,
+            api_version=self.api_version,
+            http_client=DefaultHttpxClient(limits=limits, event_hooks=event_hooks)
+        )
+
+    def _cached(self, agent_id, fingerprint, now):
+        entry = self._entries.get(agent_id)
+        if entry is not None and entry.fingerprint == fingerprint and now - entry.created < self.ttl:
+            self._entries.move_to_end(agent_id)
+            return entry.client
+        return None
+
+    def get(self, agent_id, endpoint, api_key):
+        fingerprint = _fingerprint(endpoint, api_key)
+        now = time.monotonic()
+
+        with self._lock:
+            client = self._cached(agent_id, fingerprint, now)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+
+        # built outside the lock, so a slow build never holds up the other agents' chats
+        client = self._build(agent_id, endpoint, api_key)
+        with self._lock:
+            # a concurrent request for the same agent may have built one first, that one is kept
+            cached = self._cached(agent_id, fingerprint, now)
+            if cached is not None:
+                discarded, client = client, cached
+            else:
+                discarded = None
+                # Evicted clients are not closed here: a concurrent request may still be
+                # using them, their pools are released once they are garbage collected.
+                self._entries[agent_id] = _Entry(fingerprint, client)
+                self._entries.move_to_end(agent_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        # the discarded client was never handed out, async ones are left to the garbage collector
+        if discarded is not None and not self.asynchronous:
+            discarded.close()
+        return client
+
+    def invalidate(self, agent_id):
+        with self._lock:
+            entry = self._entries.pop(agent_id, None)
+        # async clients can only be closed on the event loop, see aclose()
+        if entry is not None and not self.asynchronous:
+            entry.client.close()
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        if not self.asynchronous:
+            for entry in entries:
+                entry.client.close()
+
+    async def aclose(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            await entry.client.close()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
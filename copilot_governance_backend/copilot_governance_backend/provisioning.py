@@ -0,0 +1,213 @@
+# The Azure SDK model classes are imported in the steps using them, so importing
+# this module (and the backend) does not load the SDK packages
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from datetime import datetime, timezone
+
+from jobs import Step
+
+# Capacity units of every chat deployment, which set its requests and tokens per minute
+DEPLOYMENT_CAPACITY = 1
+
+def wait_for_poller(poller, timeout):
+    # LROPoller.result() returns without raising when the timeout expires first
+    result = poller.result(timeout=timeout)
+    if not poller.done():
+        raise TimeoutError(f"Operation did not complete within {timeout:.0f}s")
+    return result
+
+def deploy_openai_model(cognitive_client, resource_group_name, openai_resource_name, deployment_name, model_name, model_version, timeout=3600):
+    from azure.mgmt.cognitiveservices.models import Sku, Deployment, DeploymentModel, DeploymentProperties
+    try:
+        # Define the deployment model
+        deployment_model = DeploymentModel(
+            name=model_name,
+            format='OpenAI',
+            version=model_version,
+            publisher='OpenAI'
+        )
+
+        # Define the deployment properties
+        deployment_properties = DeploymentProperties(
+            model=deployment_model
+        )
+
+        # Define the SKU for the deployment
+        deployment_sku = Sku(
+            name='Standard',
+            capacity=DEPLOYMENT_CAPACITY
+        )
+
+        # Define the deployment
+        deployment = Deployment(
+            sku=deployment_sku,
+            properties=deployment_properties
+        )
+
+        # Begin the deployment creation or update
+        poller = cognitive_client.deployments.begin_create_or_update(
+            resource_group_name=resource_group_name,
+            account_name=openai_resource_name,
+            deployment_name=deployment_name,
+            deployment=deployment
+        )
+
+        # Wait for the deployment to complete
+        deployment_result = wait_for_poller(poller, timeout)
+        print(f"Deployment {deployment_name} completed successfully.")
+        return deployment_result
+
+    except HttpResponseError as e:
+        print(f"Failed to deploy model: {e.message}")
+        raise RuntimeError(f"Failed to deploy model: {e.message}")
+
+def create_resource_group(ctx):
+    agent = ctx.agent
+
+    # Provision the resource group
+    rg_result = ctx.clients.resource_client.resource_groups.create_or_update(
+        agent.name, {"location": agent.location, "tags": {"type": "agent"}}
+    )
+    return {"resource_group": rg_result.name}
+
+def create_budget(ctx):
+    from azure.mgmt.consumption.models import Budget, BudgetTimePeriod, Notification
+    agent = ctx.agent
+    rg_name = agent.name
+
+    budget_name = f"{rg_name}-budget"
+    scope = f"/subscriptions/{ctx.clients.subscription_id}/resourceGroups/{rg_name}"
+    amount = agent.budget
+    time_grain = 'Monthly'  # Options: 'Monthly', 'Quarterly', 'Annually'
+    start_date = datetime(datetime.now(timezone.utc).year, datetime.now(timezone.utc).month, 1, tzinfo=timezone.utc)
+    end_date = datetime(start_date.year + 1, start_date.month, start_date.day)
+
+    # Define notifications (optional)
+    notifications = {
+        'Actual_GreaterThan_80_Percent': Notification(
+            enabled=True,
+            operator='GreaterThan',
+            threshold=80,
+            contact_emails=[agent.owner_email],
+            threshold_type='Actual'
+        )
+    }
+
+    # Create the Budget object
+    budget = Budget(
+        category='Cost',
+        amount=amount,
+        time_grain=time_grain,
+        time_period=BudgetTimePeriod(
+            start_date=start_date,
+            end_date=end_date
+        ),
+        notifications=notifications
+    )
+
+    # Create or update the budget
+    ctx.clients.consumption_client.budgets.create_or_update(
+        scope=scope,
+        budget_name=budget_name,
+        parameters=budget
+    )
+    return {"budget_name": budget_name}
+
+def create_workspace(ctx):
+    from azure.ai.ml.entities import Workspace
+    agent = ctx.agent
+
+    # Creating the Azure AI Foundry Project
+    project_name = f"project-agent{agent.id}"
+
+    # Initialize the MLClient
+    ml_client = ctx.clients.ml_client(agent.name)
+
+    # Define the workspace
+    workspace = Workspace(
+        name=project_name,
+        location=agent.location,
+        display_name=ctx.payload.get("display_name"),
+        description=agent.description,
+    )
+
+    # Create the workspace
+    workspace = wait_for_poller(ml_client.workspaces.begin_create(workspace), ctx.remaining())
+    print(f"Provisioned Azure AI Foundry project {workspace.name} in the {workspace.location} region")
+
+    workspace_details = ml_client.workspaces.get(name=project_name)
+    agent.workspace = workspace_details.discovery_url
+    return {"workspace": agent.workspace}
+
+def create_openai_account(ctx):
+    from azure.mgmt.cognitiveservices.models import Account, Sku
+    agent = ctx.agent
+    rg_name = agent.name
+    openai_resource_name = f'agent{agent.id}openai'
+
+    openai_params = Account(
+        location=agent.location,
+        kind='OpenAI',
+        sku=Sku(name='S0'),
+        properties={}
+    )
+
+    poller = ctx.clients.cognitive_client.accounts.begin_create(
+        resource_group_name=rg_name,
+        account_name=openai_resource_name,
+        account=openai_params
+    )
+    openai_resource = wait_for_poller(poller, ctx.remaining())
+
+    # Store the OpenAI endpoint and API key in the database
+    agent.openai_endpoint = openai_resource.properties.endpoint
+
+    # Retrieve the API key for the OpenAI resource
+    keys = ctx.clients.cognitive_client.accounts.list_keys(rg_name, openai_resource_name)
+    agent.openai_api_key = keys.key1
+
+    # the key is kept on the agent only, never in the step result
+    return {"openai_resource_name": openai_resource_name, "openai_endpoint": agent.openai_endpoint}
+
+def deploy_model(ctx):
+    agent = ctx.agent
+
+    # Deploy the OpenAI model
+    openai_resource_name = f'agent{agent.id}openai'
+    deployment_name = f"gpt-3-deployment-agent{agent.id}"
+    model_name = "gpt-35-turbo"  # Replace with the correct model name
+    model_version = "0125"
+
+    deploy_openai_model(
+        cognitive_client=ctx.clients.cognitive_client,
+        resource_group_name=agent.name,
+        openai_resource_name=openai_resource_name,
+        deployment_name=deployment_name,
+        model_name=model_name,
+        model_version=model_version,
+        timeout=ctx.remaining()
+    )
+    return {"deployment_name": deployment_name, "deployment_status": "Deployed"}
+
+def delete_resource_group(ctx):
+    # the resource group name is kept in the payload, the agent row goes at the end of the job
+    rg_name = ctx.payload["resource_group"]
+    try:
+        poller = ctx.clients.resource_client.resource_groups.begin_delete(rg_name)
+    except ResourceNotFoundError:
+        # deleted by an earlier attempt (or by hand)
+        return {"resource_group": rg_name, "already_deleted": True}
+
+    # failures of the long-running delete raise here, so the step is retried
+    wait_for_poller(poller, ctx.remaining())
+    print(f"Resource group {rg_name} deleted.")
+    return {"resource_group": rg_name}
+
+# Steps of the 'new_agent' job. The budget, the AI Foundry project and the
+# OpenAI account only need the resource group, so they are provisioned in parallel.
+NEW_AGENT_STEPS = [
+    Step('create_resource_group', create_resource_group, timeout=300, retries=3),
+    Step('create_budget', create_budget, depends_on=['create_resource_group'], timeout=300, retries=3),
+    Step('create_workspace', create_workspace, depends_on=['create_resource_group'], timeout=1800, retries=1),
+    Step('create_openai_account', create_openai_account, depends_on=['create_resource_group'], timeout=1800, retries=1),
+    Step('deploy_model', deploy_model, depends_on=['create_openai_account'], timeout=3600, retries=1),
+]
@@ -0,0 +1,227 @@
+import asyncio
+import math
+import os
+import threading
+import time
+
+from costs import as_utc
+
+# Azure OpenAI Standard deployments get 1,000 tokens/min and 6 requests/min per unit of capacity
+TOKENS_PER_CAPACITY_UNIT = 1000
+REQUESTS_PER_CAPACITY_UNIT = 6
+
+# What an over-budget agent gets: 'reject' refuses new completions, 'degrade' answers
+# them ungrounded with a capped reply length, and 'allow' only reports it
+OVER_BUDGET_POLICIES = ('reject', 'degrade', 'allow')
+
+class RateLimitExceeded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """
+    Refills continuously at per_minute/60 units a second up to per_minute units.
+    The level may go negative when a request turns out to use more than it reserved,
+    which delays the next requests instead of letting the deployment answer with 429.
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        # a request larger than the bucket waits for a full bucket instead of forever
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        self._refill(time.monotonic())
+        self.level -= amount
+
+    def give(self, amount):
+        self._refill(time.monotonic())
+        self.level = min(self.capacity, self.level + amount)
+
+class AgentLimiter:
+    """
+    Requests/min and tokens/min buckets of one agent's deployment. Requests that
+    cannot be admitted yet wait in arrival order; the queue holds at most max_queue
+    requests and none waits longer than max_wait seconds.
+    """
+    def __init__(self, rpm, tpm, max_queue, max_wait):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # asyncio.Lock wakes its waiters first in, first out
+        self._turn = asyncio.Lock()
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.waited = 0.0
+
+    def wait_time(self, tokens):
+        now = time.monotonic()
+        return max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def _reject(self, message, tokens):
+        self.rejected += 1
+        raise RateLimitExceeded(message, max(1, math.ceil(self.wait_time(tokens))))
+
+    async def acquire(self, tokens):
+        """
+        Waits until the request and its reserved tokens fit in both buckets, then takes them.
+        :param tokens: Tokens reserved for the request, settled once its usage is known
+        :raises RateLimitExceeded: The wait queue is full or the wait would exceed max_wait
+        """
+        if self.waiting >= self.max_queue:
+            self._reject("Too many chat requests are waiting for this agent.", tokens)
+
+        arrived = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._turn:
+                while (wait := self.wait_time(tokens)) > 0:
+                    if time.monotonic() + wait - arrived > self.max_wait:
+                        self._reject("The agent's chat rate limit is exhausted.", tokens)
+                    await asyncio.sleep(wait)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+                self.admitted += 1
+                self.waited += time.monotonic() - arrived
+        finally:
+            self.waiting -= 1
+
+    def settle(self, reserved, used):
+        # the reservation is corrected with the tokens the reply actually used
+        if used < reserved:
+            self.tokens.give(reserved - used)
+        elif used > reserved:
+            self.tokens.take(used - reserved)
+
+    def stats(self):
+        now = time.monotonic()
+        self.requests._refill(now)
+        self.tokens._refill(now)
+        return {
+            'requests_per_minute': self.rpm,
+            'tokens_per_minute': self.tpm,
+            'available_requests': round(self.requests.level, 2),
+            'available_tokens': round(self.tokens.level, 2),
+            'waiting': self.waiting,
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'average_wait_seconds': round(self.waited / self.admitted, 3) if self.admitted else 0.0
+        }
+
+class RateLimiter:
+    """
+    Per-agent rate limits and budget admission for chat completions.
+    Limits default to the capacity the deployments are provisioned with and can be
+    overridden per agent. Budget checks use the agent's cached spend snapshot plus
+    the estimated cost of the completions served since that snapshot was taken, so
+    admission never calls the Consumption API.
+    State is held per process.
+    :param rpm: Default requests per minute of an agent
+    :param tpm: Default tokens per minute of an agent
+    :param max_queue: Requests that may wait for an agent's limit at the same time
+    :param max_wait: Seconds a request may wait before it is rejected
+    :param completion_tokens: Tokens reserved for a reply until its usage is known
+    :param over_budget: One of OVER_BUDGET_POLICIES
+    :param prompt_price: Price per 1,000 prompt tokens, for the estimated spend
+    :param completion_price: Price per 1,000 completion tokens, for the estimated spend
+    """
+    def __init__(self, rpm, tpm, max_queue=20, max_wait=30.0, completion_tokens=256, over_budget='reject',
+                 prompt_price=0.0005, completion_price=0.0015):
+        if over_budget not in OVER_BUDGET_POLICIES:
+            raise ValueError(f"over_budget must be one of {', '.join(OVER_BUDGET_POLICIES)}.")
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.completion_tokens = completion_tokens
+        self.over_budget = over_budget
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self._limiters = {}
+        # agent id -> [snapshot time the estimate started from, estimated spend since then]
+        self._estimated = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, agent_id, rpm=None, tpm=None):
+        rpm, tpm = rpm or self.rpm, tpm or self.tpm
+        with self._lock:
+            limiter = self._limiters.get(agent_id)
+            # rebuilt when the agent's limits change
+            if limiter is None or (limiter.rpm, limiter.tpm) != (rpm, tpm):
+                limiter = self._limiters[agent_id] = AgentLimiter(rpm, tpm, self.max_queue, self.max_wait)
+            return limiter
+
+    def forget(self, agent_id):
+        with self._lock:
+            self._limiters.pop(agent_id, None)
+            self._estimated.pop(agent_id, None)
+
+    def record_spend(self, agent_id, prompt_tokens, completion_tokens):
+        cost = (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1000
+        with self._lock:
+            self._estimated.setdefault(agent_id, [None, 0.0])[1] += cost
+
+    def spend(self, agent_id, snapshot_amount, snapshot_time):
+        """
+        Cached spend of an agent: the snapshot amount plus the estimated cost of the
+        completions since the snapshot. A newer snapshot restarts the estimate.
+        """
+        snapshot_time = as_utc(snapshot_time)
+        with self._lock:
+            estimate = self._estimated.setdefault(agent_id, [snapshot_time, 0.0])
+            if snapshot_time is not None and (estimate[0] is None or snapshot_time > estimate[0]):
+                estimate[0], estimate[1] = snapshot_time, 0.0
+            return (snapshot_amount or 0.0) + estimate[1]
+
+    def over(self, agent_id, budget, snapshot_amount, snapshot_time):
+        # agents without a budget are never limited by it
+        return bool(budget) and self.spend(agent_id, snapshot_amount, snapshot_time) >= budget
+
+    def stats(self, agent_id=None):
+        with self._lock:
+            limiters = dict(self._limiters)
+            estimated = {key: value[1] for key, value in self._estimated.items()}
+        if agent_id is not None:
+            limiter = limiters.get(agent_id)
+            return {
+                **(limiter.stats() if limiter else {'requests_per_minute': None, 'tokens_per_minute': None}),
+                'estimated_spend_since_snapshot': round(estimated.get(agent_id, 0.0), 6)
+            }
+        return {
+            'default_requests_per_minute': self.rpm,
+            'default_tokens_per_minute': self.tpm,
+            'over_budget_policy': self.over_budget,
+            'agents': {agent_id: limiter.stats() for agent_id, limiter in limiters.items()}
+        }
+
+def rate_limiter_from_env(capacity, prompt_price, completion_price):
+    """
+    Builds the RateLimiter from environment variables, with limits derived from the
+    deployment capacity unless CHAT_RATE_LIMIT_RPM / CHAT_RATE_LIMIT_TPM are set.
+    """
+    return RateLimiter(
+        rpm=int(os.getenv("CHAT_RATE_LIMIT_RPM", str(capacity * REQUESTS_PER_CAPACITY_UNIT))),
+        tpm=int(os.getenv("CHAT_RATE_LIMIT_TPM", str(capacity * TOKENS_PER_CAPACITY_UNIT))),
+        max_queue=int(os.getenv("CHAT_RATE_LIMIT_QUEUE", "20")),
+        max_wait=float(os.getenv("CHAT_RATE_LIMIT_MAX_WAIT", "30")),
+        completion_tokens=int(os.getenv("CHAT_RATE_LIMIT_COMPLETION_TOKENS", "256")),
+        over_budget=os.getenv("CHAT_OVER_BUDGET", "reject"),
+        prompt_price=prompt_price,
+        completion_price=completion_price
+    )
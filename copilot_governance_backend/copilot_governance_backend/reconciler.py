@@ -0,0 +1,307 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from azure.core.exceptions import ResourceNotFoundError
+from sqlalchemy import func, insert, select, update
+
+from jobs import UNFINISHED
+from models import AGENT_DELETING, AGENT_DEGRADED, AGENT_MISSING, Agent, AgentReconciliation, Job
+
+# Every agent resource group is created with the tag type=agent, see provisioning.create_resource_group
+AGENT_TAG_FILTER = "tagName eq 'type' and tagValue eq 'agent'"
+OPENAI_ACCOUNT_TYPE = 'Microsoft.CognitiveServices/accounts'
+WORKSPACE_TYPE = 'Microsoft.MachineLearningServices/workspaces'
+
+# Drift kinds, the first two mean the agent is missing in Azure, the others that it is degraded
+RESOURCE_GROUP_MISSING = 'resource_group_missing'
+RESOURCE_GROUP_DELETING = 'resource_group_deleting'
+WORKSPACE_MISSING = 'workspace_missing'
+OPENAI_ACCOUNT_MISSING = 'openai_account_missing'
+DEPLOYMENT_MISSING = 'deployment_missing'
+DEPLOYMENT_FAILED = 'deployment_failed'
+
+MISSING_DRIFT = (RESOURCE_GROUP_MISSING, RESOURCE_GROUP_DELETING)
+DRIFT_STATUSES = (AGENT_MISSING, AGENT_DEGRADED)
+
+# deployment state recorded when the deployment was not found
+DEPLOYMENT_NOT_FOUND = 'NotFound'
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+def as_utc(value):
+    # SQLite hands DateTime columns back without a timezone
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+def resource_keys(resources):
+    # (resource group, name) of each listed resource, lower-cased as Azure names are case-insensitive
+    keys = set()
+    for resource in resources:
+        parts = resource.id.split('/')
+        resource_group_name = parts[parts.index('resourceGroups') + 1]
+        keys.add((resource_group_name.lower(), resource.name.lower()))
+    return keys
+
+def openai_account_name(agent_id):
+    return f'agent{agent_id}openai'
+
+def deployment_name(agent_id):
+    return f"gpt-3-deployment-agent{agent_id}"
+
+def workspace_name(agent_id):
+    return f"project-agent{agent_id}"
+
+class AzureInventory:
+    """
+    The agent resource groups, OpenAI accounts and AI Foundry workspaces of the
+    subscription, listed with one call per resource type.
+    """
+    def __init__(self, clients):
+        resource_client = clients.resource_client
+        self.resource_groups = {group.name.lower(): group for group in resource_client.resource_groups.list(filter=AGENT_TAG_FILTER)}
+        self.openai_accounts = resource_keys(resource_client.resources.list(filter=f"resourceType eq '{OPENAI_ACCOUNT_TYPE}'"))
+        self.workspaces = resource_keys(resource_client.resources.list(filter=f"resourceType eq '{WORKSPACE_TYPE}'"))
+
+    def resource_group_state(self, name):
+        group = self.resource_groups.get(name.lower())
+        if group is None:
+            return None
+        properties = getattr(group, 'properties', None)
+        return getattr(properties, 'provisioning_state', None) or 'Succeeded'
+
+class Reconciler:
+    """
+    Compares the agent rows with their Azure resources on a schedule and records the drift,
+    so a manually deleted resource group or a failed deployment shows up before a request fails.
+    Each run lists the tagged resource groups, OpenAI accounts and workspaces once, then walks
+    the agents in batches of batch_size, each compared and written in one transaction.
+    Only the deployment state needs a call per agent: it is checked for at most
+    deployment_check_limit agents per run, those checked longest ago first.
+    Agents that drift are set to 'Missing in Azure' or 'Degraded' and get their previous
+    status back once Azure matches again. Agents with an unfinished job are skipped.
+    :param session_factory: Callable returning a new SQLAlchemy session
+    :param clients: Azure clients (real or fake) providing resource_client and cognitive_client
+    :param interval: Seconds between two runs
+    :param batch_size: Agents compared per transaction
+    :param max_workers: Deployment checks made at the same time
+    :param deployment_check_after: Seconds before the deployment of an agent is checked again
+    :param deployment_check_limit: Most deployment checks made per run
+    """
+    def __init__(self, session_factory, clients, interval=600, batch_size=500, max_workers=4, deployment_check_after=3600, deployment_check_limit=200):
+        self.session_factory = session_factory
+        self.clients = clients
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.deployment_check_after = deployment_check_after
+        self.deployment_check_limit = deployment_check_limit
+        self.last_run = None
+        self.last_error = None
+        self.orphaned_resource_groups = []
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def run(self):
+        """
+        Reconciles every agent once. Returns the stats of the run, or None when a run
+        is already in progress.
+        """
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        try:
+            started_at = utcnow()
+            inventory = AzureInventory(self.clients)
+            stats = {'agents': 0, 'skipped': 0, 'drifted': 0, 'status_updates': 0, 'deployment_checks': 0}
+            seen = set()
+
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="reconciler") as executor:
+                # keyset batches, so memory and transaction size do not grow with the number of agents
+                after = 0
+                while True:
+                    db = self.session_factory()
+                    try:
+                        agents = db.query(Agent.id, Agent.name, Agent.status).filter(Agent.id > after).order_by(Agent.id).limit(self.batch_size).all()
+                        if not agents:
+                            break
+                        seen.update(agent.name.lower() for agent in agents)
+                        self._reconcile_batch(db, agents, inventory, executor, stats, started_at)
+                        after = agents[-1].id
+                    finally:
+                        db.close()
+
+            # tagged resource groups no agent row points to
+            self.orphaned_resource_groups = sorted(group.name for name, group in inventory.resource_groups.items() if name not in seen)
+            self.last_run = {
+                **stats,
+                'orphaned_resource_groups': len(self.orphaned_resource_groups),
+                'started_at': started_at,
+                'finished_at': utcnow()
+            }
+            self.last_error = None
+            return self.last_run
+        finally:
+            self._run_lock.release()
+
+    def _reconcile_batch(self, db, agents, inventory, executor, stats, now):
+        agent_ids = [agent.id for agent in agents]
+        states = {row.agent_id: row for row in db.query(AgentReconciliation).filter(AgentReconciliation.agent_id.in_(agent_ids))}
+        # agents being provisioned or deleted are in flux, they are checked on a later run
+        busy = {row.agent_id for row in db.query(Job.agent_id).filter(Job.agent_id.in_(agent_ids), Job.kind.in_(('new_agent', 'delete_agent')), Job.status.in_(UNFINISHED))}
+
+        candidates = []
+        for agent in agents:
+            if agent.status == AGENT_DELETING or agent.id in busy:
+                stats['skipped'] += 1
+                continue
+            candidates.append(agent)
+
+        deployments = self._check_deployments(candidates, states, inventory, executor, stats, now)
+
+        inserts, updates, restored = [], [], []
+        drifted = {AGENT_MISSING: [], AGENT_DEGRADED: []}
+        for agent in candidates:
+            state = states.get(agent.id)
+            deployment_state, deployment_checked_at = deployments.get(
+                agent.id, (state.deployment_state, state.deployment_checked_at) if state else (None, None)
+            )
+            drift = self.drift(agent, inventory, deployment_state)
+
+            previous_status = state.previous_status if state else None
+            if drift:
+                target = AGENT_MISSING if any(kind in MISSING_DRIFT for kind in drift) else AGENT_DEGRADED
+                if agent.status not in DRIFT_STATUSES:
+                    previous_status = agent.status
+                if agent.status != target:
+                    drifted[target].append(agent.id)
+                stats['drifted'] += 1
+            elif agent.status in DRIFT_STATUSES:
+                restored.append(agent.id)
+                previous_status = None
+
+            values = {
+                'drift': json.dumps(drift),
+                'drifted': bool(drift),
+                'previous_status': previous_status,
+                'checked_at': now,
+                'deployment_state': deployment_state,
+                'deployment_checked_at': deployment_checked_at
+            }
+            if state is None:
+                inserts.append({'agent_id': agent.id, **values})
+            else:
+                updates.append({'id': state.id, **values})
+
+        # the previous statuses are restored before the rows holding them are updated,
+        # and a deletion started meanwhile is never overwritten
+        if restored:
+            previous = select(AgentReconciliation.previous_status).where(AgentReconciliation.agent_id == Agent.id).scalar_subquery()
+            stats['status_updates'] += db.execute(
+                update(Agent).where(Agent.id.in_(restored), Agent.status.in_(DRIFT_STATUSES)).values(status=func.coalesce(previous, Agent.status))
+            ).rowcount
+        if inserts:
+            # a Core insert keeps the None values, so every row goes in the same executemany
+            db.execute(insert(AgentReconciliation.__table__), inserts)
+        if updates:
+            db.execute(update(AgentReconciliation), updates)
+        for status, ids in drifted.items():
+            if ids:
+                stats['status_updates'] += db.execute(
+                    update(Agent).where(Agent.id.in_(ids), Agent.status != AGENT_DELETING).values(status=status)
+                ).rowcount
+        db.commit()
+        stats['agents'] += len(candidates)
+
+    def _check_deployments(self, agents, states, inventory, executor, stats, now):
+        # deployments never checked come first, then the ones checked longest ago
+        due = []
+        for agent in agents:
+            if (agent.name.lower(), openai_account_name(agent.id)) not in inventory.openai_accounts:
+                continue
+            state = states.get(agent.id)
+            checked_at = as_utc(state.deployment_checked_at) if state else None
+            if checked_at is None or (now - checked_at).total_seconds() > self.deployment_check_after:
+                due.append((checked_at or datetime.min.replace(tzinfo=timezone.utc), agent))
+
+        remaining = self.deployment_check_limit - stats['deployment_checks']
+        due = [agent for _, agent in sorted(due, key=lambda item: (item[0], item[1].id))[:max(remaining, 0)]]
+        stats['deployment_checks'] += len(due)
+
+        checked = {}
+        for agent, deployment_state in zip(due, executor.map(self.fetch_deployment_state, due)):
+            # a failed call keeps the last known state, it is checked again on the next run
+            if deployment_state is not None:
+                checked[agent.id] = (deployment_state, now)
+        return checked
+
+    def fetch_deployment_state(self, agent):
+        try:
+            deployment = self.clients.cognitive_client.deployments.get(agent.name, openai_account_name(agent.id), deployment_name(agent.id))
+        except ResourceNotFoundError:
+            return DEPLOYMENT_NOT_FOUND
+        except Exception as e:
+            print(f"Warning: Failed to check the deployment of agent {agent.id}. Error: {e}")
+            return None
+        return deployment.properties.provisioning_state
+
+    def drift(self, agent, inventory, deployment_state):
+        resource_group_state = inventory.resource_group_state(agent.name)
+        if resource_group_state is None:
+            return [RESOURCE_GROUP_MISSING]
+        if resource_group_state == 'Deleting':
+            return [RESOURCE_GROUP_DELETING]
+
+        drift = []
+        resource_group_name = agent.name.lower()
+        if (resource_group_name, workspace_name(agent.id)) not in inventory.workspaces:
+            drift.append(WORKSPACE_MISSING)
+        if (resource_group_name, openai_account_name(agent.id)) not in inventory.openai_accounts:
+            drift.append(OPENAI_ACCOUNT_MISSING)
+        elif deployment_state == DEPLOYMENT_NOT_FOUND:
+            drift.append(DEPLOYMENT_MISSING)
+        elif deployment_state == 'Failed':
+            drift.append(DEPLOYMENT_FAILED)
+        return drift
+
+    def trigger(self):
+        # runs now instead of at the next interval, on the background thread when it is started
+        if self._thread is not None:
+            self._wake.set()
+        else:
+            threading.Thread(target=self._run_logged, name="reconciler-run", daemon=True).start()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="reconciler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run_logged(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"Warning: Reconciliation failed. Error: {e}")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._run_logged()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+def serialize_reconciliation(state):
+    return {
+        'drift': json.loads(state.drift) if state.drift else [],
+        'previous_status': state.previous_status,
+        'checked_at': state.checked_at,
+        'deployment_state': state.deployment_state,
+        'deployment_checked_at': state.deployment_checked_at
+    }
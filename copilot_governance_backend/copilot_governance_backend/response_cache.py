@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+def normalize_prompt(text):
+    # prompts differing only in case, spacing or unicode form share an entry
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def estimate_tokens(text):
+    # roughly four characters per token for English text
+    return max(1, len(text) // 4)
+
+class MemoryCacheBackend:
+    """
+    In-process LRU store.
+    :param max_entries: Maximum number of cached replies
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, agent_id, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, dict(value, agent_id=agent_id))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_agent(self, agent_id):
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items() if value['agent_id'] == agent_id]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskCacheBackend:
+    """
+    Local on-disk store in a SQLite file, so cached replies survive restarts and
+    are shared by the worker processes on one host.
+    :param path: Location of the SQLite file
+    :param max_entries: Maximum number of cached replies, least recently used are evicted first
+    """
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, agent_id INTEGER, value TEXT, expires_at REAL, accessed_at REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_responses_agent_id ON responses (agent_id)")
+
+    def _connection(self):
+        # one connection per thread, sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as connection:
+            row = connection.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def set(self, key, agent_id, value, ttl):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, agent_id, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, agent_id, json.dumps(value), now + ttl, now)
+            )
+
+            # expired entries go first, then the least recently used ones beyond max_entries
+            connection.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            connection.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def delete_agent(self, agent_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM responses WHERE agent_id = ?", (agent_id,))
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+class _AgentStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_spend = 0.0
+
+class ResponseCache:
+    """
+    Exact-match cache of chat replies, keyed on (agent_id, deployment, system prompt,
+    normalized user_input). Every hit is a completion that is not billed, so the
+    cache also reports the spend it saved per agent.
+    :param backend: MemoryCacheBackend, DiskCacheBackend or any object with the same methods
+    :param ttl: Seconds a reply stays cached
+    :param prompt_price: Price per 1,000 prompt tokens, used to report saved spend
+    :param completion_price: Price per 1,000 completion tokens, used to report saved spend
+    """
+    def __init__(self, backend, ttl=86400, prompt_price=0.0005, completion_price=0.0015):
+        self.backend = backend
+        self.ttl = ttl
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(agent_id, deployment_name, system_prompt, user_input):
+        raw = json.dumps([agent_id, deployment_name, system_prompt, normalize_prompt(user_input)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _agent_stats(self, agent_id):
+        stats = self._stats.get(agent_id)
+        if stats is None:
+            stats = self._stats.setdefault(agent_id, _AgentStats())
+        return stats
+
+    def lookup(self, agent_id, deployment_name, system_prompt, user_input):
+        value = self.backend.get(self.key(agent_id, deployment_name, system_prompt, user_input))
+
+        with self._lock:
+            stats = self._agent_stats(agent_id)
+            if value is None:
+                stats.misses += 1
+                return None
+
+            stats.hits += 1
+            stats.saved_tokens += value['prompt_tokens'] + value['completion_tokens']
+            stats.saved_spend += (value['prompt_tokens'] * self.prompt_price + value['completion_tokens'] * self.completion_price) / 1000
+        return value['assistant_reply']
+
+    def store(self, agent_id, deployment_name, system_prompt, user_input, assistant_reply, prompt_tokens=None, completion_tokens=None):
+        value = {
+            'assistant_reply': assistant_reply,
+            'prompt_tokens': prompt_tokens if prompt_tokens is not None else estimate_tokens(system_prompt + user_input),
+            'completion_tokens': completion_tokens if completion_tokens is not None else estimate_tokens(assistant_reply)
+        }
+        self.backend.set(self.key(agent_id, deployment_name, system_prompt, user_input), agent_id, value, self.ttl)
+
+    def invalidate_agent(self, agent_id):
+        self.backend.delete_agent(agent_id)
+        with self._lock:
+            self._stats.pop(agent_id, None)
+
+    def stats(self, agent_id):
+        with self._lock:
+            stats = self._agent_stats(agent_id)
+            lookups = stats.hits + stats.misses
+            return {
+                'hits': stats.hits,
+                'misses': stats.misses,
+                'hit_rate': stats.hits / lookups if lookups else 0.0,
+                'saved_tokens': stats.saved_tokens,
+                'saved_spend': round(stats.saved_spend, 6)
+            }
+
+def response_cache_from_env():
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+    max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+
+    if os.getenv("RESPONSE_CACHE_BACKEND", "memory") == "disk":
+        backend = DiskCacheBackend(os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3"), max_entries=max_entries)
+    else:
+        backend = MemoryCacheBackend(max_entries=max_entries)
+
+    return ResponseCache(
+        backend,
+        ttl=ttl,
+        prompt_price=float(os.getenv("OPENAI_PROMPT_PRICE_PER_1K", "0.0005")),
+        completion_price=float(os.getenv("OPENAI_COMPLETION_PRICE_PER_1K", "0.0015"))
+    )
@@ -0,0 +1,367 @@
+import array
+import heapq
+import io
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from response_cache import estimate_tokens
+
+# NumPy is only needed for the optional vector index
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# pypdf is only needed to index PDF knowledge sources
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+_WORD = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+_SUFFIXES = ('ations', 'ation', 'ings', 'ions', 'ing', 'ion', 'ies', 'ed', 'es', 'ly', 's')
+
+def stem(word):
+    # light suffix stripping, so 'passwords' matches 'password' and 'rotated' matches 'rotation'
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3 and not word.endswith('ss'):
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text):
+    return [stem(word) for word in _WORD.findall(text.casefold()) if word not in STOPWORDS]
+
+def extract_text(data, filename=None):
+    """
+    Returns the text of a knowledge source, or None when its format cannot be indexed.
+    """
+    if data[:5] == b"%PDF-":
+        if PdfReader is None:
+            print(f"Warning: pypdf is not installed, {filename} is not indexed.")
+            return None
+        return "\n".join(page.extract_text() or "" for page in PdfReader(io.BytesIO(data)).pages)
+
+    # anything else that decodes as UTF-8 text is indexed as is
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return None
+
+def chunk_text(text, passage_tokens=200, overlap=40):
+    """
+    Splits text into overlapping passages of about passage_tokens words,
+    keeping the original text (punctuation and spacing) of each passage.
+    At most half of a passage overlaps the next one.
+    """
+    spans = [match.span() for match in _WORD.finditer(text)]
+    step = max(1, passage_tokens - min(overlap, passage_tokens // 2))
+    for start in range(0, len(spans), step):
+        window = spans[start:start + passage_tokens]
+        yield text[window[0][0]:window[-1][1]]
+        if start + passage_tokens >= len(spans):
+            return
+
+def _column(path, typecode):
+    # read-only memory map of a binary column, viewed as an array of its type
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'').cast(typecode)
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+def write_segment(path, passages, vectors=None):
+    """
+    Writes the index of one knowledge source:
+        meta.json       passage count, total length and vector size
+        text.bin        passages as UTF-8, one after the other
+        offsets.q       start of each passage in text.bin (plus the end)
+        lengths.i       token count of each passage
+        vocab.json      term -> [first posting, posting count]
+        postings.i      passage number of each posting, grouped by term
+        frequencies.i   term frequency of each posting
+        vectors.f       optional float32 embeddings, one row per passage
+    The segment is built next to its final place and moved there in one step.
+    """
+    tmp = f"{path}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    offsets, lengths = array.array('q', [0]), array.array('i')
+    postings_by_term = {}
+    with open(os.path.join(tmp, 'text.bin'), 'wb') as text_file:
+        for number, passage in enumerate(passages):
+            encoded = passage.encode()
+            text_file.write(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+
+            terms = Counter(tokenize(passage))
+            lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                postings_by_term.setdefault(term, []).append((number, frequency))
+
+    vocab, postings, frequencies = {}, array.array('i'), array.array('i')
+    for term in sorted(postings_by_term):
+        vocab[term] = [len(postings), len(postings_by_term[term])]
+        for number, frequency in postings_by_term[term]:
+            postings.append(number)
+            frequencies.append(frequency)
+
+    for name, column in (('offsets.q', offsets), ('lengths.i', lengths), ('postings.i', postings), ('frequencies.i', frequencies)):
+        with open(os.path.join(tmp, name), 'wb') as f:
+            column.tofile(f)
+    with open(os.path.join(tmp, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+
+    dimensions = None
+    if vectors is not None and len(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # rows are normalised so a dot product is the cosine similarity
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        vectors.tofile(os.path.join(tmp, 'vectors.f'))
+        dimensions = vectors.shape[1]
+
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'passages': len(lengths), 'total_length': sum(lengths), 'dimensions': dimensions}, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+class Segment:
+    """
+    Memory-mapped index of one knowledge source, see write_segment.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        with open(os.path.join(path, 'vocab.json')) as f:
+            self.vocab = json.load(f)
+
+        self.passages = meta['passages']
+        self.total_length = meta['total_length']
+        self.offsets = _column(os.path.join(path, 'offsets.q'), 'q')
+        self.lengths = _column(os.path.join(path, 'lengths.i'), 'i')
+        self.postings = _column(os.path.join(path, 'postings.i'), 'i')
+        self.frequencies = _column(os.path.join(path, 'frequencies.i'), 'i')
+        with open(os.path.join(path, 'text.bin'), 'rb') as f:
+            self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+        self.vectors = None
+        if meta['dimensions'] and np is not None:
+            self.vectors = np.memmap(os.path.join(path, 'vectors.f'), dtype=np.float32, mode='r', shape=(self.passages, meta['dimensions']))
+
+    def passage(self, number):
+        return self.text[self.offsets[number]:self.offsets[number + 1]].decode()
+
+    def term_postings(self, term):
+        start, count = self.vocab.get(term, (0, 0))
+        return self.postings[start:start + count], self.frequencies[start:start + count]
+
+class OpenAIEmbedder:
+    """
+    Embeds texts in batches with an Azure OpenAI embedding deployment.
+    :param client: AzureOpenAI client
+    :param deployment: Name of the embedding model deployment
+    :param batch_size: Texts sent per embeddings request
+    """
+    def __init__(self, client, deployment, batch_size=64):
+        self.client = client
+        self.deployment = deployment
+        self.batch_size = batch_size
+
+    def __call__(self, texts):
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self.client.embeddings.create(model=self.deployment, input=texts[start:start + self.batch_size])
+            rows.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        return np.asarray(rows, dtype=np.float32)
+
+class RetrievalIndex:
+    """
+    Search index over approved knowledge sources. Every knowledge source has its own
+    memory-mapped segment (its passages, an inverted index and optional embeddings),
+    so a source shared by several agents is indexed once, adding or removing a source
+    never touches the others, and a restart only maps the files again.
+    An agent's search runs BM25 over the segments of its sources, with corpus
+    statistics summed across them, optionally blended with vector similarity.
+    :param directory: Root directory, holding one segment directory per knowledge source
+    :param passage_tokens: Words per passage
+    :param overlap: Words shared by consecutive passages, a fifth of a passage when omitted
+    :param embedder: Optional callable turning a list of texts into an (n, dimensions) array, needs NumPy
+    :param vector_weight: Share of the vector similarity in the blended score
+    :param max_open: Segments kept mapped at the same time
+    """
+    def __init__(self, directory, passage_tokens=200, overlap=None, embedder=None, vector_weight=0.5, max_workers=2, max_open=512):
+        if embedder is not None and np is None:
+            print("Warning: NumPy is not installed, the vector index is disabled.")
+            embedder = None
+
+        self.directory = directory
+        self.passage_tokens = passage_tokens
+        self.overlap = overlap if overlap is not None else passage_tokens // 5
+        self.embedder = embedder
+        self.vector_weight = vector_weight
+        self.max_open = max_open
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval-index")
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, source_id):
+        return os.path.join(self.directory, str(source_id))
+
+    def has(self, source_id):
+        return os.path.exists(os.path.join(self._path(source_id), 'meta.json'))
+
+    def indexed_ids(self):
+        return {int(name) for name in os.listdir(self.directory) if name.isdigit() and self.has(int(name))}
+
+    def _segment(self, source_id):
+        with self._lock:
+            segment = self._segments.get(source_id)
+            if segment is not None:
+                self._segments.move_to_end(source_id)
+                return segment
+
+        if not self.has(source_id):
+            return None
+        segment = Segment(self._path(source_id))
+
+        # Evicted segments are not closed here: a concurrent search may still be
+        # reading them, their maps are released once they are garbage collected.
+        with self._lock:
+            self._segments[source_id] = segment
+            while len(self._segments) > self.max_open:
+                self._segments.popitem(last=False)
+        return segment
+
+    def build(self, source_id, data, filename=None):
+        """
+        Indexes the content of a knowledge source, replacing any previous segment.
+        Returns the number of passages, or None when the format cannot be indexed.
+        """
+        text = extract_text(data, filename)
+        if text is None:
+            return None
+
+        passages = list(chunk_text(text, self.passage_tokens, self.overlap))
+        vectors = self.embedder(passages) if self.embedder is not None and passages else None
+        write_segment(self._path(source_id), passages, vectors)
+        with self._lock:
+            self._segments.pop(source_id, None)
+        return len(passages)
+
+    def remove(self, source_id):
+        with self._lock:
+            self._segments.pop(source_id, None)
+        shutil.rmtree(self._path(source_id), ignore_errors=True)
+
+    def schedule(self, source_id, loader):
+        """
+        Indexes a knowledge source in the background.
+        :param loader: Callable returning (data, filename) of the source, or None when it is gone
+        """
+        with self._lock:
+            if source_id in self._pending:
+                return
+            self._pending.add(source_id)
+
+        def run():
+            try:
+                loaded = loader()
+                if loaded is None:
+                    return
+                passages = self.build(source_id, *loaded)
+                print(f"Indexed knowledge source {source_id}: {passages if passages is not None else 'unsupported format, no'} passages.")
+            except Exception as e:
+                print(f"Warning: Failed to index knowledge source {source_id}. Error: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(source_id)
+
+        self._executor.submit(run)
+
+    def search(self, source_ids, query, k=5, token_budget=1000):
+        """
+        Returns the best passages of the given knowledge sources for a query, best first,
+        at most k of them and no more than token_budget tokens in total.
+        Each result is a dict with knowledge_source_id, passage and score.
+        """
+        segments = [(source_id, segment) for source_id in source_ids if (segment := self._segment(source_id)) is not None]
+        terms = set(tokenize(query))
+        if not segments or not terms:
+            return []
+
+        # corpus statistics of the agent's sources taken together
+        passages = sum(segment.passages for _, segment in segments)
+        average_length = sum(segment.total_length for _, segment in segments) / max(passages, 1)
+        document_frequency = Counter()
+        for _, segment in segments:
+            for term in terms:
+                if term in segment.vocab:
+                    document_frequency[term] += segment.vocab[term][1]
+
+        scores = {}
+        for source_id, segment in segments:
+            for term in terms:
+                if not document_frequency[term]:
+                    continue
+                idf = math.log(1 + (passages - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                numbers, frequencies = segment.term_postings(term)
+                for number, frequency in zip(numbers, frequencies):
+                    length_norm = K1 * (1 - B + B * segment.lengths[number] / average_length)
+                    key = (source_id, number)
+                    scores[key] = scores.get(key, 0.0) + idf * frequency * (K1 + 1) / (frequency + length_norm)
+
+        if self.embedder is not None and all(segment.vectors is not None for _, segment in segments):
+            scores = self._blend(scores, segments, query)
+
+        results, seen, used = [], set(), 0
+        for (source_id, number), score in heapq.nlargest(k * 4, scores.items(), key=lambda item: item[1]):
+            passage = self._segment(source_id).passage(number)
+            tokens = estimate_tokens(passage)
+            # repeated boilerplate would otherwise fill the budget with the same text
+            if passage in seen or used + tokens > token_budget:
+                continue
+            seen.add(passage)
+            used += tokens
+            results.append({'knowledge_source_id': source_id, 'passage': passage, 'score': round(score, 4)})
+            if len(results) == k:
+                break
+        return results
+
+    def _blend(self, scores, segments, query):
+        # BM25 scores are scaled to 0..1 and mixed with the cosine similarity of every passage
+        query_vector = np.asarray(self.embedder([query])[0], dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        top_bm25 = max(scores.values(), default=0.0) or 1.0
+
+        blended = {}
+        for source_id, segment in segments:
+            similarities = segment.vectors @ query_vector
+            for number in np.argsort(similarities)[::-1][:50]:
+                blended[(source_id, int(number))] = self.vector_weight * float(similarities[number])
+        for key, score in scores.items():
+            blended[key] = blended.get(key, 0.0) + (1 - self.vector_weight) * score / top_bm25
+        return blended
+
+    def stats(self):
+        with self._lock:
+            return {'open_segments': len(self._segments), 'pending': len(self._pending)}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
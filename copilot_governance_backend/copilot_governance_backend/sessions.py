@@ -0,0 +1,284 @@
+import asyncio
+import json
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from sqlalchemy import func
+
+from models import ChatSession
+from response_cache import estimate_tokens
+
+SUMMARY_PROMPT = (
+    "Summarise the conversation below for the assistant that continues it. Keep names, numbers, "
+    "decisions and open questions, drop pleasantries. Answer with the summary only."
+)
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+class SessionState:
+    """
+    In-memory state of one chat session. Turns are kept as compact
+    [role, content, tokens] lists, 'u' for the user and 'a' for the assistant.
+    """
+    __slots__ = ('id', 'agent_id', 'summary', 'turns', 'prompt_tokens', 'completion_tokens',
+                 'estimated_spend', 'created_at', 'updated_at', 'dirty', 'lock')
+
+    def __init__(self, id, agent_id, summary=None, turns=None, prompt_tokens=0, completion_tokens=0,
+                 estimated_spend=0.0, created_at=None, updated_at=None):
+        self.id = id
+        self.agent_id = agent_id
+        self.summary = summary
+        self.turns = turns or []
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.estimated_spend = estimated_spend
+        self.created_at = created_at or utcnow()
+        self.updated_at = updated_at or self.created_at
+        self.dirty = False
+        # one turn of a session at a time, so concurrent requests cannot interleave its history
+        self.lock = asyncio.Lock()
+
+    def history_tokens(self):
+        return sum(tokens for _, _, tokens in self.turns)
+
+    def messages(self, system_prompt, user_input, context_budget):
+        """
+        Builds the chat messages of the next turn: the system prompt, the summary of older
+        turns, then as many of the most recent turns as fit in context_budget tokens.
+        """
+        messages = [{"role": "system", "content": system_prompt}]
+        used = estimate_tokens(system_prompt) + estimate_tokens(user_input)
+        if self.summary:
+            summary = f"Summary of the earlier conversation: {self.summary}"
+            messages.append({"role": "system", "content": summary})
+            used += estimate_tokens(summary)
+
+        # sliding window, newest turns first until the budget is spent
+        window = []
+        for role, content, tokens in reversed(self.turns):
+            if used + tokens > context_budget:
+                break
+            used += tokens
+            window.append({"role": "user" if role == 'u' else "assistant", "content": content})
+
+        messages.extend(reversed(window))
+        messages.append({"role": "user", "content": user_input})
+        return messages
+
+    def serialize(self):
+        return {
+            'session_id': self.id,
+            'agent_id': self.agent_id,
+            'summary': self.summary,
+            'turns': [{'role': "user" if role == 'u' else "assistant", 'content': content} for role, content, _ in self.turns],
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'estimated_spend': round(self.estimated_spend, 6),
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+class SessionStore:
+    """
+    Server-side chat sessions. Recently used sessions live in memory, the least recently
+    used ones beyond max_sessions are written to the chat_sessions table and dropped, and
+    are loaded again on their next turn. Dirty sessions are also written every
+    flush_interval seconds, so a restart loses at most that much history.
+    Sessions are held by the process that served them last, so several worker processes
+    need sticky routing per session.
+    :param session_factory: Callable returning a new SQLAlchemy session
+    :param max_sessions: Sessions kept in memory
+    :param context_budget: Tokens each chat request may use for the prompt, history included
+    :param history_budget: Tokens of stored turns above which the oldest ones are summarised
+    :param prompt_price: Price per 1,000 prompt tokens, for the estimated spend
+    :param completion_price: Price per 1,000 completion tokens, for the estimated spend
+    """
+    def __init__(self, session_factory, max_sessions=1000, context_budget=3000, history_budget=2000,
+                 flush_interval=30, prompt_price=0.0005, completion_price=0.0015):
+        self.session_factory = session_factory
+        self.max_sessions = max_sessions
+        self.context_budget = context_budget
+        self.history_budget = history_budget
+        self.flush_interval = flush_interval
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _remember(self, state):
+        with self._lock:
+            self._sessions[state.id] = state
+            self._sessions.move_to_end(state.id)
+            evicted = []
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+        # sessions leaving memory are spilled to the database
+        self._write([state for state in evicted if state.dirty])
+
+    def create(self, agent_id):
+        state = SessionState(uuid.uuid4().hex, agent_id)
+        state.dirty = True
+        self._write([state])
+        self._remember(state)
+        return state
+
+    def get(self, session_id):
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+                return state
+
+        db = self.session_factory()
+        try:
+            row = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+            if row is None:
+                return None
+            state = SessionState(
+                row.id, row.agent_id, row.summary, json.loads(row.turns or '[]'),
+                row.prompt_tokens or 0, row.completion_tokens or 0, row.estimated_spend or 0.0,
+                row.created_at, row.updated_at
+            )
+        finally:
+            db.close()
+
+        # a concurrent load of the same session keeps the first copy
+        with self._lock:
+            state = self._sessions.setdefault(session_id, state)
+        self._remember(state)
+        return state
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        db = self.session_factory()
+        try:
+            db.query(ChatSession).filter(ChatSession.id == session_id).delete()
+            db.commit()
+        finally:
+            db.close()
+
+    def delete_agent(self, db, agent_id):
+        # changes are left for the caller to commit
+        with self._lock:
+            for session_id in [session_id for session_id, state in self._sessions.items() if state.agent_id == agent_id]:
+                del self._sessions[session_id]
+        db.query(ChatSession).filter(ChatSession.agent_id == agent_id).delete(synchronize_session=False)
+
+    def spend(self, prompt_tokens, completion_tokens):
+        return (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1000
+
+    def account(self, state, prompt_tokens, completion_tokens):
+        state.prompt_tokens += prompt_tokens
+        state.completion_tokens += completion_tokens
+        state.estimated_spend += self.spend(prompt_tokens, completion_tokens)
+        state.updated_at = utcnow()
+        state.dirty = True
+
+    def record(self, state, user_input, assistant_reply, prompt_tokens, completion_tokens):
+        state.turns.append(['u', user_input, estimate_tokens(user_input)])
+        state.turns.append(['a', assistant_reply, estimate_tokens(assistant_reply)])
+        self.account(state, prompt_tokens, completion_tokens)
+
+    def needs_compaction(self, state):
+        return state.history_tokens() > self.history_budget
+
+    async def compact(self, state, summarize):
+        """
+        Folds the oldest turns into the session summary until the stored turns take at most
+        half of history_budget. When summarising fails they are dropped, which is what the
+        sliding window would have done anyway.
+        :param summarize: Coroutine function (previous_summary, messages) -> (summary, prompt_tokens, completion_tokens)
+        """
+        async with state.lock:
+            if not self.needs_compaction(state):
+                return
+
+            keep, kept_tokens = len(state.turns), 0
+            while keep > 0 and kept_tokens + state.turns[keep - 1][2] <= self.history_budget // 2:
+                keep -= 1
+                kept_tokens += state.turns[keep][2]
+            # the last exchange always stays, and turns leave in user/assistant pairs
+            keep = min(keep, len(state.turns) - 2)
+            keep -= keep % 2
+            if keep <= 0:
+                return
+            folded, state.turns = state.turns[:keep], state.turns[keep:]
+            state.dirty = True
+
+            try:
+                messages = [{"role": "user" if role == 'u' else "assistant", "content": content} for role, content, _ in folded]
+                summary, prompt_tokens, completion_tokens = await summarize(state.summary, messages)
+                state.summary = summary
+                self.account(state, prompt_tokens, completion_tokens)
+            except Exception as e:
+                print(f"Warning: Failed to summarise chat session {state.id}, {len(folded)} turns were dropped. Error: {e}")
+
+    def _write(self, states):
+        if not states:
+            return
+        db = self.session_factory()
+        try:
+            rows = {row.id: row for row in db.query(ChatSession).filter(ChatSession.id.in_([state.id for state in states]))}
+            for state in states:
+                row = rows.get(state.id)
+                if row is None:
+                    row = ChatSession(id=state.id, agent_id=state.agent_id, created_at=state.created_at)
+                    db.add(row)
+                row.summary = state.summary
+                row.turns = json.dumps(state.turns, separators=(',', ':'))
+                row.prompt_tokens = state.prompt_tokens
+                row.completion_tokens = state.completion_tokens
+                row.estimated_spend = state.estimated_spend
+                row.updated_at = state.updated_at
+            db.commit()
+            for state in states:
+                state.dirty = False
+        finally:
+            db.close()
+
+    def flush(self):
+        # every dirty session is written in one transaction
+        with self._lock:
+            dirty = [state for state in self._sessions.values() if state.dirty]
+        self._write(dirty)
+        return len(dirty)
+
+    def usage(self, db, agent_id):
+        """
+        Token usage and estimated spend of all the chat sessions of an agent.
+        """
+        self.flush()
+        prompt_tokens, completion_tokens, estimated_spend, sessions = db.query(
+            func.coalesce(func.sum(ChatSession.prompt_tokens), 0),
+            func.coalesce(func.sum(ChatSession.completion_tokens), 0),
+            func.coalesce(func.sum(ChatSession.estimated_spend), 0.0),
+            func.count(ChatSession.id)
+        ).filter(ChatSession.agent_id == agent_id).one()
+        return {
+            'sessions': sessions,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'estimated_spend': round(estimated_spend, 6)
+        }
+
+    def start(self):
+        if self._thread is None and self.flush_interval > 0:
+            self._thread = threading.Thread(target=self._loop, name="session-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Warning: Chat session flush failed. Error: {e}")
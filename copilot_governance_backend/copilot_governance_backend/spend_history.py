@@ -0,0 +1,248 @@
+import array
+import bisect
+import calendar
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Every series is stored column by column: one flat binary file per column,
+# holding fixed-width values (int64 'q' or float64 'd'). Appending a sample
+# writes a few bytes per column, and reads memory-map the files and bisect
+# the timestamp column, so a range query never loads a whole series.
+RAW_COLUMNS = (('ts', 'q'), ('value', 'd'))
+ROLLUP_COLUMNS = (('ts', 'q'), ('count', 'q'), ('sum', 'd'), ('min', 'd'), ('max', 'd'), ('last', 'd'))
+
+# Bucket width of each rollup in seconds (months have no fixed width)
+ROLLUPS = {'hour': 3600, 'day': 86400, 'month': None}
+STEPS = ('raw',) + tuple(ROLLUPS)
+
+def bucket_start(resolution, ts):
+    if resolution == 'month':
+        moment = datetime.fromtimestamp(ts, timezone.utc)
+        return calendar.timegm((moment.year, moment.month, 1, 0, 0, 0))
+    return ts - ts % ROLLUPS[resolution]
+
+def choose_step(start, end):
+    # the finest resolution that keeps a chart to a few thousand points
+    span = end - start
+    if span <= 2 * 86400:
+        return 'raw'
+    if span <= 90 * 86400:
+        return 'hour'
+    if span <= 5 * 366 * 86400:
+        return 'day'
+    return 'month'
+
+def _last_value(path, typecode):
+    size = struct.calcsize(typecode)
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < size:
+                return None
+            f.seek(-size, os.SEEK_END)
+            return struct.unpack(typecode, f.read(size))[0]
+    except FileNotFoundError:
+        return None
+
+def _append(path, typecode, value):
+    with open(path, 'ab') as f:
+        f.write(struct.pack(typecode, value))
+
+def _overwrite_last(path, typecode, value):
+    with open(path, 'r+b') as f:
+        f.seek(-struct.calcsize(typecode), os.SEEK_END)
+        f.write(struct.pack(typecode, value))
+
+@contextmanager
+def _mapped(path, typecode):
+    # read-only memory map of a column, viewed as an array of its type
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        yield memoryview(b'').cast(typecode)
+        return
+
+    with f:
+        usable = os.fstat(f.fileno()).st_size // struct.calcsize(typecode) * struct.calcsize(typecode)
+        if usable == 0:
+            yield memoryview(b'').cast(typecode)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)[:usable].cast(typecode)
+            try:
+                yield view
+            finally:
+                view.release()
+
+class SpendHistoryStore:
+    """
+    Compact local time-series store of per-agent spend samples, with hourly,
+    daily and monthly rollups kept up to date as samples arrive.
+    :param directory: Root directory, holding one sub-directory per agent
+    :param raw_retention: Seconds raw samples are kept for
+    :param hour_retention: Seconds hourly rollups are kept for (daily and monthly ones are kept forever)
+    """
+    def __init__(self, directory, raw_retention=7 * 86400, hour_retention=400 * 86400):
+        self.directory = directory
+        self.retention = {'raw': raw_retention, 'hour': hour_retention}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._last_compaction = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _lock(self, agent_id):
+        with self._locks_lock:
+            return self._locks.setdefault(agent_id, threading.Lock())
+
+    def _path(self, agent_id, resolution, column):
+        return os.path.join(self.directory, str(agent_id), f"{resolution}.{column}")
+
+    def _columns(self, resolution):
+        return RAW_COLUMNS if resolution == 'raw' else ROLLUP_COLUMNS
+
+    def add_sample(self, agent_id, value, ts=None):
+        ts = int(ts if ts is not None else time.time())
+        with self._lock(agent_id):
+            os.makedirs(os.path.join(self.directory, str(agent_id)), exist_ok=True)
+
+            # samples older than the newest one are dropped, every series is append-only
+            last_ts = _last_value(self._path(agent_id, 'raw', 'ts'), 'q')
+            if last_ts is not None and ts < last_ts:
+                return False
+
+            _append(self._path(agent_id, 'raw', 'ts'), 'q', ts)
+            _append(self._path(agent_id, 'raw', 'value'), 'd', value)
+            for resolution in ROLLUPS:
+                self._update_rollup(agent_id, resolution, ts, value)
+        return True
+
+    def add_samples(self, samples, ts=None):
+        # samples is an iterable of (agent_id, value) taken at the same time
+        ts = int(ts if ts is not None else time.time())
+        for agent_id, value in samples:
+            self.add_sample(agent_id, value, ts)
+
+        if ts - self._last_compaction > 3600:
+            self._last_compaction = ts
+            self.compact(ts)
+
+    def _update_rollup(self, agent_id, resolution, ts, value):
+        bucket = bucket_start(resolution, ts)
+        path = lambda column: self._path(agent_id, resolution, column)
+
+        if _last_value(path('ts'), 'q') == bucket:
+            # the sample falls into the newest bucket, which is updated in place
+            _overwrite_last(path('count'), 'q', _last_value(path('count'), 'q') + 1)
+            _overwrite_last(path('sum'), 'd', _last_value(path('sum'), 'd') + value)
+            _overwrite_last(path('min'), 'd', min(_last_value(path('min'), 'd'), value))
+            _overwrite_last(path('max'), 'd', max(_last_value(path('max'), 'd'), value))
+            _overwrite_last(path('last'), 'd', value)
+            return
+
+        for (column, typecode), initial in zip(ROLLUP_COLUMNS, (bucket, 1, value, value, value, value)):
+            _append(path(column), typecode, initial)
+
+    def bulk_load(self, agent_id, timestamps, values):
+        """
+        Writes a whole series at once, for backfills. The agent must not have any samples yet.
+        :param timestamps: Ascending epoch seconds
+        :param values: Spend at each timestamp
+        """
+        with self._lock(agent_id):
+            if _last_value(self._path(agent_id, 'raw', 'ts'), 'q') is not None:
+                raise ValueError(f"Agent {agent_id} already has spend history.")
+            os.makedirs(os.path.join(self.directory, str(agent_id)), exist_ok=True)
+
+            columns = {'raw': {'ts': array.array('q', timestamps), 'value': array.array('d', values)}}
+            for resolution in ROLLUPS:
+                rollup = {column: array.array(typecode) for column, typecode in ROLLUP_COLUMNS}
+                for ts, value in zip(timestamps, values):
+                    bucket = bucket_start(resolution, ts)
+                    if rollup['ts'] and rollup['ts'][-1] == bucket:
+                        rollup['count'][-1] += 1
+                        rollup['sum'][-1] += value
+                        rollup['min'][-1] = min(rollup['min'][-1], value)
+                        rollup['max'][-1] = max(rollup['max'][-1], value)
+                        rollup['last'][-1] = value
+                    else:
+                        for column, initial in zip(rollup, (bucket, 1, value, value, value, value)):
+                            rollup[column].append(initial)
+                columns[resolution] = rollup
+
+            for resolution, resolution_columns in columns.items():
+                for column, data in resolution_columns.items():
+                    with open(self._path(agent_id, resolution, column), 'wb') as f:
+                        data.tofile(f)
+
+    def query(self, agent_id, start, end, step=None):
+        """
+        Returns the points of one resolution between two epoch timestamps (inclusive).
+        :param step: 'raw', 'hour', 'day' or 'month', chosen from the range when omitted
+        """
+        step = step or choose_step(start, end)
+        if step not in STEPS:
+            raise ValueError(f"Unknown step '{step}', expected one of {', '.join(STEPS)}.")
+
+        columns = self._columns(step)
+        with self._lock(agent_id):
+            with _mapped(self._path(agent_id, step, 'ts'), 'q') as timestamps:
+                lo = bisect.bisect_left(timestamps, start)
+                hi = bisect.bisect_right(timestamps, end)
+                data = {'ts': timestamps[lo:hi].tolist()}
+
+            for column, typecode in columns[1:]:
+                with _mapped(self._path(agent_id, step, column), typecode) as view:
+                    data[column] = view[lo:hi].tolist()
+
+        # a write interrupted between columns leaves them at different lengths
+        length = min(len(values) for values in data.values())
+        points = []
+        for index in range(length):
+            point = {'t': datetime.fromtimestamp(data['ts'][index], timezone.utc).isoformat()}
+            if step == 'raw':
+                point['value'] = data['value'][index]
+            else:
+                point.update({
+                    'count': data['count'][index],
+                    'min': data['min'][index],
+                    'max': data['max'][index],
+                    'last': data['last'][index],
+                    'avg': data['sum'][index] / data['count'][index]
+                })
+            points.append(point)
+        return step, points
+
+    def compact(self, now=None):
+        # drops raw samples and hourly rollups that are past their retention
+        now = int(now if now is not None else time.time())
+        for name in os.listdir(self.directory):
+            if not name.isdigit():
+                continue
+            agent_id = int(name)
+            with self._lock(agent_id):
+                for resolution, retention in self.retention.items():
+                    self._truncate_before(agent_id, resolution, now - retention)
+
+    def _truncate_before(self, agent_id, resolution, cutoff):
+        with _mapped(self._path(agent_id, resolution, 'ts'), 'q') as timestamps:
+            cut = bisect.bisect_left(timestamps, cutoff)
+        if cut == 0:
+            return
+
+        for column, typecode in self._columns(resolution):
+            path = self._path(agent_id, resolution, column)
+            with _mapped(path, typecode) as view:
+                tail = view[cut:].tobytes()
+            with open(path + '.tmp', 'wb') as f:
+                f.write(tail)
+            os.replace(path + '.tmp', path)
+
+    def delete_agent(self, agent_id):
+        with self._lock(agent_id):
+            shutil.rmtree(os.path.join(self.directory, str(agent_id)), ignore_errors=True)
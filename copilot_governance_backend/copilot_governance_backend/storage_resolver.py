@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+from azure.core.exceptions import ClientAuthenticationError, HttpResponseError, ResourceExistsError
+
+class StorageAccountNotFound(Exception):
+    pass
+
+class StorageTarget:
+    """
+    What is needed to reach the blob storage of one agent resource group.
+    """
+    def __init__(self, resource_group_name, account_name, account_url, key, service_client):
+        self.resource_group_name = resource_group_name
+        self.account_name = account_name
+        self.account_url = account_url
+        self.key = key
+        self.service_client = service_client
+        self.created = time.monotonic()
+        # container clients by name, and the containers known to exist
+        self._containers = {}
+        self._existing = set()
+        self._lock = threading.Lock()
+
+    def container_client(self, container_name, create=False):
+        with self._lock:
+            container_client = self._containers.get(container_name)
+            if container_client is None:
+                container_client = self._containers[container_name] = self.service_client.get_container_client(container_name)
+            if not create or container_name in self._existing:
+                return container_client
+
+        # Check if the container exists; if not, create it (once per cached entry). The calls are
+        # made outside the lock, so they never hold up the other containers of the account.
+        if not container_client.exists():
+            try:
+                container_client.create_container()
+                print(f"Container '{container_name}' created in storage account '{self.account_name}'.")
+            except ResourceExistsError:
+                # a concurrent request created it first
+                pass
+        with self._lock:
+            self._existing.add(container_name)
+        return container_client
+
+    def blob_client(self, container_name, blob_name):
+        return self.container_client(container_name).get_blob_client(blob_name)
+
+def is_auth_error(error):
+    # a rotated key surfaces as 403 on the data plane
+    return isinstance(error, ClientAuthenticationError) or (isinstance(error, HttpResponseError) and error.status_code == 403)
+
+class StorageResolver:
+    """
+    Caches, per agent resource group, the storage account, its key and a reusable
+    BlobServiceClient, so blob requests skip the ARM list_by_resource_group and
+    list_keys round trips (ARM throttles these management calls at low rates).
+    :param clients: Azure clients (real or fake) providing storage_client and blob_service_client()
+    :param ttl: Seconds an entry is reused for before the account and key are looked up again
+    :param client_options: Keyword arguments passed to every BlobServiceClient, e.g. chunk sizes
+    """
+    def __init__(self, clients, ttl=3600, **client_options):
+        self.clients = clients
+        self.ttl = ttl
+        self.client_options = client_options
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _group_lock(self, resource_group_name):
+        with self._lock:
+            return self._locks.setdefault(resource_group_name, threading.Lock())
+
+    def _resolve(self, resource_group_name):
+        # Get the first storage account
+        storage_accounts = self.clients.storage_client.storage_accounts.list_by_resource_group(resource_group_name)
+        storage_account = next(storage_accounts, None)
+        if not storage_account:
+            raise StorageAccountNotFound(f"No storage accounts found in resource group '{resource_group_name}'.")
+
+        account_url = f'https://{storage_account.name}.blob.core.windows.net'
+        keys = self.clients.storage_client.storage_accounts.list_keys(resource_group_name, storage_account.name)
+        storage_key = keys.keys[0].value
+
+        service_client = self.clients.blob_service_client(account_url, storage_key, **self.client_options)
+        return StorageTarget(resource_group_name, storage_account.name, account_url, storage_key, service_client)
+
+    def get(self, resource_group_name):
+        """
+        Returns the StorageTarget of a resource group, looking it up when missing or expired.
+        :raises StorageAccountNotFound: The resource group holds no storage account
+        """
+        entry = self._entries.get(resource_group_name)
+        if entry is not None and time.monotonic() - entry.created < self.ttl:
+            self.hits += 1
+            return entry
+
+        # concurrent misses for the same group wait for a single lookup
+        with self._group_lock(resource_group_name):
+            entry = self._entries.get(resource_group_name)
+            if entry is not None and time.monotonic() - entry.created < self.ttl:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            entry = self._entries[resource_group_name] = self._resolve(resource_group_name)
+            return entry
+
+    def invalidate(self, resource_group_name):
+        with self._lock:
+            self._entries.pop(resource_group_name, None)
+
+    def call(self, resource_group_name, func):
+        """
+        Calls func(target) and, when storage refuses the cached key (403 after a key
+        rotation), invalidates the entry and tries once more with a fresh key.
+        """
+        try:
+            return func(self.get(resource_group_name))
+        except HttpResponseError as e:
+            if not is_auth_error(e):
+                raise
+            print(f"Storage key for resource group '{resource_group_name}' was refused, refreshing it.")
+            self.invalidate(resource_group_name)
+            return func(self.get(resource_group_name))
+
+    async def acall(self, resource_group_name, func):
+        # same as call() for a coroutine function, the ARM lookups run off the event loop
+        try:
+            return await func(await asyncio.to_thread(self.get, resource_group_name))
+        except HttpResponseError as e:
+            if not is_auth_error(e):
+                raise
+            print(f"Storage key for resource group '{resource_group_name}' was refused, refreshing it.")
+            self.invalidate(resource_group_name)
+            return await func(await asyncio.to_thread(self.get, resource_group_name))
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# The backend modules read their settings when they are imported, so the throwaway
+# database and directories are configured before any test module imports them
+TEST_DIRECTORY = tempfile.mkdtemp(prefix="copilot-governance-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(TEST_DIRECTORY, 'backend.db')}",
+    "AZURE_CLIENTS": "fake",
+    "AZURE_SUBSCRIPTION_ID": "00000000-0000-0000-0000-000000000000",
+    "AZURE_USER_OBJECT_ID": "00000000-0000-0000-0000-000000000000",
+    "COST_REFRESH_INTERVAL": "0",
+    "RECONCILE_INTERVAL": "0",
+    "SPEND_HISTORY_DIR": os.path.join(TEST_DIRECTORY, "spend_history"),
+    "RETRIEVAL_INDEX_DIR": os.path.join(TEST_DIRECTORY, "retrieval_index"),
+    "CHAT_BATCH_DIR": os.path.join(TEST_DIRECTORY, "chat_batches"),
+})
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TEST_DIRECTORY, ignore_errors=True)
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """Sessions on an empty SQLite database of the test, migrated to the current schema"""
+    from migrations import upgrade
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    upgrade(engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+@pytest.fixture(scope="session")
+def backend():
+    """The application module, on the throwaway database and the fake Azure clients"""
+    import backend
+    return backend
+
+@pytest.fixture(scope="session")
+def client(backend):
+    from fastapi.testclient import TestClient
+
+    # entering the client runs the lifespan, which starts the job runners
+    with TestClient(backend.app) as client:
+        yield client
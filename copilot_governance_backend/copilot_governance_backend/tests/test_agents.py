@@ -0,0 +1,95 @@
+import threading
+import time
+
+from jobs import UNFINISHED
+from models import Agent, Job
+
+def new_agent_body(name):
+    return {
+        "name": name, "display_name": name, "description": "test agent", "owner": "owner",
+        "owner_email": "owner@example.com", "model_base": "gpt-35-turbo", "location": "uksouth",
+        "active": False, "status": "", "budget": 10
+    }
+
+def wait_for_job(client, job_id, timeout=10):
+    # provisioning runs against the fake clients in the background, it is left to finish
+    deadline = time.monotonic() + timeout
+    while client.get(f"/jobs/{job_id}").json()["status"] in UNFINISHED and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+def test_new_agent_rejects_an_existing_name(client):
+    created = client.post("/new_agent", json=new_agent_body("duplicate"))
+    assert created.status_code == 202
+
+    response = client.post("/new_agent", json=new_agent_body("duplicate"))
+    assert response.status_code == 409
+    wait_for_job(client, created.json()["job_id"])
+
+def test_concurrent_new_agents_start_one_job(client, backend):
+    responses = []
+    requests = [
+        threading.Thread(target=lambda: responses.append(client.post("/new_agent", json=new_agent_body("concurrent"))))
+        for _ in range(4)
+    ]
+    for request in requests:
+        request.start()
+    for request in requests:
+        request.join()
+
+    assert sorted(response.status_code for response in responses) == [202, 409, 409, 409]
+    wait_for_job(client, next(response for response in responses if response.status_code == 202).json()["job_id"])
+    db = backend.SessionLocal()
+    agent_ids = [agent.id for agent in db.query(Agent).filter(Agent.name == "agent-concurrent-rg")]
+    assert len(agent_ids) == 1
+    assert db.query(Job).filter(Job.agent_id.in_(agent_ids), Job.kind == 'new_agent').count() == 1
+    db.close()
+
+def add_listed_agents(backend, owner, names):
+    db = backend.SessionLocal()
+    db.add_all([Agent(name=name, display_name=name, owner=owner, status="Active", active=True, budget=10) for name in names])
+    db.commit()
+    db.close()
+
+def test_get_agents_pages_follow_the_cursor(client, backend):
+    names = [f"agent-page-{index}-rg" for index in range(5)]
+    add_listed_agents(backend, "pager", names)
+
+    listed, cursor, pages = [], None, 0
+    while True:
+        response = client.get("/get_agents", params={"owner": "pager", "sort": "-name", "fields": "name", "limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        listed += [agent["name"] for agent in response.json()]
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert listed == sorted(names, reverse=True)
+    assert pages == 3
+
+def test_get_agents_rejects_an_invalid_cursor(client):
+    assert client.get("/get_agents", params={"cursor": "not-a-cursor"}).status_code == 400
+
+def test_get_agents_answers_304_while_the_page_is_unchanged(client, backend):
+    add_listed_agents(backend, "poller", ["agent-poll-1-rg"])
+    params = {"owner": "poller", "fields": "name,status"}
+
+    response = client.get("/get_agents", params=params)
+    etag = response.headers["ETag"]
+    unchanged = client.get("/get_agents", params=params, headers={"If-None-Match": etag})
+    assert (unchanged.status_code, unchanged.content, unchanged.headers["ETag"]) == (304, b"", etag)
+
+    add_listed_agents(backend, "poller", ["agent-poll-2-rg"])
+    changed = client.get("/get_agents", params=params, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+def test_get_agents_name_filter_matches_wildcards_literally(client, backend):
+    add_listed_agents(backend, "wildcards", ["agent-100%-rg", "agent-1000-rg", "agent-a_b-rg", "agent-axb-rg"])
+
+    def names(prefix):
+        response = client.get("/get_agents", params={"owner": "wildcards", "fields": "name", "name": prefix})
+        return [agent["name"] for agent in response.json()]
+
+    assert names("agent-100%") == ["agent-100%-rg"]
+    assert names("agent-a_b") == ["agent-a_b-rg"]
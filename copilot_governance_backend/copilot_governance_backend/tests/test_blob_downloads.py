@@ -0,0 +1,33 @@
+import pytest
+
+from blob_downloads import RangeNotSatisfiable, parse_range
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("bytes=0-9", (0, 9)),
+    ("bytes=10-", (10, 99)),
+    ("bytes=90-200", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    ("bytes=99-99", (99, 99)),
+    # not a single byte range: the whole blob is sent
+    ("bytes=-", None),
+    ("bytes=0-9,20-29", None),
+    ("items=0-9", None),
+    # last before first makes the header invalid, it is ignored
+    ("bytes=10-5", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=100-", 100),
+    ("bytes=150-200", 100),
+    ("bytes=-0", 100),
+    ("bytes=-10", 0),
+    ("bytes=0-", 0),
+])
+def test_parse_range_outside_the_blob(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import pytest
+
+from chat_batch import BatchStats, Throttled, parse_prompts, run_batch
+
+def test_parse_prompts_numbers_lines_without_an_id():
+    lines = ['{"user_input": "first"}', '', '{"id": "b", "prompt": "second"}', '{"user_input": "third"}']
+    assert parse_prompts(lines) == [
+        {'id': '1', 'user_input': 'first'},
+        {'id': 'b', 'user_input': 'second'},
+        {'id': '4', 'user_input': 'third'},
+    ]
+
+@pytest.mark.parametrize("lines, message", [
+    (['{"user_input": "first"'], "Line 1 is not valid JSON"),
+    (['["first"]'], "Line 1 must be a JSON object"),
+    (['{"id": 1}'], "Line 1 has no 'user_input'"),
+    (['{"id": "a", "user_input": "x"}', '{"id": "a", "user_input": "y"}'], "Line 2 repeats the id 'a'"),
+    ([''], "The batch holds no prompts"),
+    (['{"user_input": "x"}'] * 3, "at most 2 prompts"),
+])
+def test_parse_prompts_rejects(lines, message):
+    with pytest.raises(ValueError, match=message):
+        parse_prompts(lines, max_prompts=2)
+
+def read_results(path):
+    records = {}
+    with open(path, encoding='utf-8') as results:
+        for line in results:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['id']] = record
+    return records
+
+def test_resume_skips_the_answered_prompts(tmp_path):
+    results_path = tmp_path / "results.jsonl"
+    # the last line was cut short by a restart
+    results_path.write_text(json.dumps({'id': '1', 'status': 'succeeded'}) + '\n{"id": "2", "sta')
+    prompts = parse_prompts([json.dumps({'user_input': f"prompt {index}"}) for index in range(1, 4)])
+    sent = []
+
+    async def complete(user_input):
+        sent.append(user_input)
+        return "reply", 2, 3
+
+    stats = BatchStats(len(prompts))
+    summary = asyncio.run(run_batch(prompts, complete, results_path, stats, concurrency=2))
+
+    assert sorted(sent) == ["prompt 2", "prompt 3"]
+    assert (summary['skipped'], summary['succeeded'], summary['remaining']) == (1, 2, 0)
+    # the answers after the cut-short line are read back, a second resume sends nothing
+    assert sorted(read_results(results_path)) == ['1', '2', '3']
+    asyncio.run(run_batch(prompts, complete, results_path, BatchStats(len(prompts))))
+    assert len(sent) == 2
+
+def test_throttled_prompts_are_retried_until_max_attempts(tmp_path):
+    results_path = tmp_path / "results.jsonl"
+    prompts = parse_prompts(['{"id": "retried", "user_input": "a"}', '{"id": "gave-up", "user_input": "b"}', '{"id": "broken", "user_input": "c"}'])
+    calls = {}
+
+    async def complete(user_input):
+        calls[user_input] = calls.get(user_input, 0) + 1
+        if user_input == "a" and calls["a"] < 3 or user_input == "b":
+            raise Throttled("429", retry_after=0)
+        if user_input == "c":
+            raise RuntimeError("content filter")
+        return "reply", 1, 1
+
+    summary = asyncio.run(run_batch(prompts, complete, results_path, BatchStats(len(prompts)), max_attempts=4))
+
+    results = read_results(results_path)
+    assert (results['retried']['status'], results['retried']['attempts']) == ('succeeded', 3)
+    assert (results['gave-up']['status'], results['gave-up']['attempts']) == ('failed', 4)
+    assert (results['broken']['status'], results['broken']['error']) == ('failed', "content filter")
+    assert (summary['succeeded'], summary['failed'], summary['throttled_retries']) == (1, 2, 6)
+
+def test_local_throttling_does_not_use_up_attempts(tmp_path):
+    results_path = tmp_path / "results.jsonl"
+    prompts = parse_prompts(['{"user_input": "a"}'])
+    calls = []
+
+    async def complete(user_input):
+        calls.append(user_input)
+        if len(calls) < 5:
+            raise Throttled("agent limit", retry_after=0, local=True)
+        return "reply", 1, 1
+
+    summary = asyncio.run(run_batch(prompts, complete, results_path, BatchStats(1), max_attempts=2))
+
+    assert (summary['succeeded'], summary['throttled_retries']) == (1, 0)
+    assert read_results(results_path)['1']['attempts'] == 1
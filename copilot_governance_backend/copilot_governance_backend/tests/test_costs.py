@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+import pytest
+
+from costs import CostRefresher, utcnow
+from fake_azure import FakeAzureClients
+from models import Agent
+
+@pytest.fixture
+def fake():
+    return FakeAzureClients()
+
+@pytest.fixture
+def refresher(session_factory, fake):
+    return CostRefresher(session_factory, fake, stale_after=1800, retries=0, retry_after=300)
+
+def add_agent(session_factory):
+    db = session_factory()
+    agent = Agent(name="agent-costs-rg", display_name="costs", location="uksouth", model_base="gpt-35-turbo", status="Succeeded", budget=10)
+    db.add(agent)
+    db.commit()
+    return db, agent
+
+def test_refresh_stores_the_spend(session_factory, fake, refresher):
+    db, agent = add_agent(session_factory)
+    fake.spend["agent-costs-rg"] = 4.5
+
+    snapshot = refresher.refresh_agent(db, agent)
+    assert (snapshot.amount, snapshot.unit, snapshot.error) == (4.5, "GBP", None)
+    assert not refresher.needs_refresh(snapshot)
+    db.close()
+
+def test_failed_refresh_is_not_retried_until_retry_after(session_factory, fake, refresher):
+    db, agent = add_agent(session_factory)
+    fake.spend["agent-costs-rg"] = 2.0
+    fake.fail_next('budgets.get')
+
+    snapshot = refresher.refresh_agent(db, agent)
+    assert snapshot.error is not None
+    assert snapshot.refreshed_at is None
+    # still stale, but page views leave it alone until retry_after has passed
+    assert refresher.is_stale(snapshot)
+    assert not refresher.needs_refresh(snapshot)
+    assert refresher.needs_refresh(snapshot, utcnow() + timedelta(seconds=301))
+
+    snapshot = refresher.refresh_agent(db, agent)
+    assert (snapshot.amount, snapshot.error) == (2.0, None)
+    db.close()
+
+def test_failed_refresh_keeps_the_last_known_spend(session_factory, fake, refresher):
+    db, agent = add_agent(session_factory)
+    fake.spend["agent-costs-rg"] = 3.0
+    refresher.refresh_agent(db, agent)
+    fake.spend["agent-costs-rg"] = 7.0
+    fake.fail_next('budgets.get')
+
+    snapshot = refresher.refresh_agent(db, agent)
+    assert (snapshot.amount, snapshot.error is not None) == (3.0, True)
+    db.close()
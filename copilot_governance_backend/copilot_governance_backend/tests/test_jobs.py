@@ -0,0 +1,135 @@
+import json
+from datetime import timedelta
+
+import pytest
+
+from fake_azure import FakeAzureClients
+from jobs import JobRunner, Step, utcnow, FAILED, PENDING, RUNNING, SUCCEEDED
+from models import Agent, Job, JobStep
+from provisioning import NEW_AGENT_STEPS
+
+@pytest.fixture
+def fake():
+    return FakeAzureClients()
+
+@pytest.fixture
+def runner(session_factory, fake):
+    runner = JobRunner(session_factory, fake, lease_seconds=30)
+    runner.register('new_agent', NEW_AGENT_STEPS)
+    yield runner
+    runner.shutdown()
+
+def new_agent_job(runner, session_factory):
+    db = session_factory()
+    agent = Agent(name="agent-jobs-rg", display_name="jobs", location="uksouth", model_base="gpt-35-turbo", status="Provisioning", budget=10)
+    db.add(agent)
+    db.commit()
+    job = runner.create_job(db, 'new_agent', agent_id=agent.id, payload={"display_name": "jobs"})
+    db.close()
+    return job.id
+
+def load_job(session_factory, job_id):
+    db = session_factory()
+    job = db.get(Job, job_id)
+    steps = {job_step.name: job_step for job_step in job.steps}
+    db.close()
+    return job, steps
+
+def abandon(session_factory, job_id, finished_steps, lease_expires_at):
+    # the job as a runner that stopped left it: some steps done, one interrupted, the lease not renewed
+    db = session_factory()
+    job = db.get(Job, job_id)
+    job.status = RUNNING
+    job.owner = "stopped-runner"
+    job.lease_expires_at = lease_expires_at
+    for job_step in job.steps:
+        if job_step.name in finished_steps:
+            job_step.status = SUCCEEDED
+            job_step.attempts = 1
+            job_step.result = json.dumps(finished_steps[job_step.name])
+        elif job_step.name == 'create_workspace':
+            job_step.status = RUNNING
+            job_step.attempts = 1
+    db.commit()
+    db.close()
+
+def test_failed_step_is_retried(runner, session_factory, fake):
+    job_id = new_agent_job(runner, session_factory)
+    fake.fail_next('resource_groups.create_or_update')
+
+    runner.submit(job_id).result()
+
+    job, steps = load_job(session_factory, job_id)
+    assert job.status == SUCCEEDED
+    assert job.owner is None and job.lease_expires_at is None
+    assert steps['create_resource_group'].attempts == 2
+    assert fake.calls.count('resource_groups.create_or_update') == 2
+
+def test_resumed_job_skips_completed_steps(runner, session_factory, fake):
+    job_id = new_agent_job(runner, session_factory)
+    fake.resource_client.resource_groups.create_or_update("agent-jobs-rg", {"location": "uksouth", "tags": {"type": "agent"}})
+    abandon(session_factory, job_id, {'create_resource_group': {'resource_group': "agent-jobs-rg"}, 'create_budget': {}}, utcnow() - timedelta(seconds=1))
+    fake.calls.clear()
+
+    assert runner.resume_unfinished() == [job_id]
+    runner.shutdown(wait=True)
+
+    job, steps = load_job(session_factory, job_id)
+    assert job.status == SUCCEEDED
+    assert 'resource_groups.create_or_update' not in fake.calls
+    assert not any(call.startswith('budgets.') for call in fake.calls)
+    # the interrupted step was started again
+    assert steps['create_workspace'].attempts == 2
+    assert all(job_step.status == SUCCEEDED for job_step in steps.values())
+
+def test_job_with_a_live_lease_is_not_resumed(runner, session_factory, fake):
+    job_id = new_agent_job(runner, session_factory)
+    abandon(session_factory, job_id, {}, utcnow() + timedelta(seconds=60))
+
+    assert runner.resume_unfinished() == []
+    job, steps = load_job(session_factory, job_id)
+    assert job.owner == "stopped-runner"
+    assert steps['create_workspace'].status == RUNNING
+    assert fake.calls == []
+
+def test_only_one_runner_resumes_a_job(runner, session_factory):
+    job_id = new_agent_job(runner, session_factory)
+    abandon(session_factory, job_id, {}, utcnow() - timedelta(seconds=1))
+    other = JobRunner(session_factory, FakeAzureClients(), lease_seconds=30)
+    other.register('new_agent', [])
+
+    # the first runner took the job over, so the other one finds nothing to resume
+    assert runner.resume_unfinished() == [job_id]
+    assert other.resume_unfinished() == []
+    runner.shutdown(wait=True)
+
+def test_step_is_not_committed_after_the_lease_is_lost(session_factory, fake):
+    def taken_over(ctx):
+        ctx.db.query(Job).filter(Job.id == ctx.job.id).update({Job.owner: "other-runner"})
+        ctx.db.commit()
+        return {}
+
+    runner = JobRunner(session_factory, fake)
+    runner.register('taken_over', [Step('first', taken_over)])
+    db = session_factory()
+    job_id = runner.create_job(db, 'taken_over').id
+    db.close()
+
+    runner.submit(job_id).result()
+    runner.shutdown()
+
+    job, steps = load_job(session_factory, job_id)
+    assert job.owner == "other-runner" and job.status == RUNNING
+    assert steps['first'].status == RUNNING
+
+def test_job_is_failed_when_the_runner_raises(runner, session_factory, monkeypatch):
+    job_id = new_agent_job(runner, session_factory)
+    monkeypatch.setattr(runner, '_run_graph', lambda db, job: 1 / 0)
+
+    runner.submit(job_id).result()
+
+    job, steps = load_job(session_factory, job_id)
+    assert job.status == FAILED
+    assert "division by zero" in job.error
+    assert job.owner is None
+    assert all(job_step.status == FAILED for job_step in steps.values())
@@ -0,0 +1,84 @@
+import io
+import uuid
+import zipfile
+
+import pytest
+
+from models import Agent
+
+@pytest.fixture
+def agents(backend):
+    # two agents with a storage account each in the fake Azure, named uniquely for the shared database
+    suffix = uuid.uuid4().hex[:8]
+    db = backend.SessionLocal()
+    agents = [Agent(name=f"agent-ingest-{suffix}-{index}-rg", display_name="ingest", status="Active", active=True, budget=10) for index in range(2)]
+    db.add_all(agents)
+    db.commit()
+    for agent in agents:
+        backend.azure_clients.storage_accounts[agent.name] = {f"ingest{suffix}{agent.id}": "key1"}
+    agent_ids = [agent.id for agent in agents]
+    db.close()
+    return agent_ids
+
+def content(text):
+    # unique per test run, content already stored by another test would only be linked
+    return f"{text} {uuid.uuid4()}".encode()
+
+def add_files(client, agent_id, files, **params):
+    response = client.post(f"/agent/{agent_id}/add_knowledge_sources", files=[("files", file) for file in files], params=params)
+    assert response.status_code == 200
+    return response.json()["results"]
+
+def test_bulk_upload_stores_each_content_once(client, backend, agents):
+    travel, passwords = content("travel"), content("passwords")
+
+    results = add_files(client, agents[0], [("travel.txt", travel), ("passwords.txt", passwords), ("copy.txt", travel)], concurrency=2)
+
+    # the copy in the same request is linked by the first file
+    assert [result["status"] for result in results] == ["uploaded", "uploaded", "already_linked"]
+    assert results[0]["knowledge_source_id"] == results[2]["knowledge_source_id"]
+    assert results[0]["size"] == len(travel)
+    blobs = [data for (container, _), (data, _) in backend.azure_clients.blobs.items() if container == f"agent{agents[0]}-blob"]
+    assert sorted(blobs) == sorted([travel, passwords])
+
+def test_content_stored_for_another_agent_is_only_linked(client, agents):
+    travel = content("travel")
+    uploaded, = add_files(client, agents[0], [("travel.txt", travel)])
+
+    deduplicated, = add_files(client, agents[1], [("renamed.txt", travel)])
+    assert (deduplicated["status"], deduplicated["knowledge_source_id"]) == ("deduplicated", uploaded["knowledge_source_id"])
+
+    already_linked, = add_files(client, agents[1], [("again.txt", travel)])
+    assert already_linked["status"] == "already_linked"
+
+    single = client.post(f"/agent/{agents[1]}/add_knowledge_source", data={"knowledge_source_name": "again"}, files={"file": ("again.txt", travel)})
+    assert single.status_code == 409
+
+    listed = client.get("/knowledge_sources", params={"agent_id": agents[1]}).json()["knowledge_sources"]
+    assert [source["id"] for source in listed] == [uploaded["knowledge_source_id"]]
+    assert {agent["id"] for agent in listed[0]["agents"]} == set(agents)
+
+def test_archive_members_are_uploaded(client, agents):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("policies/travel.txt", content("travel"))
+        zip_file.writestr("policies/", b"")
+        zip_file.writestr("__MACOSX/._travel.txt", b"resource fork")
+
+    response = client.post(f"/agent/{agents[0]}/add_knowledge_sources", files={"archive": ("policies.zip", archive.getvalue())})
+
+    assert [(result["file"], result["status"]) for result in response.json()["results"]] == [("policies/travel.txt", "uploaded")]
+
+def test_bulk_upload_needs_files_and_a_readable_archive(client, agents):
+    assert client.post(f"/agent/{agents[0]}/add_knowledge_sources").status_code == 400
+    response = client.post(f"/agent/{agents[0]}/add_knowledge_sources", files={"archive": ("notes.txt", b"not an archive")})
+    assert response.status_code == 400
+
+def test_agent_without_storage_account_is_refused(client, backend, agents):
+    db = backend.SessionLocal()
+    name = db.get(Agent, agents[0]).name
+    db.close()
+    del backend.azure_clients.storage_accounts[name]
+
+    response = client.post(f"/agent/{agents[0]}/add_knowledge_sources", files=[("files", ("travel.txt", content("travel")))])
+    assert response.status_code == 404
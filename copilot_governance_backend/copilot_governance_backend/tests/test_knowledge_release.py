@@ -0,0 +1,90 @@
+import pytest
+
+from fake_azure import FakeAzureClients
+from knowledge_store import release_agent_knowledge, agent_container_name
+from models import Agent, AgentKnowledgeSource, KnowledgeSource, AGENT_DELETING
+from storage_resolver import StorageResolver
+
+@pytest.fixture
+def fake():
+    return FakeAzureClients()
+
+@pytest.fixture
+def storage_resolver(fake):
+    return StorageResolver(fake)
+
+def add_agent(db, fake, name, status="Active"):
+    agent = Agent(name=name, display_name=name, status=status, active=status == "Active", budget=10)
+    db.add(agent)
+    db.flush()
+    fake.storage_accounts[name] = {f"{name.replace('-', '')}store": f"{name.replace('-', '')}store-key1"}
+    return agent
+
+def add_shared_source(db, fake, host, agents):
+    # the blob is stored in the host agent's storage account and linked to every agent
+    url = f"https://{host.name.replace('-', '')}store.blob.core.windows.net/{agent_container_name(host.id)}/sha256/abc"
+    fake.blob_service_client().get_container_client(agent_container_name(host.id)).get_blob_client("sha256/abc").upload_blob(b"content")
+    source = KnowledgeSource(name="shared", source=url, approved=True, content_hash="abc", storage_resource_group=host.name)
+    db.add(source)
+    db.flush()
+    db.add_all([AgentKnowledgeSource(agent_id=agent.id, knowledge_id=source.id) for agent in agents])
+    db.commit()
+    return source.id
+
+def release(session_factory, agent_id, storage_resolver):
+    db = session_factory()
+    try:
+        released = release_agent_knowledge(db, db.get(Agent, agent_id), storage_resolver)
+        db.commit()
+        return released
+    finally:
+        db.close()
+
+def test_shared_source_moves_to_a_live_agent(session_factory, fake, storage_resolver):
+    db = session_factory()
+    deleted = add_agent(db, fake, "agent-a-rg", AGENT_DELETING)
+    deleting = add_agent(db, fake, "agent-b-rg", AGENT_DELETING)
+    live = add_agent(db, fake, "agent-c-rg")
+    source_id = add_shared_source(db, fake, deleted, [deleted, deleting, live])
+    deleted_id, live_id = deleted.id, live.id
+    db.close()
+
+    assert release(session_factory, deleted_id, storage_resolver) == ([], [])
+
+    db = session_factory()
+    source = db.get(KnowledgeSource, source_id)
+    # never into the storage of the other agent being deleted
+    assert source.storage_resource_group == "agent-c-rg"
+    assert (agent_container_name(live_id), "sha256/abc") in fake.blobs
+    db.close()
+
+def test_source_shared_only_by_deleting_agents_is_released_once(session_factory, fake, storage_resolver):
+    db = session_factory()
+    first = add_agent(db, fake, "agent-a-rg", AGENT_DELETING)
+    second = add_agent(db, fake, "agent-b-rg", AGENT_DELETING)
+    source_id = add_shared_source(db, fake, first, [first, second])
+    first_id, second_id = first.id, second.id
+    db.close()
+
+    assert release(session_factory, first_id, storage_resolver) == ([source_id], [])
+    assert release(session_factory, second_id, storage_resolver) == ([], [])
+
+    db = session_factory()
+    assert db.get(KnowledgeSource, source_id) is None
+    assert db.query(AgentKnowledgeSource).count() == 0
+    db.close()
+    assert 'blob.upload_blob_from_url' not in fake.calls
+
+def test_blob_stored_elsewhere_is_returned_not_deleted(session_factory, fake, storage_resolver):
+    db = session_factory()
+    host = add_agent(db, fake, "agent-a-rg", AGENT_DELETING)
+    deleted = add_agent(db, fake, "agent-b-rg", AGENT_DELETING)
+    source_id = add_shared_source(db, fake, host, [deleted])
+    deleted_id, source_url = deleted.id, db.get(KnowledgeSource, source_id).source
+    db.close()
+
+    released = release(session_factory, deleted_id, storage_resolver)
+
+    assert released == ([source_id], [{"storage_resource_group": "agent-a-rg", "source": source_url}])
+    # deleted by the next step of the deletion job, once the release is committed
+    assert ("agent1-blob", "sha256/abc") in fake.blobs
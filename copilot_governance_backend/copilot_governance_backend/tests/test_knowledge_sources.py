@@ -0,0 +1,14 @@
+from models import KnowledgeSource
+
+def test_name_filter_matches_wildcards_literally(client, backend):
+    db = backend.SessionLocal()
+    db.add_all([KnowledgeSource(name=name, source=f"https://example.com/{index}", approved=False) for index, name in enumerate(["Travel 50% policy", "Travel 500 policy", "expense_claims", "expense claims"])])
+    db.commit()
+    db.close()
+
+    def names(name):
+        response = client.get("/knowledge_sources", params={"name": name, "approved": False})
+        return [knowledge_source["name"] for knowledge_source in response.json()["knowledge_sources"]]
+
+    assert names("50%") == ["Travel 50% policy"]
+    assert names("SE_CL") == ["expense_claims"]
@@ -0,0 +1,53 @@
+import re
+
+import pytest
+
+from metrics import Histogram, arm_operation, azure_operation, openai_operation
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_seconds", "Test durations.", ("route",), (0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, "/a")
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test durations.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 3',
+        'test_seconds_bucket{route="/a",le="+Inf"} 4',
+        'test_seconds_sum{route="/a"} 4.25',
+        'test_seconds_count{route="/a"} 4',
+    ]
+
+def test_label_values_are_escaped():
+    histogram = Histogram("test_seconds", "Test durations.", ("route",), (1.0,))
+    histogram.observe(0.5, 'a "quoted"\\path')
+    assert 'route="a \\"quoted\\"\\\\path"' in histogram.render()[2]
+
+@pytest.mark.parametrize("path, expected", [
+    ("/subscriptions/s/resourceGroups/rg", ("arm", "resourceGroups")),
+    ("/subscriptions/s/resourceGroups/rg/providers/Microsoft.CognitiveServices/accounts/a/listKeys", ("cognitiveservices", "accounts/listKeys")),
+    ("/subscriptions/s/resourceGroups/rg/providers/Microsoft.Storage/storageAccounts/st/providers/Microsoft.Authorization/roleAssignments/r", ("authorization", "roleAssignments")),
+    ("/subscriptions/s", ("arm", "subscription")),
+])
+def test_arm_operation_leaves_out_resource_names(path, expected):
+    assert arm_operation(path) == expected
+
+def test_azure_and_openai_operations():
+    assert azure_operation("PUT", "https://st.blob.core.windows.net/c/b?comp=block&blockid=1") == ("blob", "PUT block")
+    assert azure_operation("PUT", "https://st.blob.core.windows.net/c?restype=container") == ("blob", "PUT container")
+    assert azure_operation("GET", "https://management.azure.com/subscriptions/s/resourceGroups/rg?api-version=1") == ("arm", "GET resourceGroups")
+    assert openai_operation("/openai/deployments/gpt/chat/completions") == "chat/completions"
+
+def test_requests_are_timed_per_route_template(client):
+    client.get("/jobs/987654")
+    client.get("/jobs/987655")
+    client.get("/no/such/path")
+
+    body = client.get("/metrics").text
+
+    # ids stay out of the labels, both requests share the route's series
+    assert re.search(r'http_request_duration_seconds_count\{method="GET",route="/jobs/\{job_id\}",status="404"\} ([2-9]|\d\d+)', body)
+    assert 'route="unmatched"' in body
+    assert re.search(r'http_request_db_queries_count\{route="/jobs/\{job_id\}"\} \d+', body)
+    assert re.search(r'db_query_duration_seconds_count\{statement="SELECT"\} \d+', body)
@@ -0,0 +1,90 @@
+import pytest
+from sqlalchemy import Boolean, Column, Integer, create_engine, inspect, text
+
+import migrations
+from database import Base
+from migrations import MIGRATIONS, add_column, upgrade, status
+import models  # registers the model tables on Base.metadata
+
+def schema(engine):
+    inspector = inspect(engine)
+    return {
+        table_name: (
+            {column['name'] for column in inspector.get_columns(table_name)},
+            {(index['name'], tuple(index['column_names']), bool(index['unique'])) for index in inspector.get_indexes(table_name)}
+        )
+        for table_name in inspector.get_table_names() if table_name != "schema_migrations"
+    }
+
+def test_migrations_build_the_schema_of_the_models(tmp_path):
+    migrated = create_engine(f"sqlite:///{tmp_path / 'migrated.db'}")
+    created = create_engine(f"sqlite:///{tmp_path / 'created.db'}")
+
+    assert upgrade(migrated) == [migration.version for migration in MIGRATIONS]
+    Base.metadata.create_all(created)
+
+    assert schema(migrated) == schema(created)
+
+def test_upgrade_applies_each_migration_once(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+
+    assert upgrade(engine, target=3) == [1, 2, 3]
+    assert upgrade(engine) == [migration.version for migration in MIGRATIONS[3:]]
+    assert upgrade(engine) == []
+    assert all(row['applied'] for row in status(engine))
+
+# Databases that Base.metadata.create_all created before the migrations existed. create_all
+# only adds missing tables, never columns, so every one of them must be upgraded in place.
+LEGACY_TABLES = ("jobs", "job_steps", "cost_snapshots", "chat_sessions")
+
+def response_cache_column(conn):
+    add_column(conn, "agents", Column("response_cache_enabled", Boolean, default=False))
+
+def rate_limit_columns(conn):
+    add_column(conn, "agents", Column("rate_limit_rpm", Integer, nullable=True))
+    add_column(conn, "agents", Column("rate_limit_tpm", Integer, nullable=True))
+
+def content_hash_columns(conn):
+    migrations.content_addressed_knowledge(conn)
+
+LEGACY_SCHEMAS = {
+    # created before the response cache: the baseline tables and the job tables only
+    'jobs_only': (("jobs", "job_steps"), []),
+    'response_cache': (("jobs", "job_steps"), [response_cache_column]),
+    'content_hash': (("jobs", "job_steps", "cost_snapshots"), [response_cache_column, content_hash_columns]),
+    'chat_sessions': (LEGACY_TABLES, [response_cache_column, content_hash_columns]),
+    # the last schema create_all produced before the migrations
+    'rate_limits': (LEGACY_TABLES, [response_cache_column, content_hash_columns, rate_limit_columns]),
+}
+
+def legacy_database(engine, tables, changes):
+    with engine.begin() as conn:
+        migrations.baseline(conn)
+        migrations.background_tables(conn)
+        # the tables the schema did not have yet are dropped again
+        for table_name in LEGACY_TABLES:
+            if table_name not in tables:
+                conn.execute(text(f"DROP TABLE {table_name}"))
+        for change in changes:
+            change(conn)
+
+@pytest.mark.parametrize("legacy_schema", LEGACY_SCHEMAS)
+def test_upgrade_brings_legacy_databases_to_the_schema_of_the_models(tmp_path, legacy_schema):
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    created = create_engine(f"sqlite:///{tmp_path / 'created.db'}")
+    legacy_database(legacy, *LEGACY_SCHEMAS[legacy_schema])
+    Base.metadata.create_all(created)
+
+    upgrade(legacy)
+
+    assert schema(legacy) == schema(created)
+
+def test_upgrade_refuses_duplicate_agent_names(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'duplicates.db'}")
+    upgrade(engine, target=8)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO agents (name) VALUES ('agent-twice-rg'), ('agent-twice-rg')"))
+
+    with pytest.raises(RuntimeError, match="agent-twice-rg"):
+        upgrade(engine)
+    assert not status(engine)[-1]['applied']
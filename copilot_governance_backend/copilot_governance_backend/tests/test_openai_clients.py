@@ -0,0 +1,55 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+from openai_clients import OpenAIClientRegistry
+
+BACKEND_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_backend_import_leaves_openai_to_the_first_client():
+    # a fresh interpreter, the test session has already imported openai
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, backend; print('openai' in sys.modules)"],
+        cwd=BACKEND_DIRECTORY, capture_output=True, text=True, check=True
+    )
+    assert result.stdout.splitlines()[-1] == "False"
+
+def test_client_is_reused_until_the_key_changes():
+    registry = OpenAIClientRegistry()
+    first = registry.get(1, "https://agent-1.openai.azure.com/", "key")
+    assert registry.get(1, "https://agent-1.openai.azure.com/", "key") is first
+    assert registry.get(1, "https://agent-1.openai.azure.com/", "rotated") is not first
+    assert (registry.hits, registry.misses) == (1, 2)
+    registry.clear()
+
+def test_least_recently_used_client_is_evicted():
+    registry = OpenAIClientRegistry(max_size=2)
+    first = registry.get(1, "https://agent-1.openai.azure.com/", "key")
+    registry.get(2, "https://agent-2.openai.azure.com/", "key")
+    registry.get(1, "https://agent-1.openai.azure.com/", "key")
+    registry.get(3, "https://agent-3.openai.azure.com/", "key")
+    assert registry.get(1, "https://agent-1.openai.azure.com/", "key") is first
+    assert registry.stats()["size"] == 2
+    registry.clear()
+
+def test_expired_or_invalidated_client_is_rebuilt():
+    registry = OpenAIClientRegistry(ttl=0)
+    first = registry.get(1, "https://agent-1.openai.azure.com/", "key")
+    assert registry.get(1, "https://agent-1.openai.azure.com/", "key") is not first
+
+    registry = OpenAIClientRegistry()
+    first = registry.get(1, "https://agent-1.openai.azure.com/", "key")
+    registry.invalidate(1)
+    assert first.is_closed()
+    assert registry.get(1, "https://agent-1.openai.azure.com/", "key") is not first
+    registry.clear()
+
+def test_async_clients_are_closed_on_the_event_loop():
+    registry = OpenAIClientRegistry(asynchronous=True, event_hooks=lambda agent_id, asynchronous: {'request': [], 'response': []})
+    client = registry.get(1, "https://agent-1.openai.azure.com/", "key")
+    assert type(client).__name__ == "AsyncAzureOpenAI"
+
+    asyncio.run(registry.aclose())
+    assert client.is_closed()
+    assert registry.stats()["size"] == 0
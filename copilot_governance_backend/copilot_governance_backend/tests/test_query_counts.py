@@ -0,0 +1,71 @@
+"""
+The knowledge-source endpoints and the agent deletion job must issue the same number
+of SQL statements however many knowledge sources the agent has.
+"""
+import threading
+import time
+
+import pytest
+from sqlalchemy import event
+
+from models import Agent, KnowledgeSource, AgentKnowledgeSource
+
+SIZES = (1, 2, 10, 41)
+
+def seed(db, sources):
+    agent = Agent(name=f"agent-count{sources}-rg", display_name=f"count{sources}", status="Waiting for approval", active=False, budget=10)
+    db.add(agent)
+    db.flush()
+    for index in range(sources):
+        knowledge_source = KnowledgeSource(name=f"source{index}", source=f"https://example.blob.core.windows.net/c/{index}", approved=index % 2 == 0)
+        db.add(knowledge_source)
+        db.flush()
+        db.add(AgentKnowledgeSource(agent_id=agent.id, knowledge_id=knowledge_source.id))
+    db.commit()
+    return agent.id
+
+@pytest.fixture
+def statements(backend):
+    # statements of the background job threads are counted apart from the request
+    recorded = {'request': [], 'job': []}
+
+    def record(*args):
+        recorded['job' if threading.current_thread().name.startswith("job") else 'request'].append(args[2])
+
+    event.listen(backend.engine, "before_cursor_execute", record)
+    yield recorded
+    event.remove(backend.engine, "before_cursor_execute", record)
+
+def wait_for_job(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while client.get(f"/jobs/{job_id}").json()['status'] in ('Pending', 'Running'):
+        assert time.monotonic() < deadline, f"Job {job_id} did not finish"
+        time.sleep(0.05)
+    return client.get(f"/jobs/{job_id}").json()
+
+def count_statements(backend, client, statements, sources):
+    def count(call):
+        statements['request'].clear()
+        response = call()
+        assert response.is_success, response.text
+        return len(statements['request']), response
+
+    db = backend.SessionLocal()
+    agent_id = seed(db, sources)
+    db.close()
+
+    counts = {
+        'GET /agent/{id}/knowledge_sources': count(lambda: client.get(f"/agent/{agent_id}/knowledge_sources"))[0],
+        'GET /knowledge_sources?agent_id=': count(lambda: client.get(f"/knowledge_sources?agent_id={agent_id}&limit=500"))[0],
+    }
+    statements['job'].clear()
+    counts['DELETE /delete_agent'], response = count(lambda: client.delete(f"/delete_agent?id={agent_id}"))
+    assert wait_for_job(client, response.json()['job_id'])['status'] == 'Succeeded'
+    counts['delete_agent job'] = len(statements['job'])
+    return counts
+
+def test_statement_counts_do_not_grow_with_sources(backend, client, statements):
+    counts = {sources: count_statements(backend, client, statements, sources) for sources in SIZES}
+
+    for endpoint in counts[SIZES[0]]:
+        assert len({counts[sources][endpoint] for sources in SIZES}) == 1, f"{endpoint}: {counts}"
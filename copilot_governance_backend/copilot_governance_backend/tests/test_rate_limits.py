@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from rate_limits import AgentLimiter, RateLimiter, RateLimitExceeded, TokenBucket
+
+def test_bucket_waits_for_the_missing_units():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0
+    bucket.take(60)
+    # one unit a second
+    assert bucket.wait_time(10, bucket.updated) == pytest.approx(10, abs=0.1)
+
+def test_request_larger_than_the_bucket_waits_for_a_full_bucket():
+    bucket = TokenBucket(60)
+    bucket.take(60)
+    assert bucket.wait_time(1000, bucket.updated) == pytest.approx(60, abs=0.1)
+
+def test_admitted_requests_take_from_both_buckets():
+    limiter = AgentLimiter(rpm=60, tpm=1000, max_queue=5, max_wait=1)
+
+    asyncio.run(limiter.acquire(400))
+
+    stats = limiter.stats()
+    assert stats['admitted'] == 1
+    assert stats['available_requests'] == pytest.approx(59, abs=0.1)
+    assert stats['available_tokens'] == pytest.approx(600, abs=1)
+
+def test_request_that_would_wait_too_long_is_rejected():
+    limiter = AgentLimiter(rpm=60, tpm=1000, max_queue=5, max_wait=1)
+    asyncio.run(limiter.acquire(1000))
+
+    # 600 tokens come back after 36 seconds, beyond max_wait
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        asyncio.run(limiter.acquire(600))
+    assert exc_info.value.retry_after >= 35
+    assert limiter.stats()['rejected'] == 1
+
+def test_short_wait_is_queued_then_admitted():
+    limiter = AgentLimiter(rpm=600, tpm=6000, max_queue=5, max_wait=1)
+    # 100 tokens a second, the second request waits about 0.2 seconds
+    asyncio.run(limiter.acquire(6000))
+    asyncio.run(limiter.acquire(20))
+    assert limiter.admitted == 2
+    assert limiter.waited > 0.1
+
+def test_full_queue_rejects_at_once():
+    async def scenario():
+        limiter = AgentLimiter(rpm=600, tpm=6000, max_queue=2, max_wait=5)
+        await limiter.acquire(6000)
+        # both wait about a second for their tokens, the third finds the queue full
+        waiting = [asyncio.create_task(limiter.acquire(50)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(RateLimitExceeded, match="waiting"):
+            await limiter.acquire(50)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert limiter.rejected == 1
+    assert limiter.waiting == 0
+
+def test_settle_returns_or_takes_the_difference():
+    limiter = AgentLimiter(rpm=60, tpm=1000, max_queue=5, max_wait=1)
+    asyncio.run(limiter.acquire(500))
+
+    limiter.settle(500, 200)
+    assert limiter.stats()['available_tokens'] == pytest.approx(800, abs=1)
+    limiter.settle(100, 400)
+    assert limiter.stats()['available_tokens'] == pytest.approx(500, abs=1)
+
+def test_limiter_is_rebuilt_when_the_agent_limits_change():
+    rate_limiter = RateLimiter(rpm=60, tpm=1000)
+    limiter = rate_limiter.limiter(1)
+    assert rate_limiter.limiter(1) is limiter
+    assert rate_limiter.limiter(1, tpm=2000) is not limiter
+
+def test_estimated_spend_restarts_with_a_newer_snapshot():
+    rate_limiter = RateLimiter(rpm=60, tpm=1000, prompt_price=1.0, completion_price=2.0)
+    taken = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    assert rate_limiter.spend(1, 5.0, taken) == 5.0
+    rate_limiter.record_spend(1, prompt_tokens=1000, completion_tokens=1000)
+    assert rate_limiter.spend(1, 5.0, taken) == 8.0
+    assert rate_limiter.over(1, 8.0, 5.0, taken)
+    assert not rate_limiter.over(1, None, 5.0, taken)
+
+    assert rate_limiter.spend(1, 9.0, taken + timedelta(minutes=15)) == 9.0
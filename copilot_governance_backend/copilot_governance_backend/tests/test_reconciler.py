@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from fake_azure import FakeAzureClients
+from jobs import JobRunner
+from models import Agent, AgentReconciliation, AGENT_DEGRADED, AGENT_MISSING
+from reconciler import Reconciler, RESOURCE_GROUP_MISSING, DEPLOYMENT_FAILED, WORKSPACE_MISSING
+
+@pytest.fixture
+def fake():
+    return FakeAzureClients()
+
+@pytest.fixture
+def reconciler(session_factory, fake):
+    return Reconciler(session_factory, fake, batch_size=2)
+
+def provision(session_factory, fake, name):
+    # the agent row and every Azure resource provisioning would have created for it
+    db = session_factory()
+    agent = Agent(name=name, display_name=name, status="Active", active=True, budget=10)
+    db.add(agent)
+    db.commit()
+    agent_id = agent.id
+    db.close()
+
+    fake.resource_client.resource_groups.create_or_update(name, {"location": "uksouth", "tags": {"type": "agent"}})
+    fake.accounts[(name, f"agent{agent_id}openai")] = f"https://agent{agent_id}openai.openai.azure.com/"
+    fake.deployments[(name, f"agent{agent_id}openai", f"gpt-3-deployment-agent{agent_id}")] = None
+    fake.workspaces[(name, f"project-agent{agent_id}")] = None
+    return agent_id
+
+def reconciliation(session_factory, agent_id):
+    db = session_factory()
+    agent = db.get(Agent, agent_id)
+    state = db.query(AgentReconciliation).filter(AgentReconciliation.agent_id == agent_id).one()
+    db.close()
+    return agent.status, json.loads(state.drift), state.previous_status
+
+def test_agents_matching_azure_have_no_drift(reconciler, session_factory, fake):
+    agent_ids = [provision(session_factory, fake, f"agent-{index}-rg") for index in range(3)]
+
+    stats = reconciler.run()
+
+    assert stats['agents'] == 3 and stats['drifted'] == 0 and stats['status_updates'] == 0
+    assert all(reconciliation(session_factory, agent_id) == ("Active", [], None) for agent_id in agent_ids)
+
+def test_deleted_resource_group_is_reported_as_drift(reconciler, session_factory, fake):
+    agent_id = provision(session_factory, fake, "agent-gone-rg")
+    fake.resource_groups.pop("agent-gone-rg")
+
+    stats = reconciler.run()
+
+    assert stats['drifted'] == 1
+    assert reconciliation(session_factory, agent_id) == (AGENT_MISSING, [RESOURCE_GROUP_MISSING], "Active")
+
+def test_status_is_restored_once_the_drift_is_gone(reconciler, session_factory, fake):
+    agent_id = provision(session_factory, fake, "agent-back-rg")
+    workspace = fake.workspaces.pop(("agent-back-rg", f"project-agent{agent_id}"))
+    reconciler.run()
+    assert reconciliation(session_factory, agent_id) == (AGENT_DEGRADED, [WORKSPACE_MISSING], "Active")
+
+    fake.workspaces[("agent-back-rg", f"project-agent{agent_id}")] = workspace
+    reconciler.run()
+
+    assert reconciliation(session_factory, agent_id) == ("Active", [], None)
+
+def test_failed_deployment_degrades_the_agent(reconciler, session_factory, fake):
+    agent_id = provision(session_factory, fake, "agent-failed-rg")
+    fake.deployment_states[("agent-failed-rg", f"agent{agent_id}openai", f"gpt-3-deployment-agent{agent_id}")] = 'Failed'
+
+    reconciler.run()
+
+    assert reconciliation(session_factory, agent_id) == (AGENT_DEGRADED, [DEPLOYMENT_FAILED], "Active")
+
+def test_deployments_are_checked_up_to_the_limit_per_run(session_factory, fake):
+    reconciler = Reconciler(session_factory, fake, deployment_check_limit=2)
+    for index in range(3):
+        provision(session_factory, fake, f"agent-{index}-rg")
+
+    first = reconciler.run()
+    second = reconciler.run()
+
+    assert first['deployment_checks'] == 2
+    # the agent left out is checked next, the others are not due again yet
+    assert second['deployment_checks'] == 1
+    assert fake.calls.count('deployments.get') == 3
+
+def test_agents_with_an_unfinished_job_are_skipped(reconciler, session_factory, fake):
+    agent_id = provision(session_factory, fake, "agent-busy-rg")
+    fake.resource_groups.pop("agent-busy-rg")
+    runner = JobRunner(session_factory, fake)
+    runner.register('delete_agent', [])
+    db = session_factory()
+    runner.create_job(db, 'delete_agent', agent_id=agent_id)
+    db.close()
+    runner.shutdown()
+
+    stats = reconciler.run()
+
+    assert stats['skipped'] == 1 and stats['drifted'] == 0
+    db = session_factory()
+    assert db.get(Agent, agent_id).status == "Active"
+    db.close()
+
+def test_resource_groups_without_an_agent_are_reported(reconciler, session_factory, fake):
+    provision(session_factory, fake, "agent-known-rg")
+    fake.resource_client.resource_groups.create_or_update("agent-orphan-rg", {"location": "uksouth", "tags": {"type": "agent"}})
+
+    stats = reconciler.run()
+
+    assert stats['orphaned_resource_groups'] == 1
+    assert reconciler.orphaned_resource_groups == ["agent-orphan-rg"]
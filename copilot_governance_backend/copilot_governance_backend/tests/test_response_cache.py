@@ -0,0 +1,51 @@
+import pytest
+
+from response_cache import DiskCacheBackend, MemoryCacheBackend, ResponseCache
+
+@pytest.fixture(params=["memory", "disk"])
+def cache(request, tmp_path):
+    if request.param == "disk":
+        backend = DiskCacheBackend(str(tmp_path / "responses.sqlite3"), max_entries=2)
+    else:
+        backend = MemoryCacheBackend(max_entries=2)
+    return ResponseCache(backend, ttl=60, prompt_price=1.0, completion_price=2.0)
+
+def test_miss_then_hit_on_a_normalized_prompt(cache):
+    assert cache.lookup(1, "gpt", "system", "What is the travel policy?") is None
+    cache.store(1, "gpt", "system", "What is the travel policy?", "Economy class.", prompt_tokens=1000, completion_tokens=500)
+
+    assert cache.lookup(1, "gpt", "system", "  what IS the   travel policy?") == "Economy class."
+    assert cache.stats(1) == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'saved_tokens': 1500, 'saved_spend': 2.0}
+
+def test_entries_are_keyed_on_agent_deployment_and_system_prompt(cache):
+    cache.store(1, "gpt", "system", "question", "answer")
+
+    assert cache.lookup(2, "gpt", "system", "question") is None
+    assert cache.lookup(1, "gpt-4", "system", "question") is None
+    assert cache.lookup(1, "gpt", "other system", "question") is None
+
+def test_expired_entries_miss(cache):
+    cache.ttl = -1
+    cache.store(1, "gpt", "system", "question", "answer")
+    assert cache.lookup(1, "gpt", "system", "question") is None
+
+def test_least_recently_used_entry_is_evicted(cache):
+    cache.store(1, "gpt", "system", "first", "1")
+    cache.store(1, "gpt", "system", "second", "2")
+    cache.lookup(1, "gpt", "system", "first")
+    cache.store(1, "gpt", "system", "third", "3")
+
+    assert cache.lookup(1, "gpt", "system", "second") is None
+    assert cache.lookup(1, "gpt", "system", "first") == "1"
+    assert len(cache.backend) == 2
+
+def test_invalidate_agent_drops_its_entries_and_stats(cache):
+    cache.store(1, "gpt", "system", "question", "answer")
+    cache.store(2, "gpt", "system", "question", "answer")
+    cache.lookup(1, "gpt", "system", "question")
+
+    cache.invalidate_agent(1)
+
+    assert cache.stats(1)['hits'] == 0
+    assert cache.lookup(1, "gpt", "system", "question") is None
+    assert cache.lookup(2, "gpt", "system", "question") == "answer"
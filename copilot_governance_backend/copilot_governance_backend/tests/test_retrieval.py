@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from retrieval import RetrievalIndex, chunk_text, np, tokenize
+
+TRAVEL = b"Travel policy. Economy class is booked for flights under six hours. Hotels are booked through the travel portal."
+PASSWORDS = b"Security policy. Passwords are rotated every ninety days and never shared by email."
+
+@pytest.fixture
+def index(tmp_path):
+    index = RetrievalIndex(str(tmp_path), passage_tokens=8, overlap=2)
+    yield index
+    index.shutdown()
+
+def test_tokenize_stems_and_drops_stopwords():
+    assert tokenize("The passwords are rotated") == ["password", "rotat"]
+
+def test_chunks_overlap_and_cover_the_text():
+    passages = list(chunk_text("one two three four five six seven", passage_tokens=4, overlap=2))
+    assert passages == ["one two three four", "three four five six", "five six seven"]
+
+def test_build_and_search(index):
+    assert index.build(1, TRAVEL, "travel.txt") > 1
+    assert index.build(2, PASSWORDS, "passwords.txt") > 0
+    assert index.indexed_ids() == {1, 2}
+
+    results = index.search([1, 2], "how often is a password rotated?", k=2)
+    assert results[0]['knowledge_source_id'] == 2
+    assert "rotated" in results[0]['passage']
+    # only the agent's own sources are searched
+    assert all(result['knowledge_source_id'] == 1 for result in index.search([1], "password hotels"))
+
+def test_search_respects_k_and_the_token_budget(index):
+    index.build(1, TRAVEL)
+    assert len(index.search([1], "travel booked", k=1)) == 1
+    assert index.search([1], "travel booked", token_budget=1) == []
+
+def test_unindexable_content_is_skipped(index):
+    assert index.build(1, b"\xff\xfe\x00binary") is None
+    assert not index.has(1)
+    assert index.search([1], "anything") == []
+
+def test_build_replaces_and_remove_deletes_the_segment(index):
+    index.build(1, TRAVEL)
+    assert index.search([1], "hotels")
+
+    index.build(1, PASSWORDS)
+    assert index.search([1], "hotels") == []
+    assert index.search([1], "passwords")
+
+    index.remove(1)
+    assert not index.has(1)
+    assert index.search([1], "passwords") == []
+
+def test_segments_are_mapped_again_by_a_new_index(tmp_path, index):
+    index.build(1, PASSWORDS)
+    reopened = RetrievalIndex(str(tmp_path))
+    assert reopened.indexed_ids() == {1}
+    assert reopened.search([1], "passwords")[0]['knowledge_source_id'] == 1
+    reopened.shutdown()
+
+@pytest.mark.skipif(np is None, reason="the vector index needs NumPy")
+def test_vector_similarity_is_blended_in(tmp_path):
+    # a two-dimensional embedding: travel texts point one way, everything else the other
+    def embedder(texts):
+        return np.array([[1.0, 0.0] if "travel" in text.casefold() or "trip" in text.casefold() else [0.0, 1.0] for text in texts])
+
+    index = RetrievalIndex(str(tmp_path), passage_tokens=8, overlap=2, embedder=embedder, vector_weight=1.0)
+    index.build(1, TRAVEL)
+    index.build(2, PASSWORDS)
+    # no word in common with the travel policy, the vectors find it
+    assert index.search([1, 2], "trip", k=1)[0]['knowledge_source_id'] == 1
+    index.shutdown()
+
+def test_scheduled_source_is_indexed_in_the_background(index):
+    index.schedule(1, lambda: (PASSWORDS, "passwords.txt"))
+    index.schedule(2, lambda: None)
+
+    deadline = time.monotonic() + 5
+    while index.stats()['pending'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert index.indexed_ids() == {1}
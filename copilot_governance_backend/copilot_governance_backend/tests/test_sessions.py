@@ -0,0 +1,79 @@
+import asyncio
+
+from models import ChatSession
+from sessions import SessionState, SessionStore
+
+def words(tokens):
+    # estimate_tokens counts four characters a token
+    return "w" * (tokens * 4)
+
+def test_window_keeps_the_newest_turns_that_fit():
+    state = SessionState("s", 1, summary="earlier")
+    state.turns = [['u', words(100), 100], ['a', words(100), 100], ['u', "second", 1], ['a', "answer", 1]]
+
+    messages = state.messages("system", "next", context_budget=100)
+
+    assert [message["content"] for message in messages] == [
+        "system", "Summary of the earlier conversation: earlier", "second", "answer", "next"
+    ]
+    assert [message["role"] for message in messages[2:]] == ["user", "assistant", "user"]
+
+def test_compaction_folds_the_oldest_turns_into_the_summary(session_factory):
+    store = SessionStore(session_factory, history_budget=100)
+    state = store.create(1)
+    for index in range(4):
+        store.record(state, words(20), words(20), prompt_tokens=10, completion_tokens=10)
+    assert store.needs_compaction(state)
+    summarized = []
+
+    async def summarize(previous, messages):
+        summarized.append((previous, len(messages)))
+        return "summary", 5, 5
+
+    asyncio.run(store.compact(state, summarize))
+
+    # the turns above half of the budget are folded in user/assistant pairs
+    assert summarized == [(None, 6)]
+    assert state.summary == "summary"
+    assert len(state.turns) == 2
+    assert not store.needs_compaction(state)
+    assert (state.prompt_tokens, state.completion_tokens) == (45, 45)
+
+def test_failed_summary_drops_the_folded_turns(session_factory):
+    store = SessionStore(session_factory, history_budget=100)
+    state = store.create(1)
+    for index in range(4):
+        store.record(state, words(20), words(20), prompt_tokens=10, completion_tokens=10)
+
+    async def summarize(previous, messages):
+        raise RuntimeError("deployment unavailable")
+
+    asyncio.run(store.compact(state, summarize))
+
+    assert state.summary is None
+    assert len(state.turns) == 2
+
+def test_evicted_sessions_are_spilled_and_loaded_again(session_factory):
+    store = SessionStore(session_factory, max_sessions=2)
+    first = store.create(1)
+    store.record(first, "hello", "hi there", prompt_tokens=3, completion_tokens=2)
+    store.create(1)
+    store.create(1)
+
+    # the least recently used session left memory after its turn was written
+    assert first.id not in store._sessions
+    db = session_factory()
+    assert db.get(ChatSession, first.id).prompt_tokens == 3
+    db.close()
+
+    loaded = store.get(first.id)
+    assert loaded is not first
+    assert [content for _, content, _ in loaded.turns] == ["hello", "hi there"]
+    db = session_factory()
+    assert store.usage(db, 1) == {
+        'sessions': 3, 'prompt_tokens': 3, 'completion_tokens': 2, 'estimated_spend': round(store.spend(3, 2), 6)
+    }
+    db.close()
+
+def test_unknown_session_is_none(session_factory):
+    assert SessionStore(session_factory).get("missing") is None
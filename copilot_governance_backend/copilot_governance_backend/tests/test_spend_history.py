@@ -0,0 +1,67 @@
+import calendar
+
+import pytest
+
+from spend_history import SpendHistoryStore, choose_step
+
+# 2026-03-01 00:00 UTC
+START = calendar.timegm((2026, 3, 1, 0, 0, 0))
+
+@pytest.fixture
+def store(tmp_path):
+    return SpendHistoryStore(str(tmp_path), raw_retention=86400, hour_retention=10 * 86400)
+
+def test_samples_roll_up_into_hours_and_days(store):
+    for minutes, value in ((0, 1.0), (30, 3.0), (60, 2.0)):
+        assert store.add_sample(1, value, START + minutes * 60)
+
+    step, raw = store.query(1, START, START + 3600, step='raw')
+    assert [point['value'] for point in raw] == [1.0, 3.0, 2.0]
+
+    step, hours = store.query(1, START, START + 86400, step='hour')
+    assert [(point['count'], point['min'], point['max'], point['last'], point['avg']) for point in hours] == [
+        (2, 1.0, 3.0, 3.0, 2.0), (1, 2.0, 2.0, 2.0, 2.0)
+    ]
+    step, days = store.query(1, START, START + 86400, step='day')
+    assert [(point['t'], point['count'], point['last']) for point in days] == [("2026-03-01T00:00:00+00:00", 3, 2.0)]
+
+def test_samples_older_than_the_newest_are_dropped(store):
+    assert store.add_sample(1, 5.0, START + 60)
+    assert not store.add_sample(1, 4.0, START)
+    assert [point['value'] for point in store.query(1, START, START + 120, step='raw')[1]] == [5.0]
+
+def test_step_is_chosen_from_the_range(store):
+    assert choose_step(START, START + 86400) == 'raw'
+    assert choose_step(START, START + 30 * 86400) == 'hour'
+    assert choose_step(START, START + 400 * 86400) == 'day'
+    assert choose_step(START, START + 10 * 366 * 86400) == 'month'
+    with pytest.raises(ValueError):
+        store.query(1, START, START + 60, step='week')
+
+def test_bulk_load_matches_sample_by_sample(tmp_path, store):
+    timestamps = [START + index * 1800 for index in range(100)]
+    values = [float(index) for index in range(100)]
+    loaded = SpendHistoryStore(str(tmp_path / "loaded"))
+    loaded.bulk_load(1, timestamps, values)
+    for ts, value in zip(timestamps, values):
+        store.add_sample(1, value, ts)
+
+    for step in ('raw', 'hour', 'day', 'month'):
+        assert loaded.query(1, START, timestamps[-1], step) == store.query(1, START, timestamps[-1], step)
+    with pytest.raises(ValueError):
+        loaded.bulk_load(1, timestamps, values)
+
+def test_compaction_drops_samples_past_their_retention(store):
+    for day in range(3):
+        store.add_sample(1, float(day), START + day * 86400)
+
+    store.compact(START + 2 * 86400)
+
+    assert [point['value'] for point in store.query(1, START, START + 3 * 86400, step='raw')[1]] == [1.0, 2.0]
+    assert len(store.query(1, START, START + 3 * 86400, step='day')[1]) == 3
+
+def test_unknown_and_deleted_agents_have_no_points(store):
+    assert store.query(2, START, START + 60, step='raw') == ('raw', [])
+    store.add_sample(1, 1.0, START)
+    store.delete_agent(1)
+    assert store.query(1, START, START + 60, step='raw') == ('raw', [])
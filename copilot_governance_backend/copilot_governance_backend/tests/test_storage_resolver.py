@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+import pytest
+
+from fake_azure import FakeAzureClients
+from storage_resolver import StorageResolver, StorageAccountNotFound
+
+@pytest.fixture
+def fake():
+    fake = FakeAzureClients()
+    fake.storage_accounts["agent-a-rg"] = {"agentastorage": "agentastorage-key1"}
+    return fake
+
+def upload(target, data=b"hello"):
+    target.container_client("knowledge", create=True).get_blob_client("a.txt").upload_blob(data, overwrite=True)
+    return target.account_name
+
+def test_storage_is_resolved_once_per_resource_group(fake):
+    resolver = StorageResolver(fake)
+
+    first = resolver.get("agent-a-rg")
+    second = resolver.get("agent-a-rg")
+
+    assert first is second
+    assert first.account_url == "https://agentastorage.blob.core.windows.net"
+    assert first.key == "agentastorage-key1"
+    assert fake.calls.count('storage_accounts.list_by_resource_group') == 1
+    assert fake.calls.count('storage_accounts.list_keys') == 1
+    assert resolver.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+def test_concurrent_misses_share_one_lookup(fake):
+    fake.latency = 0.05
+    resolver = StorageResolver(fake)
+    targets = []
+
+    threads = [threading.Thread(target=lambda: targets.append(resolver.get("agent-a-rg"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(target) for target in targets}) == 1
+    assert fake.calls.count('storage_accounts.list_keys') == 1
+
+def test_expired_entry_is_resolved_again(fake):
+    resolver = StorageResolver(fake, ttl=0)
+
+    resolver.get("agent-a-rg")
+    resolver.get("agent-a-rg")
+
+    assert fake.calls.count('storage_accounts.list_keys') == 2
+
+def test_resource_group_without_storage_account(fake):
+    with pytest.raises(StorageAccountNotFound):
+        StorageResolver(fake).get("agent-b-rg")
+
+def test_container_is_created_once(fake):
+    resolver = StorageResolver(fake)
+
+    resolver.call("agent-a-rg", upload)
+    resolver.call("agent-a-rg", upload)
+
+    assert fake.calls.count('container.create_container') == 1
+    assert fake.calls.count('container.exists') == 1
+
+def test_concurrent_first_uploads_share_the_created_container(fake):
+    fake.latency = 0.05
+    resolver = StorageResolver(fake)
+    errors = []
+
+    def first_upload():
+        try:
+            resolver.call("agent-a-rg", upload)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=first_upload) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the threads that also saw it missing have their create refused, which is ignored
+    assert errors == []
+    assert fake.containers == {"knowledge"}
+    assert fake.calls.count('container.create_container') >= 1
+
+def test_rotated_key_is_refreshed_once(fake):
+    resolver = StorageResolver(fake)
+    resolver.call("agent-a-rg", upload)
+    fake.storage_client.storage_accounts.regenerate_key("agent-a-rg", "agentastorage")
+
+    resolver.call("agent-a-rg", upload)
+
+    assert resolver.get("agent-a-rg").key == "agentastorage-key2"
+    assert fake.calls.count('storage_accounts.list_keys') == 2
+    assert fake.blobs[("knowledge", "a.txt")][0] == b"hello"
+
+def test_rotated_key_is_refreshed_for_coroutines(fake):
+    resolver = StorageResolver(fake)
+    resolver.get("agent-a-rg")
+    fake.storage_client.storage_accounts.regenerate_key("agent-a-rg", "agentastorage")
+
+    async def upload_async(target):
+        return upload(target, b"async")
+
+    assert asyncio.run(resolver.acall("agent-a-rg", upload_async)) == "agentastorage"
+    assert fake.blobs[("knowledge", "a.txt")][0] == b"async"